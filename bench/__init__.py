@@ -0,0 +1,26 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for mlat-server. Run these from the top of the source tree:
+
+  python3 -m bench.micro       timing of individual hot functions
+  python3 -m bench.scenario    end-to-end throughput, latency and accuracy
+  python3 -m bench.tracker_scale  tracker and interest management at scale
+  python3 -m bench.footprint   memory footprint of the hot objects
+"""
@@ -0,0 +1,180 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared benchmark harness: timing, JSON results, and comparison against a
+stored baseline.
+
+A results file is a JSON object:
+
+  {"meta": {...}, "results": {name: {metric: value, ...}, ...}}
+
+Each benchmark module describes which metrics are better when lower (e.g.
+per-call latency) or higher (e.g. throughput); compare() flags any metric
+that got worse than the baseline by more than a threshold.
+"""
+
+import argparse
+import json
+import platform
+import re
+import sys
+import time
+
+__all__ = ('measure', 'percentile', 'load_results', 'save_results', 'compare', 'make_arg_parser', 'selected', 'finish')
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """Time repeated calls of func().
+
+    The number of calls per round is calibrated so that a round takes at
+    least min_time seconds; the fastest of repeat rounds is reported, to
+    reduce noise from the rest of the system.
+
+    Returns a dict with ops_per_sec, per_call_us and calls (per round)."""
+
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        calls *= 10
+
+    calls = max(1, int(calls * min_time / max(elapsed, 1e-9)))
+
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    per_call = best / calls
+    return {'ops_per_sec': round(1.0 / per_call, 1),
+            'per_call_us': round(per_call * 1e6, 3),
+            'calls': calls}
+
+
+def percentile(ordered, fraction):
+    """Return the given fraction's percentile of a sorted list, or None if
+    the list is empty."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def load_results(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_results(filename, results, meta=None):
+    document = {'meta': dict(meta or {},
+                             python=platform.python_version(),
+                             machine=platform.machine(),
+                             time=round(time.time())),
+                'results': results}
+    if filename == '-':
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(filename, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def compare(results, baseline, lower_is_better=(), higher_is_better=(), threshold=0.1):
+    """Compare results against baseline results.
+
+    Returns a list of (name, metric, baseline value, new value, relative change)
+    for every metric that got worse by more than threshold (a fraction)."""
+
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+
+        for metric, value in sorted(metrics.items()):
+            old_value = old.get(metric)
+            if value is None or not old_value:
+                continue
+
+            change = (value - old_value) / old_value
+            if metric in lower_is_better and change > threshold:
+                regressions.append((name, metric, old_value, value, change))
+            elif metric in higher_is_better and -change > threshold:
+                regressions.append((name, metric, old_value, value, change))
+
+    return regressions
+
+
+def make_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--filter', default=None,
+                        help="only run benchmarks whose name matches this regular expression")
+    parser.add_argument('--output', default=None,
+                        help="write JSON results to this file ('-' for stdout)")
+    parser.add_argument('--baseline', default=None,
+                        help="compare against the results in this file, and exit with status 1 on regressions")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative change that counts as a regression (default: 0.1)")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="random seed for generating inputs (default: 1)")
+    return parser
+
+
+def selected(args, name):
+    return args.filter is None or re.search(args.filter, name)
+
+
+def finish(args, results, meta=None, lower_is_better=(), higher_is_better=()):
+    """Save and compare results as requested on the command line; return
+    the process exit status."""
+
+    if args.output:
+        save_results(args.output, results, dict(meta or {}, seed=args.seed))
+
+    if not args.baseline:
+        return 0
+
+    baseline = load_results(args.baseline)['results']
+    regressions = compare(results, baseline,
+                          lower_is_better=lower_is_better,
+                          higher_is_better=higher_is_better,
+                          threshold=args.threshold)
+
+    missing = sorted(set(baseline) - set(results))
+    if missing and args.filter is None:
+        print('Not run (present in baseline): ' + ', '.join(missing), file=sys.stderr)
+
+    if not regressions:
+        print('No regressions against {0} (threshold {1:.0f}%)'.format(args.baseline, args.threshold * 100),
+              file=sys.stderr)
+        return 0
+
+    print('REGRESSIONS against {0}:'.format(args.baseline), file=sys.stderr)
+    for name, metric, old, new, change in regressions:
+        print('  {name:40s} {metric:16s} {old:>12.3f} -> {new:>12.3f} ({change:+.0%})'.format(
+            name=name, metric=metric, old=old, new=new, change=change), file=sys.stderr)
+    return 1
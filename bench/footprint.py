@@ -0,0 +1,129 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory footprint of the server's hot objects.
+
+Runs synthetic traffic (or replays a capture) through an in-process
+coordinator with tracemalloc enabled, and reports just before the end of
+the input, while the coordinator's state is fully populated:
+
+  traced_bytes, peak_bytes   memory allocated by Python (current and peak)
+  <class>: mean_bytes        estimated size of one instance, see mlat.server.memory
+  message/<type>: bytes      size of one decoded Mode S message
+
+Compare against a baseline to see the effect of changes to object layout:
+
+  python3 -m bench.footprint --output before.json
+  python3 -m bench.footprint --baseline before.json
+"""
+
+import asyncio
+import os
+import sys
+import tracemalloc
+from contextlib import closing
+
+import modes.message
+from mlat.server import capture, memory, simulator
+
+from bench import common, scenario
+
+MESSAGES = (
+    ('DF4', lambda: simulator.encode_altitude_reply(0x4840d6, 35000)),
+    ('DF11', lambda: simulator.encode_all_call_reply(0x4840d6)),
+    ('DF17', lambda: simulator.encode_airborne_position(0x4840d6, 51.5, -0.5, 35000, False)),
+)
+
+
+def _inspect(results, name):
+    def inspect(coord):
+        traced, peak = tracemalloc.get_traced_memory()
+        results[name] = {'traced_bytes': traced, 'peak_bytes': peak}
+
+        for cls, info in sorted(coord.memory.measure()['classes'].items()):
+            results[name + '/' + cls] = {'count': info['count'],
+                                         'mean_bytes': info['mean_bytes'],
+                                         'total_bytes': info['total_bytes']}
+    return inspect
+
+
+def main():
+    parser = common.make_arg_parser("Memory footprint of the server's hot objects.")
+    parser.add_argument('--sizes', default='20x60',
+                        help="comma-separated RECEIVERSxAIRCRAFT synthetic scenarios (default: 20x60)")
+    parser.add_argument('--duration', type=float, default=120.0,
+                        help="seconds of virtual time to simulate (default: 120)")
+    parser.add_argument('--replay', action='append', default=[],
+                        help="also replay this capture file (may be repeated)")
+    parser.add_argument('--frames', type=int, default=1,
+                        help="tracemalloc traceback depth (default: 1)")
+    args = parser.parse_args()
+
+    results = {}
+
+    for name, make in MESSAGES:
+        if common.selected(args, 'message/' + name):
+            results['message/' + name] = {'bytes': memory.sizeof(modes.message.decode(make()))}
+
+    todo = []
+    for size in args.sizes.split(','):
+        if size:
+            receivers, aircraft = scenario.parse_size(size)
+            todo.append(('footprint/sim/{0}x{1}'.format(receivers, aircraft), receivers, aircraft, None))
+    for filename in args.replay:
+        todo.append(('footprint/replay/' + os.path.basename(filename), None, None, filename))
+
+    for name, receivers, aircraft, filename in todo:
+        if not common.selected(args, name):
+            continue
+
+        tracemalloc.start(args.frames)
+        try:
+            if filename is None:
+                simulation = simulator.Simulation.random(receivers, aircraft,
+                                                         seed='{0}:{1}'.format(args.seed, name))
+
+                def make_feed(coord, simulation=simulation):
+                    return simulator.InProcessDriver(coord, simulation, speed=1.0).run(args.duration)
+
+                scenario.run_scenario(make_feed, warmup=0.0, duration=args.duration - 1.0,
+                                      inspect=_inspect(results, name))
+            else:
+                def make_feed(coord, filename=filename):
+                    @asyncio.coroutine
+                    def feed():
+                        with closing(open(filename, 'rb', buffering=1048576)) as f:
+                            yield from capture.replay(coord, f, speed=1.0)
+                    return feed()
+
+                start, span = scenario.capture_span(filename)
+                scenario.run_scenario(make_feed, warmup=0.0, duration=max(0.0, span - 1.0), utc=start,
+                                      inspect=_inspect(results, name))
+        finally:
+            tracemalloc.stop()
+
+    for name, result in sorted(results.items()):
+        print('{0:50s} {1}'.format(name, ', '.join('{0}={1}'.format(k, v) for k, v in sorted(result.items()))))
+
+    return common.finish(args, results, meta={'suite': 'footprint'},
+                         lower_is_better=('bytes', 'traced_bytes', 'peak_bytes', 'mean_bytes'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks of the server's hot functions.
+
+Inputs are generated from a seeded simulation (see mlat.server.simulator),
+so runs with the same seed time the same work. Functions whose cost
+depends on the number of receivers involved are run for each count given
+by --receivers.
+
+  python3 -m bench.micro --output baseline.json
+  python3 -m bench.micro --baseline baseline.json
+"""
+
+import math
+import random
+import sys
+
+import numpy
+
+import modes.crc
+import modes.cpr
+import modes.message
+from mlat import geodesy, constants
+from mlat.server import clocksync, clocknorm, mlattrack, solver, kalman, simulator
+
+from bench import common
+
+CENTER = (51.5, -0.5)
+AIRCRAFT_LLH = (51.6, -0.4, 10000.0)
+
+
+class _Receiver(object):
+    """Just enough of coordinator.Receiver for the clock and solver code."""
+
+    def __init__(self, sim):
+        self.uuid = sim.uuid
+        self.sim = sim
+        self.clock = sim.clock
+        self.position = sim.ecef
+        self.distance = {}
+
+    def __lt__(self, other):
+        return self.uuid < other.uuid
+
+
+class _ClockTracker(object):
+    def __init__(self):
+        self.clock_pairs = {}
+
+
+def _make_receivers(rng, count, clock_type='beast'):
+    """Return count receivers placed around CENTER, all with the given clock type."""
+
+    def place():
+        r = 150e3 * math.sqrt(rng.random())
+        bearing = rng.uniform(0, 2 * math.pi)
+        return (CENTER[0] + (r * math.cos(bearing) / geodesy.SPHERICAL_R) * constants.RTOD,
+                CENTER[1] + (r * math.sin(bearing) / geodesy.SPHERICAL_R /
+                             math.cos(CENTER[0] * constants.DTOR)) * constants.RTOD,
+                rng.uniform(0, 300))
+
+    receivers = [_Receiver(simulator.SimReceiver('r{0:03d}'.format(i), place(), clock_type=clock_type,
+                                                 rng=random.Random(rng.random())))
+                 for i in range(count)]
+    for r0 in receivers:
+        for r1 in receivers:
+            r0.distance[r1] = geodesy.ecef_distance(r0.position, r1.position)
+    return receivers
+
+
+def _arrival(receiver, ecef, t):
+    return t + geodesy.ecef_distance(receiver.position, ecef) / constants.Cair
+
+
+class _PairFeed(object):
+    """Generates a stream of ClockPairing updates from two simulated clocks,
+    as if both receivers heard an even/odd DF17 pair every half second."""
+
+    def __init__(self, base, peer, ecef):
+        self.base = base
+        self.peer = peer
+        self.ecef = ecef
+        self.t = 0.0
+
+    def next(self):
+        t = self.t
+        self.t += 0.5
+        base = self.base.sim
+        peer = self.peer.sim
+        b0 = base.timestamp(_arrival(self.base, self.ecef, t), 0.0)
+        b1 = base.timestamp(_arrival(self.base, self.ecef, t + 0.4), 0.0)
+        p0 = peer.timestamp(_arrival(self.peer, self.ecef, t), 0.0)
+        p1 = peer.timestamp(_arrival(self.peer, self.ecef, t + 0.4), 0.0)
+
+        # correct for the propagation delays, as the clock tracker does
+        b_delay = geodesy.ecef_distance(self.base.position, self.ecef) / constants.Cair * self.base.clock.freq
+        p_delay = geodesy.ecef_distance(self.peer.position, self.ecef) / constants.Cair * self.peer.clock.freq
+        return (0x123456, b1 - b_delay, p1 - p_delay, b1 - b0, p1 - p0)
+
+
+def _make_pairing(base, peer, ecef, warmup=40):
+    pairing = clocksync.ClockPairing(base, peer)
+    feed = _PairFeed(base, peer, ecef)
+    for i in range(warmup):
+        pairing.update(*feed.next())
+    return pairing, feed
+
+
+def _make_clock_tracker(receivers, ecef):
+    tracker = _ClockTracker()
+    for r0 in receivers:
+        for r1 in receivers:
+            if r0 < r1:
+                tracker.clock_pairs[(r0, r1)] = _make_pairing(r0, r1, ecef)[0]
+    return tracker
+
+
+def _timestamp_map(receivers, ecef, t):
+    return {r: [(r.sim.timestamp(_arrival(r, ecef, t), 0.0), t)] for r in receivers}
+
+
+def _measurements(rng, receivers, ecef):
+    """Return solver-style measurements of a transmission from ecef."""
+
+    measurements = [(r, geodesy.ecef_distance(r.position, ecef) / constants.Cair + rng.gauss(0, 100e-9), 1e-14)
+                    for r in receivers]
+    measurements.sort(key=lambda m: m[1])
+    return measurements
+
+
+# benchmark factories: each takes (rng) or (rng, receiver count) and
+# returns a no-argument callable to time
+
+def bench_crc_long(rng):
+    message = simulator.encode_airborne_position(0x4ca123, 51.5, -0.5, 35000, False)
+    return lambda: modes.crc.residual(message)
+
+
+def bench_crc_short(rng):
+    message = simulator.encode_altitude_reply(0x4ca123, 35000)
+    return lambda: modes.crc.residual(message)
+
+
+def bench_decode_df17(rng):
+    message = simulator.encode_airborne_position(0x4ca123, 51.5, -0.5, 35000, False)
+    return lambda: modes.message.decode(message)
+
+
+def bench_decode_df4(rng):
+    message = simulator.encode_altitude_reply(0x4ca123, 35000)
+    return lambda: modes.message.decode(message)
+
+
+def bench_decode_df11(rng):
+    message = simulator.encode_all_call_reply(0x4ca123)
+    return lambda: modes.message.decode(message)
+
+
+def bench_cpr_decode(rng):
+    lat, lon = 51.5 + rng.random(), -0.5 + rng.random()
+    latE, lonE = modes.cpr.encode(lat, lon, False)
+    latO, lonO = modes.cpr.encode(lat, lon, True)
+    return lambda: modes.cpr.decode(latE, lonE, latO, lonO)
+
+
+def bench_llh2ecef(rng):
+    llh = AIRCRAFT_LLH
+    return lambda: geodesy.llh2ecef(llh)
+
+
+def bench_ecef2llh(rng):
+    ecef = geodesy.llh2ecef(AIRCRAFT_LLH)
+    return lambda: geodesy.ecef2llh(ecef)
+
+
+def bench_greatcircle(rng):
+    p0 = AIRCRAFT_LLH
+    p1 = (CENTER[0], CENTER[1], 0.0)
+    return lambda: geodesy.greatcircle(p0, p1)
+
+
+def bench_ecef_distance(rng):
+    p0 = geodesy.llh2ecef(AIRCRAFT_LLH)
+    p1 = geodesy.llh2ecef((CENTER[0], CENTER[1], 0.0))
+    return lambda: geodesy.ecef_distance(p0, p1)
+
+
+def bench_pairing_update(rng):
+    base, peer = _make_receivers(rng, 2)
+    pairing, feed = _make_pairing(base, peer, geodesy.llh2ecef(AIRCRAFT_LLH))
+    # precompute a long stream of updates so the timing covers only update()
+    updates = [feed.next() for i in range(20000)]
+    state = {'i': 0}
+
+    def run():
+        i = state['i']
+        if i == len(updates):
+            # start over with a fresh pairing and the same stream
+            state['i'] = i = 0
+            state['pairing'] = _make_pairing(base, peer, geodesy.llh2ecef(AIRCRAFT_LLH))[0]
+        state['pairing'].update(*updates[i])
+        state['i'] = i + 1
+
+    state['pairing'] = pairing
+    return run
+
+
+def bench_pairing_predict(rng):
+    base, peer = _make_receivers(rng, 2)
+    pairing, feed = _make_pairing(base, peer, geodesy.llh2ecef(AIRCRAFT_LLH))
+    base_ts = pairing.ts_base[-1] - 0.25 * base.clock.freq
+    return lambda: pairing.predict_peer(base_ts)
+
+
+def bench_normalize(rng, n):
+    receivers = _make_receivers(rng, n)
+    ecef = geodesy.llh2ecef(AIRCRAFT_LLH)
+    tracker = _make_clock_tracker(receivers, ecef)
+    t = receivers[0].sim.rng.random()
+    timestamp_map = _timestamp_map(receivers, ecef, 20.0 + t)
+    return lambda: clocknorm.normalize(clocktracker=tracker, timestamp_map=timestamp_map)
+
+
+def bench_cluster(rng, n):
+    receivers = _make_receivers(rng, n)
+    ecef = geodesy.llh2ecef(AIRCRAFT_LLH)
+    tracker = _make_clock_tracker(receivers, ecef)
+
+    # three transmissions of the same message, as when an aircraft repeats a reply
+    timestamp_map = {}
+    for t in (20.0, 21.0, 22.0):
+        for r, timestamps in _timestamp_map(receivers, ecef, t).items():
+            timestamp_map.setdefault(r, []).extend(timestamps)
+
+    component = clocknorm.normalize(clocktracker=tracker, timestamp_map=timestamp_map)[0]
+    return lambda: mlattrack._cluster_timestamps(component, 4)
+
+
+def bench_solve(rng, n):
+    receivers = _make_receivers(rng, n)
+    cases = []
+    for i in range(16):
+        llh = (CENTER[0] + rng.uniform(-1, 1), CENTER[1] + rng.uniform(-1.5, 1.5), rng.uniform(1000, 12000))
+        cases.append((_measurements(rng, receivers, geodesy.llh2ecef(llh)), llh[2]))
+    state = {'i': 0}
+
+    def run():
+        measurements, altitude = cases[state['i'] % len(cases)]
+        state['i'] += 1
+        solver.solve(measurements, altitude, 50.0, receivers[0].position)
+
+    return run
+
+
+def bench_kalman_update(rng, n):
+    receivers = _make_receivers(rng, n)
+    aircraft = simulator.SimAircraft(0x4ca123, AIRCRAFT_LLH, heading=rng.uniform(0, 360), speed=200.0)
+
+    # precompute one observation per second of flight
+    observations = []
+    for i in range(600):
+        t = float(i)
+        ecef = aircraft.ecef(t)
+        position = numpy.array(ecef) + [rng.gauss(0, 50) for j in range(3)]
+        observations.append((t, _measurements(rng, receivers, ecef), aircraft.position(t)[2],
+                             position, numpy.diag([100.0 ** 2] * 3)))
+
+    def fresh():
+        state = kalman.KalmanStateCA(0x4ca123)
+        for t, measurements, altitude, position, cov in observations[:5]:
+            state.update(t, measurements, altitude, 50.0, position, cov, n, n - 3)
+        return state
+
+    state = {'i': 5, 'filter': fresh()}
+
+    def run():
+        i = state['i']
+        if i == len(observations):
+            state['i'] = i = 5
+            state['filter'] = fresh()
+        t, measurements, altitude, position, cov = observations[i]
+        state['filter'].update(t, measurements, altitude, 50.0, position, cov, n, n - 3)
+        state['i'] = i + 1
+
+    return run
+
+
+BENCHMARKS = [
+    ('crc.residual/long', bench_crc_long),
+    ('crc.residual/short', bench_crc_short),
+    ('message.decode/df17', bench_decode_df17),
+    ('message.decode/df4', bench_decode_df4),
+    ('message.decode/df11', bench_decode_df11),
+    ('cpr.decode', bench_cpr_decode),
+    ('geodesy.llh2ecef', bench_llh2ecef),
+    ('geodesy.ecef2llh', bench_ecef2llh),
+    ('geodesy.greatcircle', bench_greatcircle),
+    ('geodesy.ecef_distance', bench_ecef_distance),
+    ('ClockPairing.update', bench_pairing_update),
+    ('ClockPairing.predict_peer', bench_pairing_predict),
+]
+
+# these are run once per receiver count
+SCALED_BENCHMARKS = [
+    ('clocknorm.normalize', bench_normalize),
+    ('mlattrack._cluster_timestamps', bench_cluster),
+    ('solver.solve', bench_solve),
+    ('KalmanStateCA.update', bench_kalman_update),
+]
+
+
+def main():
+    parser = common.make_arg_parser("Micro-benchmarks of mlat-server hot functions.")
+    parser.add_argument('--receivers', default='4,8,16,32',
+                        help="comma-separated receiver counts for scaled benchmarks (default: 4,8,16,32)")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimum time per timing round, in seconds (default: 0.2)")
+    args = parser.parse_args()
+
+    todo = []
+    for name, factory in BENCHMARKS:
+        todo.append((name, factory, ()))
+    for name, factory in SCALED_BENCHMARKS:
+        for n in [int(x) for x in args.receivers.split(',')]:
+            todo.append(('{0}/n={1}'.format(name, n), factory, (n,)))
+
+    results = {}
+    for name, factory, extra in todo:
+        if not common.selected(args, name):
+            continue
+
+        func = factory(random.Random('{0}:{1}'.format(args.seed, name)), *extra)
+        results[name] = common.measure(func, min_time=args.min_time)
+        print('{name:40s} {us:12.3f} us/call {ops:14.1f} ops/s'.format(
+            name=name, us=results[name]['per_call_us'], ops=results[name]['ops_per_sec']))
+        sys.stdout.flush()
+
+    return common.finish(args, results, meta={'suite': 'micro'},
+                         lower_is_better=('per_call_us',),
+                         higher_is_better=('ops_per_sec',))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end scenarios: synthetic or recorded traffic fed through a
+coordinator running in this process.
+
+Scenarios run on a virtual clock (see mlat.server.timebase): timer-driven
+behaviour such as MLAT_DELAY is the same as in a real-time run, but the
+run goes as fast as the server can process its input, so wall-clock
+throughput is the server's sustainable message rate.
+
+After a warmup period (while clock sync converges), each scenario reports:
+
+  messages_per_sec       input messages (sync + mlat) processed per wall-clock second
+  cpu_per_message_us     CPU time per input message
+  results                number of multilateration results
+  latency_p50/p99_ms     result time minus the time of the located message (virtual clock)
+  resolve_p50/p99_us     wall-clock time to resolve one message group
+  error_p50/p90/p99_m    position error against truth (synthetic traffic only)
+
+Configuration values can be overridden to compare settings:
+
+  python3 -m bench.scenario --sizes 20x50,50x150 --output baseline.json
+  python3 -m bench.scenario --set MLAT_DELAY=1.5 --baseline baseline.json
+  python3 -m bench.scenario --replay capture.bin
+"""
+
+import ast
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+from mlat.server import config, coordinator, capture, simulator, timebase
+
+from bench import common
+
+
+class _Probe(object):
+    """Instruments a coordinator: counts input messages, times group
+    resolution, and collects result latency and (optionally) accuracy.
+
+    Nothing is recorded until start() is called, so the warmup period can
+    be excluded."""
+
+    def __init__(self, coordinator, simulation=None):
+        self.coordinator = coordinator
+        self.accuracy = simulator.AccuracyStats(simulation) if simulation else None
+        self.recording = False
+        self.messages = 0
+        self.latencies = []
+        self.resolve_times = []
+        self.wall_start = self.cpu_start = None
+        self.wall_end = self.cpu_end = None
+
+        # instance attributes shadow the methods; mlattrack looks up
+        # _resolve when it schedules each group, so this sees every group
+        self._wrap(coordinator, 'receiver_sync', self._count)
+        self._wrap(coordinator, 'receiver_mlat', self._count)
+        self._wrap(coordinator.mlat_tracker, '_resolve', self._time)
+        coordinator.add_output_handler(self._result)
+
+    def _wrap(self, obj, name, wrapper):
+        original = getattr(obj, name)
+        setattr(obj, name, lambda *args: wrapper(original, *args))
+
+    def _count(self, original, *args):
+        if self.recording:
+            self.messages += 1
+        return original(*args)
+
+    def _time(self, original, *args):
+        if not self.recording:
+            return original(*args)
+
+        start = time.perf_counter()
+        try:
+            return original(*args)
+        finally:
+            self.resolve_times.append(time.perf_counter() - start)
+
+    def _result(self, receive_timestamp, address, ecef, *args):
+        if not self.recording:
+            return
+
+        self.latencies.append(timebase.time() - receive_timestamp)
+        if self.accuracy:
+            self.accuracy.add(receive_timestamp, address, ecef)
+
+    def start(self):
+        self.recording = True
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def stop(self):
+        self.recording = False
+        self.wall_end = time.perf_counter()
+        self.cpu_end = time.process_time()
+
+    def summary(self):
+        if self.wall_start is None:
+            return {'messages': 0, 'results': 0}
+
+        wall = self.wall_end - self.wall_start
+        cpu = self.cpu_end - self.cpu_start
+        latencies = sorted(self.latencies)
+        resolve_times = sorted(self.resolve_times)
+
+        def scaled(value, scale, digits):
+            return None if value is None else round(value * scale, digits)
+
+        result = {'messages': self.messages,
+                  'wall_seconds': round(wall, 3),
+                  'messages_per_sec': round(self.messages / wall, 1) if wall > 0 else None,
+                  'cpu_per_message_us': round(cpu * 1e6 / self.messages, 2) if self.messages else None,
+                  'groups': len(resolve_times),
+                  'results': len(latencies),
+                  'latency_p50_ms': scaled(common.percentile(latencies, 0.5), 1e3, 1),
+                  'latency_p99_ms': scaled(common.percentile(latencies, 0.99), 1e3, 1),
+                  'resolve_p50_us': scaled(common.percentile(resolve_times, 0.5), 1e6, 1),
+                  'resolve_p99_us': scaled(common.percentile(resolve_times, 0.99), 1e6, 1)}
+
+        if self.accuracy:
+            accuracy = self.accuracy.summary()
+            for name in ('p50', 'p90', 'p99'):
+                result['error_' + name + '_m'] = accuracy.get(name)
+
+        return result
+
+
+def capture_span(filename):
+    """Return (start, duration) of a capture: the estimated UTC time at
+    which it started (from its first mlat message, or None if there are
+    none), and the time of its last event relative to the start."""
+
+    start = None
+    t = 0.0
+    with closing(open(filename, 'rb', buffering=1048576)) as f:
+        for event, t, index, args in capture.read_capture(f):
+            if start is None and event == capture.MLAT:
+                timestamp, message, utc = args
+                start = utc - t
+    return start, t
+
+
+def run_scenario(make_feed, duration=None, warmup=60.0, utc=None, simulation=None, inspect=None):
+    """Run one scenario on a fresh virtual-time loop and coordinator.
+
+    make_feed: called with the coordinator; returns a coroutine that feeds
+      it input (and returns once all input is delivered)
+    duration: if not None, stop recording this long after the end of the warmup
+    warmup: seconds of virtual time to run before recording anything
+    utc: initial virtual UTC time (default: now)
+    simulation: if given, results are checked against its truth
+    inspect: if given, called with the coordinator at the end of the
+      recording period; or, if duration is None, once all input has been
+      delivered
+
+    Returns the probe's summary."""
+
+    loop = timebase.use_virtual_time(timebase.VirtualTimeEventLoop(utc=utc))
+    work_dir = tempfile.mkdtemp(prefix='mlat-bench-')
+    try:
+        coord = coordinator.Coordinator(work_dir=work_dir)
+        probe = _Probe(coord, simulation)
+        loop.run_until_complete(coord.start())
+        try:
+            timebase.call_later(warmup, probe.start)
+            if duration is not None:
+                timebase.call_later(warmup + duration, probe.stop)
+                if inspect:
+                    timebase.call_later(warmup + duration, inspect, coord)
+
+            loop.run_until_complete(make_feed(coord))
+            if inspect and duration is None:
+                inspect(coord)
+
+            # let pending groups resolve
+            loop.run_until_complete(asyncio.sleep(config.MLAT_DELAY + 1.0))
+            if probe.recording:
+                probe.stop()
+        finally:
+            coord.close()
+            loop.run_until_complete(coord.wait_closed())
+
+        return probe.summary()
+    finally:
+        loop.close()
+        timebase.use_real_time()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_size(s):
+    receivers, sep, aircraft = s.partition('x')
+    return int(receivers), int(aircraft)
+
+
+def _parse_setting(s):
+    name, sep, value = s.partition('=')
+    if not sep or not hasattr(config, name):
+        raise ValueError('unknown config setting: ' + s)
+    return name, ast.literal_eval(value)
+
+
+def main():
+    parser = common.make_arg_parser("End-to-end throughput, latency and accuracy scenarios.")
+    parser.add_argument('--sizes', default='20x50,50x150',
+                        help="comma-separated RECEIVERSxAIRCRAFT synthetic scenarios (default: 20x50,50x150)")
+    parser.add_argument('--duration', type=float, default=240.0,
+                        help="seconds of virtual time to measure, after warmup (default: 240)")
+    parser.add_argument('--warmup', type=float, default=60.0,
+                        help="seconds of virtual time to run before measuring (default: 60)")
+    parser.add_argument('--radius', type=float, default=250.0,
+                        help="radius of the synthetic area, in km (default: 250)")
+    parser.add_argument('--replay', action='append', default=[],
+                        help="also run a scenario that replays this capture file (may be repeated)")
+    parser.add_argument('--set', dest='settings', type=_parse_setting, action='append', default=[],
+                        metavar='NAME=VALUE', help="override a mlat.server.config setting (may be repeated)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+
+    for name, value in args.settings:
+        setattr(config, name, value)
+
+    todo = []
+    for size in args.sizes.split(','):
+        if not size:
+            continue
+        receivers, aircraft = parse_size(size)
+        todo.append(('sim/{0}x{1}'.format(receivers, aircraft), receivers, aircraft, None))
+    for filename in args.replay:
+        todo.append(('replay/' + os.path.basename(filename), None, None, filename))
+
+    results = {}
+    for name, receivers, aircraft, filename in todo:
+        if not common.selected(args, name):
+            continue
+
+        if filename is None:
+            simulation = simulator.Simulation.random(receivers, aircraft,
+                                                     radius=args.radius * 1e3,
+                                                     seed='{0}:{1}'.format(args.seed, name))
+
+            def make_feed(coord, simulation=simulation):
+                driver = simulator.InProcessDriver(coord, simulation, speed=1.0)
+                return driver.run(args.warmup + args.duration)
+
+            results[name] = run_scenario(make_feed,
+                                         duration=args.duration,
+                                         warmup=args.warmup,
+                                         simulation=simulation)
+        else:
+            def make_feed(coord, filename=filename):
+                @asyncio.coroutine
+                def feed():
+                    with closing(open(filename, 'rb', buffering=1048576)) as f:
+                        yield from capture.replay(coord, f, speed=1.0)
+                return feed()
+
+            results[name] = run_scenario(make_feed,
+                                         warmup=args.warmup,
+                                         utc=capture_span(filename)[0])
+
+        print('{0}: {1}'.format(name, ', '.join('{0}={1}'.format(k, v) for k, v in sorted(results[name].items()))))
+        sys.stdout.flush()
+
+    return common.finish(args, results,
+                         meta={'suite': 'scenario',
+                               'settings': {name: value for name, value in args.settings}},
+                         lower_is_better=('cpu_per_message_us', 'latency_p50_ms', 'latency_p99_ms',
+                                          'resolve_p50_us', 'resolve_p99_us',
+                                          'error_p50_m', 'error_p90_m', 'error_p99_m'),
+                         higher_is_better=('messages_per_sec', 'results'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
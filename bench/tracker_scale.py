@@ -0,0 +1,245 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scaling benchmark for the tracker and receiver interest management.
+
+Builds a population of receivers and aircraft scattered over a flat square
+area (each receiver sees the aircraft within --range of it), then times
+individual operations on randomly chosen receivers:
+
+  add                  Tracker.add: a receiver starts seeing a few aircraft
+  remove               Tracker.remove: a receiver stops seeing a few aircraft
+  update_interest      Tracker.update_interest after a new rate report
+  update_interest_sets Receiver.update_interest_sets with a changed sync set
+  refresh              Receiver.refresh_traffic_requests after an interest change
+  remove_all           Tracker.remove_all: a receiver disconnects
+  join                 Tracker.add of a whole tracking set, plus update_interest
+
+Memory used by the populated tracker is measured with tracemalloc. This
+makes building the population several times slower (minutes at 10000
+receivers); use --no-memory to skip it.
+
+  python3 -m bench.tracker_scale --receivers 1000,5000,10000 --output tracker.json
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from mlat.server import tracker, coordinator
+
+from bench import common
+
+OPERATIONS = ('add', 'remove', 'update_interest', 'update_interest_sets', 'refresh', 'remove_all', 'join')
+
+
+class _Connection(object):
+    """Connection that discards traffic requests."""
+
+    def request_traffic(self, receiver, start_set, stop_set):
+        pass
+
+
+class _World(object):
+    """Receiver and aircraft positions, and what each receiver can see."""
+
+    def __init__(self, receiver_count, aircraft_count, size, max_range, adsb_fraction, seed):
+        rs = numpy.random.RandomState(seed)
+        self.icao = numpy.array(random.Random(seed).sample(range(0x100000, 0xf00000), aircraft_count))
+        self.aircraft_xy = rs.uniform(0, size, (aircraft_count, 2))
+        self.adsb = rs.uniform(0, 1, aircraft_count) < adsb_fraction
+        self.receiver_xy = rs.uniform(0, size, (receiver_count, 2))
+        self.max_range = max_range
+        self.rs = rs
+
+    def visible(self, index):
+        """Return the indexes of the aircraft visible to a receiver."""
+        delta = self.aircraft_xy - self.receiver_xy[index]
+        return numpy.nonzero((delta ** 2).sum(axis=1) < self.max_range ** 2)[0]
+
+    def rate_report(self, visible):
+        """Return a plausible rate report for a receiver that sees the given aircraft."""
+        adsb = visible[self.adsb[visible]]
+        rates = self.rs.uniform(0.1, 2.0, len(adsb))
+        return dict(zip(self.icao[adsb].tolist(), rates.tolist()))
+
+
+def _populate(t, world):
+    """Connect every receiver in the world to tracker t, as a real server
+    would see them: tracking sets first, then rate reports. Returns the
+    list of (receiver, tracked icao set) pairs."""
+
+    connection = _Connection()
+    population = []
+    for i in range(len(world.receiver_xy)):
+        receiver = coordinator.Receiver(uuid='r{0:05d}'.format(i), user='r{0:05d}'.format(i),
+                                        connection=connection, clock=None,
+                                        position_llh=(0.0, 0.0, 0.0),
+                                        privacy=False, connection_info='bench')
+        visible = world.visible(i)
+        icao_set = set(world.icao[visible].tolist())
+        t.add(receiver, icao_set)
+        receiver.last_rate_report = world.rate_report(visible)
+        population.append((receiver, icao_set))
+
+    for receiver, icao_set in population:
+        t.update_interest(receiver)
+
+    for receiver in t.dirty_receivers:
+        receiver.refresh_traffic_requests()
+    t.dirty_receivers.clear()
+
+    return population
+
+
+def _timed(times, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    times.append(time.perf_counter() - start)
+
+
+def _churn(t, world, population, ops, rng, batch):
+    """Time each operation on ops randomly chosen receivers. The population
+    is left as it was found (modulo fresh rate reports)."""
+
+    times = {name: [] for name in OPERATIONS}
+
+    for n in range(ops):
+        receiver, icao_set = population[rng.randrange(len(population))]
+        if len(icao_set) <= batch:
+            continue
+
+        # seen/lost updates
+        changed = set(rng.sample(sorted(icao_set), batch))
+        _timed(times['remove'], t.remove, receiver, changed)
+        _timed(times['add'], t.add, receiver, changed)
+
+        # rate report and the resulting interest change
+        report = {icao: rate * rng.uniform(0.8, 1.2) for icao, rate in receiver.last_rate_report.items()}
+        receiver.last_rate_report = report
+        _timed(times['update_interest'], t.update_interest, receiver)
+        _timed(times['refresh'], receiver.refresh_traffic_requests)
+
+        sync, mlat = receiver.sync_interest, receiver.mlat_interest
+        fewer = set(list(sync)[::2])
+        _timed(times['update_interest_sets'], receiver.update_interest_sets, fewer, mlat)
+        receiver.update_interest_sets(sync, mlat)
+
+        # leave and rejoin
+        _timed(times['remove_all'], t.remove_all, receiver)
+        start = time.perf_counter()
+        t.add(receiver, icao_set)
+        t.update_interest(receiver)
+        times['join'].append(time.perf_counter() - start)
+        receiver.refresh_traffic_requests()
+
+    t.dirty_receivers.clear()
+    return times
+
+
+def _summarize(times):
+    ordered = sorted(times)
+    return {'ops': len(ordered),
+            'mean_us': round(sum(ordered) * 1e6 / len(ordered), 2) if ordered else None,
+            'p99_us': round(common.percentile(ordered, 0.99) * 1e6, 2) if ordered else None,
+            'max_us': round(ordered[-1] * 1e6, 2) if ordered else None}
+
+
+def run(receiver_count, args):
+    """Run the benchmark for one receiver count; returns a dict of results."""
+
+    world = _World(receiver_count, args.aircraft, args.size * 1e3, args.range * 1e3,
+                   args.adsb_fraction, args.seed)
+    t = tracker.Tracker(partition=(1, 1))
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    population = _populate(t, world)
+    build_time = time.perf_counter() - start
+    if args.memory:
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    pairs = sum(len(ac.tracking) for ac in t.aircraft.values())
+    prefix = 'tracker/r={0}'.format(receiver_count)
+    results = {}
+
+    population_result = {'receivers': receiver_count,
+                         'aircraft': len(t.aircraft),
+                         'tracking_pairs': pairs,
+                         'sync_interest_pairs': sum(len(r.sync_interest) for r, s in population),
+                         'mlat_interest_pairs': sum(len(r.mlat_interest) for r, s in population),
+                         'build_seconds': round(build_time, 3)}
+    if args.memory:
+        population_result.update(bytes=traced,
+                                 bytes_per_receiver=round(traced / receiver_count),
+                                 bytes_per_pair=round(traced / pairs, 1) if pairs else None)
+    results[prefix + '/population'] = population_result
+
+    times = _churn(t, world, population, args.ops, random.Random(args.seed), args.batch)
+    for name in OPERATIONS:
+        results[prefix + '/' + name] = _summarize(times[name])
+
+    return results
+
+
+def main():
+    parser = common.make_arg_parser("Scaling benchmark for the tracker and interest management.")
+    parser.add_argument('--receivers', default='1000,5000,10000',
+                        help="comma-separated receiver counts (default: 1000,5000,10000)")
+    parser.add_argument('--aircraft', type=int, default=20000,
+                        help="number of aircraft (default: 20000)")
+    parser.add_argument('--size', type=float, default=5000.0,
+                        help="side of the square area, in km (default: 5000)")
+    parser.add_argument('--range', type=float, default=250.0,
+                        help="receiver range, in km (default: 250)")
+    parser.add_argument('--adsb-fraction', type=float, default=0.5,
+                        help="fraction of aircraft that transmit ADS-B positions (default: 0.5)")
+    parser.add_argument('--ops', type=int, default=200,
+                        help="number of receivers to churn per receiver count (default: 200)")
+    parser.add_argument('--batch', type=int, default=5,
+                        help="aircraft per seen/lost update (default: 5)")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', default=True,
+                        help="don't measure memory (tracemalloc slows down building the population)")
+    args = parser.parse_args()
+
+    results = {}
+    for receiver_count in [int(x) for x in args.receivers.split(',')]:
+        if not common.selected(args, 'tracker/r={0}'.format(receiver_count)):
+            continue
+
+        for name, result in sorted(run(receiver_count, args).items()):
+            results[name] = result
+            print('{0:40s} {1}'.format(name, ', '.join('{0}={1}'.format(k, v) for k, v in sorted(result.items()))))
+            sys.stdout.flush()
+
+    return common.finish(args, results,
+                         meta={'suite': 'tracker_scale',
+                               'aircraft': args.aircraft,
+                               'size_km': args.size,
+                               'range_km': args.range},
+                         lower_is_better=('mean_us', 'p99_us', 'bytes', 'bytes_per_receiver', 'bytes_per_pair'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
+import threading
+import time
 
 # NB: This requires Python 3.3 when MLAT_CPU_PROFILE is set.
 
@@ -30,8 +33,6 @@ if not int(os.environ.get('MLAT_CPU_PROFILE', '0')):
     def dump_cpu_profiles(tofile=None):
         pass
 else:
-    import sys
-    import time
     import operator
     import functools
 
@@ -94,3 +95,217 @@ else:
             rank += 1
 
         tofile.flush()
+
+
+# Pipeline latency histograms. Stages are arbitrary names; each stage gets
+# a histogram with fixed, roughly logarithmic, bucket bounds (in seconds).
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005,
+                   0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0,
+                   10.0, 25.0, 50.0)
+
+if not int(os.environ.get('MLAT_LATENCY_PROFILE', '0')):
+    latency_enabled = False
+
+    def record_latency(stage, seconds):
+        pass
+
+    def latency_histograms():
+        return []
+
+    def dump_latency_profiles(tofile=None):
+        pass
+else:
+    import bisect
+    import collections
+
+    print('Latency profiling enabled', file=sys.stderr)
+    latency_enabled = True
+    _latency_tracking = collections.OrderedDict()
+
+    def record_latency(stage, seconds):
+        tracking = _latency_tracking.get(stage)
+        if tracking is None:
+            # counts (one per bucket, plus overflow), total, max
+            tracking = _latency_tracking[stage] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0.0]
+
+        tracking[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        tracking[1] += seconds
+        if seconds > tracking[2]:
+            tracking[2] = seconds
+
+    def latency_histograms():
+        """Return a list of (stage, bucket counts, total, max) tuples.
+        Bucket counts are not cumulative; the last count is for values
+        above the largest bucket bound."""
+        return [(stage, list(counts), total, maxval)
+                for stage, (counts, total, maxval) in _latency_tracking.items()]
+
+    def _percentile(counts, n, fraction, maxval):
+        # upper bound of the bucket containing the percentile
+        target = n * fraction
+        seen = 0
+        for i, count in enumerate(counts[:-1]):
+            seen += count
+            if seen >= target:
+                return min(LATENCY_BUCKETS[i], maxval)
+        return maxval
+
+    def dump_latency_profiles(tofile=sys.stderr):
+        print('{stage:20s} {count:8s} {mean:10s} {p50:10s} {p90:10s} {p99:10s} {max:10s}'.format(
+            stage='Stage',
+            count='Count',
+            mean='Mean(ms)',
+            p50='p50(ms)',
+            p90='p90(ms)',
+            p99='p99(ms)',
+            max='Max(ms)'), file=tofile)
+
+        for stage, counts, total, maxval in latency_histograms():
+            n = sum(counts)
+            if n == 0:
+                continue
+
+            print('{stage:20s} {count:8d} {mean:10.3f} {p50:10.3f} {p90:10.3f} {p99:10.3f} {max:10.3f}'.format(
+                stage=stage,
+                count=n,
+                mean=total * 1e3 / n,
+                p50=_percentile(counts, n, 0.5, maxval) * 1e3,
+                p90=_percentile(counts, n, 0.9, maxval) * 1e3,
+                p99=_percentile(counts, n, 0.99, maxval) * 1e3,
+                max=maxval * 1e3), file=tofile)
+
+        tofile.flush()
+
+
+# Sampling profiler. Rather than timing every call of decorated functions,
+# a background thread periodically samples the stack of a target thread
+# (by default the main thread) and counts collapsed stacks, in the format
+# used by flamegraph.pl. This covers all code, not just decorated functions.
+#
+# Enable at startup by setting MLAT_SAMPLE_PROFILE to the sampling interval
+# in milliseconds, or at runtime with start_sampling() / stop_sampling().
+# The server toggles sampling on SIGUSR1 only if MLAT_SAMPLE_PROFILE is set;
+# set it to 0 to allow toggling without sampling from startup.
+
+# maximum number of distinct stacks to track; further new stacks are
+# counted under a single placeholder entry.
+MAX_SAMPLED_STACKS = 20000
+
+# maximum stack depth to record
+MAX_SAMPLE_DEPTH = 100
+
+# the sampler backs off so that it holds the interpreter for no more than
+# this fraction of the time
+MAX_SAMPLE_OVERHEAD = 0.01
+
+sampling_configured = 'MLAT_SAMPLE_PROFILE' in os.environ
+_sampler = None
+_sampled_stacks = {}
+
+
+class _StackSampler(threading.Thread):
+    def __init__(self, target_ident, interval):
+        super().__init__(name='mlat-stack-sampler', daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.sample_time = 0.0
+        self._labels = {}
+
+    def _label(self, frame):
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '{module}.{name}'.format(module=frame.f_globals.get('__name__', '?'),
+                                                                  name=code.co_name)
+        return label
+
+    def run(self):
+        delay = self.interval
+        while not self.stopping.wait(delay):
+            start = time.perf_counter()
+
+            frame = sys._current_frames().get(self.target_ident)
+            if frame is None:
+                # target thread has gone away
+                return
+
+            stack = []
+            while frame is not None and len(stack) < MAX_SAMPLE_DEPTH:
+                stack.append(self._label(frame))
+                frame = frame.f_back
+            del frame
+
+            stack.reverse()
+            key = ';'.join(stack)
+            if key in _sampled_stacks:
+                _sampled_stacks[key] += 1
+            elif len(_sampled_stacks) < MAX_SAMPLED_STACKS:
+                _sampled_stacks[key] = 1
+            else:
+                _sampled_stacks['[too many stacks]'] = _sampled_stacks.get('[too many stacks]', 0) + 1
+
+            cost = time.perf_counter() - start
+            self.samples += 1
+            self.sample_time += cost
+            delay = max(self.interval, cost / MAX_SAMPLE_OVERHEAD)
+
+
+def sampling_enabled():
+    return _sampler is not None
+
+
+def start_sampling(interval=0.01, thread_ident=None, reset=True):
+    """Start sampling the stack of the given thread (default: the main thread)
+    every interval seconds. If reset is True, previously collected samples
+    are discarded."""
+
+    global _sampler
+
+    if _sampler is not None:
+        return
+
+    if reset:
+        _sampled_stacks.clear()
+
+    if thread_ident is None:
+        thread_ident = threading.main_thread().ident
+
+    _sampler = _StackSampler(thread_ident, interval)
+    _sampler.start()
+
+
+def stop_sampling():
+    """Stop sampling. Collected samples are kept until sampling is restarted."""
+
+    global _sampler
+
+    if _sampler is None:
+        return
+
+    _sampler.stopping.set()
+    _sampler.join()
+    print('Stack sampling stopped after {n} samples ({t:.3f}s spent sampling)'.format(
+        n=_sampler.samples,
+        t=_sampler.sample_time), file=sys.stderr)
+    _sampler = None
+
+
+def dump_sampled_stacks(tofile=sys.stderr):
+    """Write the collected samples as collapsed stacks, most frequent first."""
+
+    for stack, count in sorted(list(_sampled_stacks.items()), key=lambda x: x[1], reverse=True):
+        print('{stack} {count}'.format(stack=stack, count=count), file=tofile)
+
+    tofile.flush()
+
+
+if int(os.environ.get('MLAT_SAMPLE_PROFILE', '0')):
+    print('Stack sampling enabled', file=sys.stderr)
+    start_sampling(interval=int(os.environ['MLAT_SAMPLE_PROFILE']) / 1000.0)
@@ -0,0 +1,409 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Record-and-replay of the input events a coordinator receives.
+
+A capture file starts with MAGIC, followed by a sequence of records. Each
+record is a RECORD_HEADER (event type, seconds since the start of the
+capture, receiver index) followed by a type-specific payload. Receivers are
+numbered in the order they connect; indexes are not reused.
+
+Authentication data is never recorded.
+
+To replay a capture against a fresh coordinator:
+
+  python3 -m mlat.server.capture capture.bin [--speed N] [--real-time]
+
+Replay runs on a virtual clock (see timebase) by default, so the recorded
+timing is preserved, which MLAT_DELAY grouping and clock sync depend on,
+without waiting for it.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import time
+
+from mlat.server import util, timebase
+
+__all__ = ('CaptureRecorder', 'read_capture', 'replay')
+
+glogger = logging.getLogger("capture")
+
+MAGIC = b'MLATCAP1'
+RECORD_HEADER = struct.Struct('>BdI')
+
+# event types
+NEW_RECEIVER = 1       # payload: JSON (length-prefixed)
+SYNC = 2               # payload: even_time, odd_time, even_message, odd_message
+MLAT = 3               # payload: timestamp, utc, message (length-prefixed)
+TRACKING_ADD = 4       # payload: addresses (count-prefixed, 3 bytes each)
+TRACKING_REMOVE = 5    # payload: addresses (count-prefixed, 3 bytes each)
+RATE_REPORT = 6        # payload: JSON (length-prefixed)
+CLOCK_RESET = 7        # no payload
+LOCATION_UPDATE = 8    # payload: lat, lon, alt
+DISCONNECT = 9         # no payload
+
+SYNC_PAYLOAD = struct.Struct('>ddB14sB14s')
+MLAT_PAYLOAD = struct.Struct('>ddB')
+LLH_PAYLOAD = struct.Struct('>ddd')
+LENGTH = struct.Struct('>I')
+
+
+def _pack_json(obj):
+    body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    return LENGTH.pack(len(body)) + body
+
+
+def _pack_addresses(icao_set):
+    return LENGTH.pack(len(icao_set)) + b''.join(icao.to_bytes(3, 'big') for icao in icao_set)
+
+
+class CaptureRecorder(object):
+    """Records the input events received by a coordinator to a capture file.
+
+    This wraps the coordinator's receiver_* and new_receiver entry points, so
+    it sees exactly what the client connections pass to the coordinator."""
+
+    WRAPPED = ('new_receiver', 'receiver_sync', 'receiver_mlat', 'receiver_tracking_add',
+               'receiver_tracking_remove', 'receiver_rate_report', 'receiver_clock_reset',
+               'receiver_location_update', 'receiver_disconnect')
+
+    def __init__(self, coordinator, filename):
+        self.coordinator = coordinator
+        self.filename = filename
+        self.f = None
+        self.start_time = None
+        self.indexes = {}
+        self.next_index = 0
+        self.record_count = 0
+        self._originals = {}
+
+    def start(self):
+        if self.f is None:
+            self.f = open(self.filename, 'wb', buffering=1048576)
+            self.f.write(MAGIC)
+            self.start_time = timebase.monotonic()
+
+            for name in self.WRAPPED:
+                original = self._originals[name] = getattr(self.coordinator, name)
+                setattr(self.coordinator, name, getattr(self, '_' + name)(original))
+
+            glogger.info("Recording coordinator input to {0}".format(self.filename))
+
+        return util.completed_future
+
+    def close(self):
+        if self.f is None:
+            return
+
+        for name, original in self._originals.items():
+            setattr(self.coordinator, name, original)
+        self._originals.clear()
+
+        self.f.close()
+        self.f = None
+        glogger.info("Recorded {n} events to {f}".format(n=self.record_count, f=self.filename))
+
+    def wait_closed(self):
+        return util.completed_future
+
+    def _write(self, event, receiver, payload=b''):
+        index = self.indexes.get(receiver)
+        if index is None:
+            return  # connected before recording started
+
+        self.f.write(RECORD_HEADER.pack(event, timebase.monotonic() - self.start_time, index))
+        if payload:
+            self.f.write(payload)
+        self.record_count += 1
+
+    # wrapper factories, one per coordinator entry point
+
+    def _new_receiver(self, original):
+        def new_receiver(connection, uuid, user, auth, position_llh, clock_type, privacy, connection_info):
+            receiver = original(connection=connection, uuid=uuid, user=user, auth=auth,
+                                position_llh=position_llh, clock_type=clock_type,
+                                privacy=privacy, connection_info=connection_info)
+            self.indexes[receiver] = self.next_index
+            self.next_index += 1
+            self._write(NEW_RECEIVER, receiver, _pack_json({'uuid': uuid,
+                                                            'user': user,
+                                                            'position_llh': list(position_llh),
+                                                            'clock_type': clock_type,
+                                                            'privacy': privacy,
+                                                            'connection_info': connection_info}))
+            return receiver
+        return new_receiver
+
+    def _receiver_sync(self, original):
+        def receiver_sync(receiver, even_time, odd_time, even_message, odd_message):
+            self._write(SYNC, receiver, SYNC_PAYLOAD.pack(even_time, odd_time,
+                                                          len(even_message), even_message,
+                                                          len(odd_message), odd_message))
+            original(receiver, even_time, odd_time, even_message, odd_message)
+        return receiver_sync
+
+    def _receiver_mlat(self, original):
+        def receiver_mlat(receiver, timestamp, message, utc):
+            self._write(MLAT, receiver, MLAT_PAYLOAD.pack(timestamp, utc, len(message)) + message)
+            original(receiver, timestamp, message, utc)
+        return receiver_mlat
+
+    def _receiver_tracking_add(self, original):
+        def receiver_tracking_add(receiver, icao_set):
+            self._write(TRACKING_ADD, receiver, _pack_addresses(icao_set))
+            original(receiver, icao_set)
+        return receiver_tracking_add
+
+    def _receiver_tracking_remove(self, original):
+        def receiver_tracking_remove(receiver, icao_set):
+            self._write(TRACKING_REMOVE, receiver, _pack_addresses(icao_set))
+            original(receiver, icao_set)
+        return receiver_tracking_remove
+
+    def _receiver_rate_report(self, original):
+        def receiver_rate_report(receiver, report):
+            self._write(RATE_REPORT, receiver, _pack_json({'{0:06X}'.format(k): v for k, v in report.items()}))
+            original(receiver, report)
+        return receiver_rate_report
+
+    def _receiver_clock_reset(self, original):
+        def receiver_clock_reset(receiver):
+            self._write(CLOCK_RESET, receiver)
+            original(receiver)
+        return receiver_clock_reset
+
+    def _receiver_location_update(self, original):
+        def receiver_location_update(receiver, position_llh):
+            self._write(LOCATION_UPDATE, receiver, LLH_PAYLOAD.pack(*position_llh))
+            original(receiver, position_llh)
+        return receiver_location_update
+
+    def _receiver_disconnect(self, original):
+        def receiver_disconnect(receiver):
+            self._write(DISCONNECT, receiver)
+            self.indexes.pop(receiver, None)
+            original(receiver)
+        return receiver_disconnect
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError('Truncated capture file')
+    return data
+
+
+def _read_json(f):
+    length, = LENGTH.unpack(_read_exactly(f, LENGTH.size))
+    return json.loads(_read_exactly(f, length).decode('utf-8'))
+
+
+def _read_addresses(f):
+    count, = LENGTH.unpack(_read_exactly(f, LENGTH.size))
+    data = _read_exactly(f, count * 3)
+    return {int.from_bytes(data[i:i+3], 'big') for i in range(0, len(data), 3)}
+
+
+def read_capture(f):
+    """Generate (event, time, receiver index, args) tuples from a capture file object.
+    args is a tuple of the arguments for the event."""
+
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a capture file')
+
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != RECORD_HEADER.size:
+            raise EOFError('Truncated capture file')
+
+        event, t, index = RECORD_HEADER.unpack(header)
+        if event == SYNC:
+            even_time, odd_time, even_len, even_message, odd_len, odd_message = \
+                SYNC_PAYLOAD.unpack(_read_exactly(f, SYNC_PAYLOAD.size))
+            args = (even_time, odd_time, even_message[:even_len], odd_message[:odd_len])
+        elif event == MLAT:
+            timestamp, utc, length = MLAT_PAYLOAD.unpack(_read_exactly(f, MLAT_PAYLOAD.size))
+            args = (timestamp, _read_exactly(f, length), utc)
+        elif event == NEW_RECEIVER:
+            args = (_read_json(f),)
+        elif event == TRACKING_ADD or event == TRACKING_REMOVE:
+            args = (_read_addresses(f),)
+        elif event == RATE_REPORT:
+            args = ({int(k, 16): v for k, v in _read_json(f).items()},)
+        elif event == LOCATION_UPDATE:
+            args = (LLH_PAYLOAD.unpack(_read_exactly(f, LLH_PAYLOAD.size)),)
+        elif event == CLOCK_RESET or event == DISCONNECT:
+            args = ()
+        else:
+            raise ValueError('Unknown event type {0} in capture file'.format(event))
+
+        yield event, t, index, args
+
+
+class ReplayConnection(object):
+    """A connection (see connection.Connection) for replayed receivers, which
+    discards everything sent to it but counts the results."""
+
+    def __init__(self):
+        self.traffic_requests = 0
+        self.results = 0
+
+    def request_traffic(self, receiver, start_set, stop_set):
+        self.traffic_requests += 1
+
+    def report_mlat_position(self, receiver,
+                             receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
+                             dof, kalman_state, result_cache):
+        self.results += 1
+
+
+@asyncio.coroutine
+def replay(coordinator, f, speed=None):
+    """Feed the events in a capture file into a coordinator.
+
+    coordinator: the coordinator to feed
+    f: the capture file, opened in binary mode
+    speed: replay at this multiple of the recorded speed. If None, the
+      current event loop must be a timebase.VirtualTimeEventLoop, and the
+      recorded timing is used; this runs as fast as possible.
+
+    Raises ValueError if speed is None and the event loop uses the real
+    clock: without the recorded gaps between events, mlat message groups
+    and clock sync points would not expire as they did when recorded.
+
+    Returns the number of events replayed.
+    """
+
+    loop = asyncio.get_event_loop()
+    if speed is None:
+        if not isinstance(loop, timebase.VirtualTimeEventLoop):
+            raise ValueError('Replay needs a speed unless it runs on a virtual clock')
+        speed = 1.0
+
+    connection = ReplayConnection()
+    receivers = {}
+    count = 0
+    start = loop.time()
+
+    for event, t, index, args in read_capture(f):
+        delay = start + t / speed - loop.time()
+        if delay > 0:
+            yield from asyncio.sleep(delay)
+
+        count += 1
+
+        if event == NEW_RECEIVER:
+            info, = args
+            try:
+                receivers[index] = coordinator.new_receiver(connection=connection,
+                                                            uuid=info['uuid'],
+                                                            user=info['user'],
+                                                            auth=None,
+                                                            position_llh=tuple(info['position_llh']),
+                                                            clock_type=info['clock_type'],
+                                                            privacy=info['privacy'],
+                                                            connection_info=info['connection_info'])
+            except ValueError as e:
+                glogger.warning("Replayed receiver {0} rejected: {1}".format(info['uuid'], e))
+            continue
+
+        receiver = receivers.get(index)
+        if receiver is None:
+            continue
+
+        if event == SYNC:
+            coordinator.receiver_sync(receiver, *args)
+        elif event == MLAT:
+            coordinator.receiver_mlat(receiver, *args)
+        elif event == TRACKING_ADD:
+            coordinator.receiver_tracking_add(receiver, *args)
+        elif event == TRACKING_REMOVE:
+            coordinator.receiver_tracking_remove(receiver, *args)
+        elif event == RATE_REPORT:
+            coordinator.receiver_rate_report(receiver, *args)
+        elif event == CLOCK_RESET:
+            coordinator.receiver_clock_reset(receiver)
+        elif event == LOCATION_UPDATE:
+            coordinator.receiver_location_update(receiver, *args)
+        elif event == DISCONNECT:
+            coordinator.receiver_disconnect(receiver)
+            del receivers[index]
+
+    return count
+
+
+def main():
+    import argparse
+    import tempfile
+    from contextlib import closing
+    from mlat.server import coordinator as coordinator_module
+
+    parser = argparse.ArgumentParser(description="Replay a capture file into a coordinator.")
+    parser.add_argument('capture', help="the capture file to replay")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay at this multiple of the recorded speed (default: 1.0)")
+    parser.add_argument('--work-dir', default=None,
+                        help="directory for state files (default: a temporary directory)")
+    parser.add_argument('--real-time', action='store_true', default=False,
+                        help="run on the real clock, waiting between events, rather than on a virtual clock")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.real_time:
+        loop = asyncio.get_event_loop()
+    else:
+        loop = timebase.use_virtual_time()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='mlat-replay-')
+    coordinator = coordinator_module.Coordinator(work_dir=work_dir)
+
+    results = [0]
+
+    def count_result(*args):
+        results[0] += 1
+
+    coordinator.add_output_handler(count_result)
+    loop.run_until_complete(coordinator.start())
+
+    with closing(open(args.capture, 'rb', buffering=1048576)) as f:
+        start = time.monotonic()
+        count = loop.run_until_complete(replay(coordinator, f, speed=args.speed))
+        elapsed = time.monotonic() - start
+
+    # let pending groups resolve
+    loop.run_until_complete(asyncio.sleep(3.0))
+
+    coordinator.close()
+    loop.run_until_complete(coordinator.wait_closed())
+
+    print('Replayed {n} events in {t:.1f}s ({rate:.0f} events/s), {r} results'.format(
+        n=count,
+        t=elapsed,
+        rate=count / elapsed if elapsed > 0 else 0,
+        r=results[0]))
+
+
+if __name__ == '__main__':
+    main()
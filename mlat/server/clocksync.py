@@ -21,10 +21,11 @@ Maintains clock synchronization between individual pairs of receivers.
 """
 
 import math
-import time
 import bisect
 import logging
 
+from mlat.server import timebase
+
 __all__ = ('Clock', 'ClockPairing', 'make_clock')
 
 glogger = logging.getLogger("clocksync")
@@ -69,6 +70,11 @@ class ClockPairing(object):
     KP = 0.05
     KI = 0.01
 
+    __slots__ = ('base', 'peer', 'base_clock', 'peer_clock', 'raw_drift', 'drift', 'i_drift', 'n',
+                 'ts_base', 'ts_peer', 'var', 'var_sum', 'outliers', 'cumulative_error',
+                 'relative_freq', 'i_relative_freq', 'drift_max', 'drift_max_delta', 'outlier_threshold',
+                 'expiry', 'validity')
+
     def __init__(self, base, peer):
         self.base = base
         self.peer = peer
@@ -91,7 +97,7 @@ class ClockPairing(object):
         self.drift_max_delta = self.drift_max / 10.0
         self.outlier_threshold = 5 * math.sqrt(peer.clock.jitter ** 2 + base.clock.jitter ** 2)   # 5 sigma
 
-        now = time.monotonic()
+        now = timebase.monotonic()
         self.expiry = now + 120.0
         self.validity = now + 30.0
 
@@ -117,7 +123,7 @@ class ClockPairing(object):
     def valid(self):
         """True if this pairing is usable for clock syncronization."""
         return bool(self.n >= 2 and (self.var_sum / self.n) < 16e-12 and
-                    self.outliers == 0 and self.validity > time.monotonic())
+                    self.outliers == 0 and self.validity > timebase.monotonic())
 
     def update(self, address, base_ts, peer_ts, base_interval, peer_interval):
         """Update the relative drift and offset of this pairing given:
@@ -155,7 +161,7 @@ class ClockPairing(object):
         # update clock offset based on the actual clock values
         self._update_offset(address, base_ts, peer_ts, prediction_error)
 
-        now = time.monotonic()
+        now = timebase.monotonic()
         self.expiry = now + 120.0
         self.validity = now + 30.0
         return True
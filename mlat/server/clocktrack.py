@@ -23,15 +23,14 @@ DF17 position messages received by more than one receiver.
 
 __all__ = ('SyncPoint', 'ClockTracker')
 
-import asyncio
 import functools
-import time
+import heapq
 import logging
 
 import modes.message
 
 from mlat import geodesy, constants, profile
-from mlat.server import clocksync, config
+from mlat.server import clocksync, config, timebase
 
 
 class SyncPoint(object):
@@ -41,6 +40,8 @@ class SyncPoint(object):
     that pair.
     """
 
+    __slots__ = ('address', 'posA', 'posB', 'interval', 'receivers', 'synced', 'handle')
+
     def __init__(self, address, posA, posB, interval):
         """Construct a new sync point.
 
@@ -58,14 +59,28 @@ class SyncPoint(object):
         self.posA = posA
         self.posB = posB
         self.interval = interval
-        self.receivers = []  # a list of (receiver, timestampA, timestampB) values
+        self.receivers = []  # a list of (receiver, timestampA, timestampB) tuples
+        self.synced = 0      # bitmask: bit i is set if receivers[i] synced with another receiver here
+        self.handle = None   # the timer that will expire this sync point
 
 
 class ClockTracker(object):
     """Maintains clock pairings between receivers, and matches up incoming sync messages
     from receivers to update the parameters of the pairings."""
 
-    def __init__(self):
+    def __init__(self, max_sync_points=50000):
+        """max_sync_points: the maximum number of sync points to hold at once;
+        when this is reached, the sync points with the fewest receivers are
+        dropped to make room."""
+
+        self.max_sync_points = max_sync_points
+        self.sync_point_count = 0
+        self.evicted_count = 0
+
+        # load shedding, controlled by overload.OverloadController
+        self.skip_converged_sync = False
+        self.skipped_sync_count = 0
+
         # map of (sync key) -> list of sync points
         #
         # sync key is a pair of bytearrays: (msgA, msgB)
@@ -80,14 +95,14 @@ class ClockTracker(object):
         self.clock_pairs = {}
 
         # schedule periodic cleanup
-        asyncio.get_event_loop().call_later(1.0, self._cleanup)
+        timebase.call_later(1.0, self._cleanup)
 
     def _cleanup(self):
         """Called periodically to clean up clock pairings that have expired."""
 
-        asyncio.get_event_loop().call_later(30.0, self._cleanup)
+        timebase.call_later(30.0, self._cleanup)
 
-        now = time.monotonic()
+        now = timebase.monotonic()
         prune = set()
         for k, pairing in self.clock_pairs.items():
             if pairing.expiry <= now:
@@ -150,6 +165,8 @@ class ClockTracker(object):
         odd_time: the time of arrival of odd_message, as seen by receiver.clock
         """
 
+        receiver.sync_message_count += 1
+
         # Do sanity checks.
 
         # Messages must be within 5 seconds of each other.
@@ -238,21 +255,26 @@ class ClockTracker(object):
             logging.info("{a:06X}: intermessage range check failed".format(a=even_message.address))
             return
 
-        # valid. Create a new sync point.
+        # valid. Create a new sync point, making room for it if needed.
+        if self.sync_point_count >= self.max_sync_points:
+            self._evict_sync_points()
+            syncpointlist = self.sync_points.get(key)
+
         if even_time < odd_time:
             syncpoint = SyncPoint(even_message.address, even_ecef, odd_ecef, interval)
         else:
             syncpoint = SyncPoint(even_message.address, odd_ecef, even_ecef, interval)
 
-        syncpoint.receivers.append([receiver, tA, tB, False])
+        syncpoint.receivers.append((receiver, tA, tB))
         if not syncpointlist:
             syncpointlist = self.sync_points[key] = []
         syncpointlist.append(syncpoint)
+        self.sync_point_count += 1
 
         # schedule cleanup of the syncpoint after 2 seconds -
         # we should have seen all copies of those messages by
         # then.
-        asyncio.get_event_loop().call_later(
+        syncpoint.handle = timebase.call_later(
             2.0,
             functools.partial(self._cleanup_syncpoint,
                               key=key,
@@ -261,16 +283,15 @@ class ClockTracker(object):
     def _add_to_existing_syncpoint(self, syncpoint, r0, t0A, t0B):
         # add a new receiver and timestamps to an existing syncpoint
 
-        # new state for the syncpoint: receiver, timestamp A, timestamp B,
-        # and a flag indicating if this receiver actually managed to sync
-        # with another receiver using this syncpoint (used for stats)
-        r0l = [r0, t0A, t0B, False]
+        # the new receiver is responsible for the pairing work it causes
+        r0.sync_pair_count += len(syncpoint.receivers)
 
         # try to sync the new receiver with all receivers that previously
-        # saw the same pair
-        for r1l in syncpoint.receivers:
-            r1, t1A, t1B, r1sync = r1l
-
+        # saw the same pair. Note which receivers actually managed to sync
+        # with another receiver using this syncpoint (used for stats)
+        synced = syncpoint.synced
+        r0bit = 1 << len(syncpoint.receivers)
+        for i, (r1, t1A, t1B) in enumerate(syncpoint.receivers):
             if r1.dead:
                 # receiver went away before we started resolving this
                 continue
@@ -283,14 +304,15 @@ class ClockTracker(object):
             if r0 < r1:
                 if self._do_sync(syncpoint.address, syncpoint.posA, syncpoint.posB, r0, t0A, t0B, r1, t1A, t1B):
                     # sync worked, note it for stats
-                    r0l[3] = r1l[3] = True
+                    synced |= r0bit | (1 << i)
             else:
                 if self._do_sync(syncpoint.address, syncpoint.posA, syncpoint.posB, r1, t1A, t1B, r0, t0A, t0B):
                     # sync worked, note it for stats
-                    r0l[3] = r1l[3] = True
+                    synced |= r0bit | (1 << i)
 
         # update syncpoint with the new receiver and we're done
-        syncpoint.receivers.append(r0l)
+        syncpoint.synced = synced
+        syncpoint.receivers.append((r0, t0A, t0B))
 
     @profile.trackcpu
     def _cleanup_syncpoint(self, key, syncpoint):
@@ -301,16 +323,38 @@ class ClockTracker(object):
         syncpoint: the syncpoint itself
         """
 
+        self._remove_syncpoint(key, syncpoint)
+
+    def _remove_syncpoint(self, key, syncpoint):
         # remove syncpoint from self.sync_points, clean up empty entries
         l = self.sync_points[key]
         l.remove(syncpoint)
         if not l:
             del self.sync_points[key]
+        self.sync_point_count -= 1
 
         # stats update
-        for r, _, _, synced in syncpoint.receivers:
-            if synced:
+        synced = syncpoint.synced
+        for r, _, _ in syncpoint.receivers:
+            if synced & 1:
                 r.sync_count += 1
+            synced >>= 1
+
+    @profile.trackcpu
+    def _evict_sync_points(self):
+        """Drop the sync points with the fewest receivers (usually those seen
+        by only one receiver, which have not been useful yet) to make room
+        for new ones. A tenth of the sync points are dropped at a time, so
+        that the cost of finding them is spread over many insertions."""
+
+        count = max(1, self.sync_point_count // 10)
+        candidates = ((key, syncpoint) for key, l in self.sync_points.items() for syncpoint in l)
+        for key, syncpoint in heapq.nsmallest(count, candidates, key=lambda c: len(c[1].receivers)):
+            syncpoint.handle.cancel()
+            self._remove_syncpoint(key, syncpoint)
+
+        self.evicted_count += count
+        logging.info("Sync point limit reached, dropped {n} sync points".format(n=count))
 
     def _do_sync(self, address, posA, posB, r0, t0A, t0B, r1, t1A, t1B):
         # find or create clock pair
@@ -318,6 +362,13 @@ class ClockTracker(object):
         pairing = self.clock_pairs.get(k)
         if pairing is None:
             self.clock_pairs[k] = pairing = clocksync.ClockPairing(r0, r1)
+        elif self.skip_converged_sync and pairing.n >= 8 and pairing.valid:
+            # Under load, leave well-established pairings alone until they
+            # are halfway to expiring for lack of updates.
+            # Skipped updates are not syncs, so don't count them as such.
+            if (pairing.validity - timebase.monotonic()) > 15.0:
+                self.skipped_sync_count += 1
+                return False
 
         # propagation delays, in clock units
         delay0A = geodesy.ecef_distance(posA, r0.position) * r0.clock.freq / constants.Cair
@@ -335,19 +386,18 @@ class ClockTracker(object):
         # do the update
         return pairing.update(address, t0B - delay0B, t1B - delay1B, i0, i1)
 
-    def dump_receiver_state(self, receiver):
+    def dump_state(self):
+        """Return the state of all clock pairings, keyed by receiver UUID and then
+        peer UUID. Each value is [number of sync points, error (us), drift (ppm),
+        offset from receiver to peer (clock ticks)]. This makes a single pass
+        over all pairings, rather than one pass per receiver."""
+
         state = {}
         for (r0, r1), pairing in self.clock_pairs.items():
             if pairing.n < 2:
                 continue
-            if r0 is receiver:
-                state[r1.uuid] = [pairing.n,
-                                  round(pairing.error * 1e6, 1),
-                                  round(pairing.drift * 1e6, 2),
-                                  pairing.ts_peer[-1] - pairing.ts_base[-1]]
-            elif r1 is receiver:
-                state[r0.uuid] = [pairing.n,
-                                  round(pairing.error * 1e6, 1),
-                                  round(pairing.i_drift * 1e6, 2),
-                                  pairing.ts_base[-1] - pairing.ts_peer[-1]]
+            error = round(pairing.error * 1e6, 1)
+            offset = pairing.ts_peer[-1] - pairing.ts_base[-1]
+            state.setdefault(r0.uuid, {})[r1.uuid] = [pairing.n, error, round(pairing.drift * 1e6, 2), offset]
+            state.setdefault(r1.uuid, {})[r0.uuid] = [pairing.n, error, round(pairing.i_drift * 1e6, 2), -offset]
         return state
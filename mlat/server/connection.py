@@ -32,17 +32,19 @@ class Connection(object):
     this class as long as they provide methods with equivalent signatures.
     """
 
-    def request_traffic(self, receiver, icao_set):
-        """Request that a receiver starts sending traffic for exactly
-        the given set of aircraft only.
+    def request_traffic(self, receiver, start_set, stop_set):
+        """Request changes to the set of aircraft that a receiver sends
+        traffic for. Changes are relative to all previous requests.
 
         receiver: the handle of the concerned receiver
-        icao_set: a set of ICAO addresses (as ints) to send (_not_ copied, don't modify afterwards!)
+        start_set: a set of ICAO addresses (as ints) to start sending
+        stop_set: a set of ICAO addresses (as ints) to stop sending
         """
         raise NotImplementedError
 
     def report_mlat_position(self, receiver,
-                             receive_timestamp, address, ecef, ecef_cov, receivers, distinct):
+                             receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
+                             dof, kalman_state, result_cache):
         """Report a multilaterated position result.
 
         receiver: the handle of the concerned receiver
@@ -52,5 +54,9 @@ class Connection(object):
         ecef_cov: a 3x3 matrix giving the covariance matrix of ecef
         receivers: the set of receivers that contributed to the result
         distinct: the number of distinct receivers (<= len(receivers))
+        dof: the number of degrees of freedom in the solution
+        kalman_state: the Kalman filter state of the aircraft
+        result_cache: a dict shared by all connections that are reported this
+          result; implementations may use it to cache encoded forms of the result
         """
         raise NotImplementedError
@@ -23,13 +23,13 @@ the various sub-objects that make up the server.
 
 import signal
 import asyncio
-import json
+import collections
 import logging
-import time
 from contextlib import closing
 
 from mlat import geodesy, profile, constants
 from mlat.server import tracker, clocksync, clocktrack, mlattrack, util
+from mlat.server import outputbus, statefile, metrics, loopmonitor, overload, timebase, memory
 
 glogger = logging.getLogger("coordinator")
 
@@ -38,6 +38,16 @@ class Receiver(object):
     """Represents a particular connected receiver and the associated
     connection that manages it."""
 
+    # __dict__ is kept (it is only allocated if used) so that authenticators
+    # can attach their own attributes
+    __slots__ = ('uuid', 'user', 'connection', 'clock', 'position_llh', 'position', 'privacy', 'connection_info',
+                 'dead', 'sync_count', 'last_rate_report',
+                 'mlat_message_count', 'sync_message_count', 'bytes_received', 'sync_pair_count',
+                 'cluster_candidate_count', 'solver_count', 'ingest_time', 'resolve_time',
+                 'mlat_dropped_count', 'sync_dropped_count',
+                 'tracking', 'sync_interest', 'mlat_interest', 'requested', 'distance',
+                 '__dict__')
+
     def __init__(self, uuid, user, connection, clock, position_llh, privacy, connection_info):
         self.uuid = uuid
         self.user = user
@@ -51,6 +61,18 @@ class Receiver(object):
 
         self.sync_count = 0
         self.last_rate_report = None
+
+        # accounting of the work this receiver causes, see dump_accounting()
+        self.mlat_message_count = 0
+        self.sync_message_count = 0
+        self.bytes_received = 0
+        self.sync_pair_count = 0
+        self.cluster_candidate_count = 0
+        self.solver_count = 0
+        self.ingest_time = 0.0
+        self.resolve_time = 0.0
+        self.mlat_dropped_count = 0
+        self.sync_dropped_count = 0
         self.tracking = set()
         self.sync_interest = set()
         self.mlat_interest = set()
@@ -76,8 +98,41 @@ class Receiver(object):
 
     @profile.trackcpu
     def refresh_traffic_requests(self):
-        self.requested = {x for x in self.tracking if x.interesting}
-        self.connection.request_traffic(self, {x.icao for x in self.requested})
+        requested = {x for x in self.tracking if x.interesting}
+        start_sending = {x.icao for x in requested.difference(self.requested)}
+        stop_sending = {x.icao for x in self.requested.difference(requested)}
+        self.requested = requested
+
+        # an aircraft that was dropped from the tracker and then re-added
+        # appears in both sets; the receiver is already sending it, so
+        # leave it alone.
+        unchanged = start_sending.intersection(stop_sending)
+        if unchanged:
+            start_sending.difference_update(unchanged)
+            stop_sending.difference_update(unchanged)
+
+        if start_sending or stop_sending:
+            self.connection.request_traffic(self, start_sending, stop_sending)
+
+    @property
+    def cpu_time(self):
+        """Approximate CPU time attributable to this receiver: time spent parsing
+        its messages, plus its share of the time spent resolving message groups
+        it contributed to."""
+        return self.ingest_time + self.resolve_time
+
+    def dump_accounting(self):
+        return {'user': self.user,
+                'mlat_messages': self.mlat_message_count,
+                'sync_messages': self.sync_message_count,
+                'mlat_dropped': self.mlat_dropped_count,
+                'sync_dropped': self.sync_dropped_count,
+                'bytes': self.bytes_received,
+                'sync_pairs': self.sync_pair_count,
+                'cluster_candidates': self.cluster_candidate_count,
+                'solver': self.solver_count,
+                'ingest_time': round(self.ingest_time, 3),
+                'resolve_time': round(self.resolve_time, 3)}
 
     def __lt__(self, other):
         return self.uuid < other.uuid
@@ -96,43 +151,99 @@ class Coordinator(object):
     """Master coordinator. Receives all messages from receivers and dispatches
     them to clock sync / multilateration / tracking as needed."""
 
-    def __init__(self, work_dir, partition=(1, 1), tag="mlat", authenticator=None, pseudorange_filename=None):
+    # how many of the most expensive receivers to report in metrics
+    metrics_top_receivers = 20
+
+    def __init__(self, work_dir, partition=(1, 1), tag="mlat", authenticator=None, pseudorange_filename=None,
+                 output_queue_limit=1000, output_overflow='drop-oldest', skip_unchanged_state=False,
+                 slow_callback_threshold=None, max_pending_groups=50000, max_sync_points=50000,
+                 overload_control=False):
         """If authenticator is not None, it should be a callable that takes two arguments:
         the newly created Receiver, plus the 'auth' argument provided by the connection.
         The authenticator may modify the receiver if needed. The authenticator should either
         return silently on success, or raise an exception (propagated to the caller) on
         failure.
+
+        output_queue_limit and output_overflow control the per-handler queues of
+        the output bus, see outputbus.OutputBus.
+
+        If skip_unchanged_state is True, state files in work_dir are only rewritten
+        when their contents change.
+
+        If slow_callback_threshold is not None, event loop callbacks that run for
+        longer than this many seconds are recorded, see loopmonitor.LoopMonitor.
+
+        max_pending_groups and max_sync_points cap the number of mlat message
+        groups and clock sync points held at once.
+
+        If overload_control is True, load is shed in stages when the server
+        falls behind, see overload.OverloadController.
         """
 
         self.work_dir = work_dir
+        self.state_writer = statefile.StateFileWriter(work_dir, skip_unchanged=skip_unchanged_state)
         self.receivers = {}    # keyed by uuid
         self.sighup_handlers = []
         self.authenticator = authenticator
         self.partition = partition
         self.tag = tag
         self.tracker = tracker.Tracker(partition)
-        self.clock_tracker = clocktrack.ClockTracker()
+        self.clock_tracker = clocktrack.ClockTracker(max_sync_points=max_sync_points)
         self.mlat_tracker = mlattrack.MlatTracker(self,
                                                   blacklist_filename=work_dir + '/blacklist.txt',
-                                                  pseudorange_filename=pseudorange_filename)
-        self.output_handlers = [self.forward_results]
+                                                  pseudorange_filename=pseudorange_filename,
+                                                  max_pending=max_pending_groups)
+        self.output_bus = outputbus.OutputBus(limit=output_queue_limit, overflow=output_overflow)
+        # results forwarded to receivers are never dropped
+        self.output_bus.add_handler(self.forward_results, inline=True)
+        self.loop_monitor = loopmonitor.LoopMonitor(slow_threshold=slow_callback_threshold)
+        self.memory = memory.MemoryAccounting(self)
+
+        # state documents, written periodically to work_dir; the HTTP status
+        # listener serves the bodies last written by state_writer
+        self.state_documents = collections.OrderedDict([
+            ('aircraft.json', self.dump_aircraft_state),
+            ('sync.json', self.dump_sync_state),
+            ('locations.json', self.dump_locations),
+            ('outputs.json', self.output_bus.dump_state),
+            ('loop.json', self.loop_monitor.dump_state),
+            ('receivers.json', self.dump_receiver_accounting),
+            ('memory.json', self.memory.dump_state)
+        ])
+
+        if overload_control:
+            self.overload = overload.OverloadController(self)
+            self.state_documents['overload.json'] = self.overload.dump_state
+        else:
+            self.overload = None
+
+        self.metrics = metrics.Metrics()
+        self.metrics.add_source(self._collect_metrics)
+        self.metrics.add_source(self.loop_monitor.collect_metrics)
+        self.metrics.add_source(self.memory.collect_metrics)
+        if self.overload:
+            self.metrics.add_source(self.overload.collect_metrics)
 
         self.receiver_mlat = self.mlat_tracker.receiver_mlat
         self.receiver_sync = self.clock_tracker.receiver_sync
+        self._sampling_signal = False
 
     def start(self):
         self._write_state_task = asyncio.async(self.write_state())
-        if profile.enabled:
-            self._write_profile_task = asyncio.async(self.write_profile())
-        else:
-            self._write_profile_task = None
+        self._write_profile_task = asyncio.async(self.write_profile())
+        self.loop_monitor.start()
+        if self.overload:
+            self.overload.start()
+        if profile.sampling_configured:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, self.toggle_sampling)
+            self._sampling_signal = True
         return util.completed_future
 
     def add_output_handler(self, handler):
-        self.output_handlers.append(handler)
+        self.output_bus.add_handler(handler)
 
     def remove_output_handler(self, handler):
-        self.output_handlers.remove(handler)
+        self.output_bus.remove_handler(handler)
 
     # it's a pity that asyncio's add_signal_handler doesn't let you have
     # multiple handlers per signal. so wire up a multiple-handler here.
@@ -150,38 +261,30 @@ class Coordinator(object):
         for handler in self.sighup_handlers[:]:
             handler()
 
-    @profile.trackcpu
-    def _really_write_state(self):
-        aircraft_state = {}
+    def toggle_sampling(self):
+        """Start or stop the sampling profiler (bound to SIGUSR1 if
+        MLAT_SAMPLE_PROFILE is set)."""
+        if profile.sampling_enabled():
+            profile.stop_sampling()
+            self._write_sampled_stacks()
+            glogger.info("Stack sampling stopped")
+        else:
+            profile.start_sampling()
+            glogger.info("Stack sampling started")
+
+    def _interest_counts(self):
         mlat_count = 0
         sync_count = 0
-        now = time.time()
         for ac in self.tracker.aircraft.values():
-            s = aircraft_state['{0:06X}'.format(ac.icao)] = {}
-            s['interesting'] = 1 if ac.interesting else 0
-            s['allow_mlat'] = 1 if ac.allow_mlat else 0
-            s['tracking'] = len(ac.tracking)
-            s['sync_interest'] = len(ac.sync_interest)
-            s['mlat_interest'] = len(ac.mlat_interest)
-            s['mlat_message_count'] = ac.mlat_message_count
-            s['mlat_result_count'] = ac.mlat_result_count
-            s['mlat_kalman_count'] = ac.mlat_kalman_count
-
-            if ac.last_result_time is not None and ac.kalman.valid:
-                s['last_result'] = round(now - ac.last_result_time, 1)
-                lat, lon, alt = ac.kalman.position_llh
-                s['lat'] = round(lat, 3)
-                s['lon'] = round(lon, 3)
-                s['alt'] = round(alt * constants.MTOF, 0)
-                s['heading'] = round(ac.kalman.heading, 0)
-                s['speed'] = round(ac.kalman.ground_speed, 0)
-
             if ac.interesting:
                 if ac.sync_interest:
                     sync_count += 1
                 if ac.mlat_interest:
                     mlat_count += 1
+        return mlat_count, sync_count
 
+    def _update_proctitle(self):
+        mlat_count, sync_count = self._interest_counts()
         if self.partition[1] > 1:
             util.setproctitle('{tag} {i}/{n} ({r} clients) ({m} mlat {s} sync {t} tracked)'.format(
                 tag=self.tag,
@@ -199,13 +302,40 @@ class Coordinator(object):
                 s=sync_count,
                 t=len(self.tracker.aircraft)))
 
-        sync = {}
-        locations = {}
+    @profile.trackcpu
+    def dump_aircraft_state(self):
+        aircraft_state = {}
+        now = timebase.time()
+        for ac in self.tracker.aircraft.values():
+            s = aircraft_state['{0:06X}'.format(ac.icao)] = {}
+            s['interesting'] = 1 if ac.interesting else 0
+            s['allow_mlat'] = 1 if ac.allow_mlat else 0
+            s['tracking'] = len(ac.tracking)
+            s['sync_interest'] = len(ac.sync_interest)
+            s['mlat_interest'] = len(ac.mlat_interest)
+            s['mlat_message_count'] = ac.mlat_message_count
+            s['mlat_result_count'] = ac.mlat_result_count
+            s['mlat_kalman_count'] = ac.mlat_kalman_count
 
+            if ac.last_result_time is not None and ac.kalman.valid:
+                s['last_result'] = round(now - ac.last_result_time, 1)
+                lat, lon, alt = ac.kalman.position_llh
+                s['lat'] = round(lat, 3)
+                s['lon'] = round(lon, 3)
+                s['alt'] = round(alt * constants.MTOF, 0)
+                s['heading'] = round(ac.kalman.heading, 0)
+                s['speed'] = round(ac.kalman.ground_speed, 0)
+
+        return aircraft_state
+
+    @profile.trackcpu
+    def dump_sync_state(self):
+        peers = self.clock_tracker.dump_state()
+        return {r.uuid: {'peers': peers.get(r.uuid, {})} for r in self.receivers.values()}
+
+    def dump_locations(self):
+        locations = {}
         for r in self.receivers.values():
-            sync[r.uuid] = {
-                'peers': self.clock_tracker.dump_receiver_state(r)
-            }
             locations[r.uuid] = {
                 'user': r.user,
                 'lat': r.position_llh[0],
@@ -214,21 +344,104 @@ class Coordinator(object):
                 'privacy': r.privacy,
                 'connection': r.connection_info
             }
-
-        with closing(open(self.work_dir + '/sync.json', 'w')) as f:
-            json.dump(sync, fp=f, indent=True)
-
-        with closing(open(self.work_dir + '/locations.json', 'w')) as f:
-            json.dump(locations, fp=f, indent=True)
-
-        with closing(open(self.work_dir + '/aircraft.json', 'w')) as f:
-            json.dump(aircraft_state, fp=f, indent=True)
+        return locations
+
+    def top_receivers(self, n=None):
+        """Return receivers ordered by decreasing CPU time attributed to them,
+        limited to the first n if n is not None."""
+        ordered = sorted(self.receivers.values(), key=lambda r: r.cpu_time, reverse=True)
+        return ordered if n is None else ordered[:n]
+
+    def dump_receiver_accounting(self):
+        # a list rather than a dict, to preserve the ordering
+        return [dict(r.dump_accounting(), uuid=r.uuid) for r in self.top_receivers()]
+
+    def _snapshot_state(self):
+        """Build a snapshot of the state files to write. This runs on the event loop,
+        so it only collects data; serialization is left to the state writer."""
+
+        self._update_proctitle()
+        return {name: dump() for name, dump in self.state_documents.items()}
+
+    def _collect_metrics(self):
+        mlat_count, sync_count = self._interest_counts()
+        yield metrics.gauge('receivers', 'Connected receivers', len(self.receivers))
+        yield metrics.gauge('aircraft_tracked', 'Aircraft being tracked', len(self.tracker.aircraft))
+        yield metrics.gauge('aircraft_sync', 'Interesting aircraft used for clock sync', sync_count)
+        yield metrics.gauge('aircraft_mlat', 'Interesting aircraft being multilaterated', mlat_count)
+        yield metrics.gauge('clock_pairs', 'Receiver clock pairings', len(self.clock_tracker.clock_pairs))
+        yield metrics.gauge('sync_points', 'Pending clock sync points', self.clock_tracker.sync_point_count)
+        yield metrics.gauge('sync_points_limit', 'Maximum pending clock sync points',
+                            self.clock_tracker.max_sync_points)
+        yield metrics.counter('sync_points_evicted_total', 'Clock sync points dropped because of the limit',
+                              self.clock_tracker.evicted_count)
+        yield metrics.gauge('mlat_pending_groups', 'Pending multilateration message groups',
+                            len(self.mlat_tracker.pending))
+        yield metrics.gauge('mlat_pending_groups_limit', 'Maximum pending multilateration message groups',
+                            self.mlat_tracker.max_pending)
+        yield metrics.counter('mlat_pending_evicted_total',
+                              'Multilateration message groups dropped because of the limit',
+                              self.mlat_tracker.evicted_count)
+
+        yield metrics.counter('kalman_skipped_total', 'Kalman filter updates skipped to shed load',
+                              self.mlat_tracker.skipped_kalman_count)
+        yield metrics.counter('mlat_groups_rejected_total', 'New mlat message groups rejected to shed load',
+                              self.mlat_tracker.rejected_group_count)
+        yield metrics.counter('sync_skipped_total', 'Clock sync updates of converged pairs skipped to shed load',
+                              self.clock_tracker.skipped_sync_count)
+
+        queued = metrics.Metric('output_queued', 'gauge', 'Results queued for each output handler', [])
+        handled = metrics.Metric('output_handled_total', 'counter', 'Results passed to each output handler', [])
+        dropped = metrics.Metric('output_dropped_total', 'counter', 'Results dropped for each output handler', [])
+        for i, state in enumerate(self.output_bus.dump_state()):
+            labels = {'handler': state['handler'], 'index': i}
+            queued.samples.append(('', labels, state['queued']))
+            handled.samples.append(('', labels, state['handled']))
+            dropped.samples.append(('', labels, state['dropped']))
+        yield queued
+        yield handled
+        yield dropped
+
+        receiver_metrics = [
+            ('receiver_cpu_seconds_total', 'CPU time attributed to each receiver', lambda r: r.cpu_time),
+            ('receiver_mlat_messages_total', 'Mlat messages from each receiver', lambda r: r.mlat_message_count),
+            ('receiver_sync_messages_total', 'Sync messages from each receiver', lambda r: r.sync_message_count),
+            ('receiver_mlat_dropped_total', 'Mlat messages dropped by rate limits for each receiver',
+             lambda r: r.mlat_dropped_count),
+            ('receiver_sync_dropped_total', 'Sync messages dropped by rate limits for each receiver',
+             lambda r: r.sync_dropped_count),
+            ('receiver_bytes_total', 'Bytes received from each receiver', lambda r: r.bytes_received),
+            ('receiver_sync_pairs_total', 'Sync pairings attempted for each receiver', lambda r: r.sync_pair_count),
+            ('receiver_cluster_candidates_total', 'Timestamps from each receiver considered for clustering',
+             lambda r: r.cluster_candidate_count),
+            ('receiver_solver_total', 'Solver runs that included each receiver', lambda r: r.solver_count)
+        ]
+        top = self.top_receivers(self.metrics_top_receivers)
+        for name, help, get in receiver_metrics:
+            yield metrics.Metric(name, 'counter', help + ' (most expensive receivers only)',
+                                 [('', {'receiver': r.uuid}, get(r)) for r in top])
+
+        histograms = profile.latency_histograms()
+        if histograms:
+            latency = metrics.Metric('latency_seconds', 'histogram', 'Multilateration pipeline latency by stage', [])
+            for stage, counts, total, maxval in histograms:
+                cumulative = 0
+                for bound, count in zip(profile.LATENCY_BUCKETS, counts):
+                    cumulative += count
+                    latency.samples.append(('_bucket', {'stage': stage, 'le': bound}, cumulative))
+                cumulative += counts[-1]
+                latency.samples.append(('_bucket', {'stage': stage, 'le': '+Inf'}, cumulative))
+                latency.samples.append(('_sum', {'stage': stage}, total))
+                latency.samples.append(('_count', {'stage': stage}, cumulative))
+            yield latency
 
     @asyncio.coroutine
     def write_state(self):
+        loop = asyncio.get_event_loop()
         while True:
             try:
-                self._really_write_state()
+                snapshot = self._snapshot_state()
+                yield from loop.run_in_executor(None, self.state_writer.write, snapshot)
             except Exception:
                 glogger.exception("Failed to write state files")
 
@@ -239,20 +452,49 @@ class Coordinator(object):
         while True:
             yield from asyncio.sleep(60.0)
 
-            try:
-                with closing(open(self.work_dir + '/cpuprofile.txt', 'w')) as f:
-                    profile.dump_cpu_profiles(f)
-            except Exception:
-                glogger.exception("Failed to write CPU profile")
+            if profile.enabled:
+                try:
+                    with closing(open(self.work_dir + '/cpuprofile.txt', 'w')) as f:
+                        profile.dump_cpu_profiles(f)
+                except Exception:
+                    glogger.exception("Failed to write CPU profile")
+
+            if profile.latency_enabled:
+                try:
+                    with closing(open(self.work_dir + '/latencyprofile.txt', 'w')) as f:
+                        profile.dump_latency_profiles(f)
+                except Exception:
+                    glogger.exception("Failed to write latency profile")
+
+            if profile.sampling_enabled():
+                self._write_sampled_stacks()
+
+    def _write_sampled_stacks(self):
+        try:
+            with closing(open(self.work_dir + '/cpustacks.txt', 'w')) as f:
+                profile.dump_sampled_stacks(f)
+        except Exception:
+            glogger.exception("Failed to write sampled stacks")
 
     def close(self):
         self._write_state_task.cancel()
-        if self._write_profile_task:
-            self._write_profile_task.cancel()
+        self._write_profile_task.cancel()
+        self.tracker.close()
+        self.loop_monitor.close()
+        if self.overload:
+            self.overload.close()
+        if self._sampling_signal:
+            asyncio.get_event_loop().remove_signal_handler(signal.SIGUSR1)
+            self._sampling_signal = False
+        self.output_bus.close()
 
     @asyncio.coroutine
     def wait_closed(self):
-        util.safe_wait([self._write_state_task, self._write_profile_task])
+        yield from util.safe_wait([self._write_state_task, self._write_profile_task])
+        yield from self.loop_monitor.wait_closed()
+        if self.overload:
+            yield from self.overload.wait_closed()
+        yield from self.output_bus.wait_closed()
 
     @profile.trackcpu
     def new_receiver(self, connection, uuid, user, auth, position_llh, clock_type, privacy, connection_info):
@@ -344,12 +586,15 @@ class Coordinator(object):
         if ac:
             ac.successful_mlat.update(receivers)
             broadcast = ac.successful_mlat
+
+        # shared by all connections so each result format is encoded only once
+        result_cache = {}
         for receiver in broadcast:
             try:
                 receiver.connection.report_mlat_position(receiver,
                                                          receive_timestamp, address,
                                                          ecef, ecef_cov, receivers, distinct,
-                                                         dof, kalman_state)
+                                                         dof, kalman_state, result_cache)
             except Exception:
                 glogger.exception("Failed to forward result to receiver {r}".format(r=receiver.uuid))
                 # eat the exception so it doesn't break our caller
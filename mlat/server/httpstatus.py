@@ -0,0 +1,270 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A small HTTP listener that serves server state and metrics from memory.
+"""
+
+import asyncio
+import functools
+import hashlib
+import logging
+import socket
+import time
+
+from mlat.server import net, util, metrics
+
+__all__ = ('StatusCache', 'StatusClient', 'DocumentUnavailable', 'make_status_listener')
+
+glogger = logging.getLogger("httpstatus")
+
+REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+def _serialize_metrics(collected):
+    return metrics.format_prometheus(collected).encode('utf-8')
+
+
+class DocumentUnavailable(Exception):
+    """A known document that has not been built yet."""
+    pass
+
+
+class StatusCache(object):
+    """Finds or builds the serialized documents served by the status listener.
+
+    The JSON state documents are served exactly as last serialized by the
+    coordinator's state file writer, with their digests as ETags, so they
+    are not collected or encoded a second time. They are as fresh as the
+    state files in the work directory.
+
+    /metrics is not a state file. It is rebuilt at most once every max_age
+    seconds, no matter how many clients ask for it; it is collected on the
+    event loop, but serialized in the default executor."""
+
+    def __init__(self, coordinator, max_age=5.0):
+        self.max_age = max_age
+        self.state_writer = coordinator.state_writer
+
+        # path -> (content type, state file name, or None for a built document)
+        self.documents = {'/' + name: ('application/json', name) for name in coordinator.state_documents}
+        self.documents['/metrics'] = ('text/plain; version=0.0.4', None)
+        self._collect_metrics = coordinator.metrics.collect
+
+        self._cache = {}     # path -> (expiry, body, etag)
+        self._building = {}  # path -> future for the cache entry being built
+
+    @asyncio.coroutine
+    def get(self, path):
+        """Return (content type, body, etag) for a path, or None if there is no such document.
+        Raises DocumentUnavailable if the document has not been built yet."""
+
+        document = self.documents.get(path)
+        if document is None:
+            return None
+
+        content_type, name = document
+        if name is not None:
+            body, etag = self._get_state(name)
+        else:
+            body, etag = yield from self._get_built(path, self._collect_metrics, _serialize_metrics)
+        return content_type, body, etag
+
+    def _get_state(self, name):
+        # bodies is updated from the state writer's worker thread; each
+        # entry is replaced whole, so the (body, digest) pair is consistent
+        entry = self.state_writer.bodies.get(name)
+        if entry is None:
+            raise DocumentUnavailable(name)
+
+        body, digest = entry
+        return body, '"' + digest + '"'
+
+    @asyncio.coroutine
+    def _get_built(self, path, collect, serialize):
+        entry = self._cache.get(path)
+        if entry is None or entry[0] < time.monotonic():
+            building = self._building.get(path)
+            if building is None:
+                building = self._building[path] = asyncio.async(self._build(path, collect, serialize))
+            # shielded so that one client going away doesn't cancel the
+            # build for everyone else waiting on it
+            entry = yield from asyncio.shield(building)
+
+        return entry[1], entry[2]
+
+    @asyncio.coroutine
+    def _build(self, path, collect, serialize):
+        try:
+            state = collect()
+            body = yield from asyncio.get_event_loop().run_in_executor(None, serialize, state)
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            entry = self._cache[path] = (time.monotonic() + self.max_age, body, etag)
+            return entry
+        finally:
+            del self._building[path]
+
+
+class StatusClient(object):
+    """Handles a single HTTP connection to the status listener.
+
+    Only GET and HEAD are supported; persistent connections are allowed."""
+
+    def __init__(self, reader, writer, *, cache, idle_timeout=60.0):
+        peer = writer.get_extra_info('peername')
+        self.logger = util.TaggingLogger(glogger,
+                                         {'tag': '{host}:{port}'.format(host=peer[0],
+                                                                        port=peer[1])})
+        self.reader = reader
+        self.writer = writer
+        self.cache = cache
+        self.idle_timeout = idle_timeout
+        self.task = asyncio.async(self.handle_requests())
+
+    def close(self):
+        if not self.writer:
+            return  # already closed
+
+        self.task.cancel()
+        self.writer.close()
+        self.writer = None
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        yield from util.safe_wait([self.task])
+
+    @asyncio.coroutine
+    def handle_requests(self):
+        try:
+            while True:
+                try:
+                    request_line = yield from asyncio.wait_for(self.reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    return
+
+                if not request_line:
+                    return  # EOF
+
+                headers = {}
+                while True:
+                    line = yield from asyncio.wait_for(self.reader.readline(), self.idle_timeout)
+                    if not line or line in (b'\r\n', b'\n'):
+                        break
+                    name, sep, value = line.decode('iso-8859-1').partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('iso-8859-1').split()
+                if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+                    self.send_response(400, keep_alive=False)
+                    return
+
+                method, target, version = parts
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.0':
+                    keep_alive = (connection == 'keep-alive')
+                else:
+                    keep_alive = (connection != 'close')
+
+                yield from self.handle_request(method, target.partition('?')[0], headers, keep_alive)
+                yield from self.writer.drain()
+
+                if not keep_alive:
+                    return
+
+        except (socket.error, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+
+        except Exception:
+            self.logger.exception("Exception handling status request")
+
+        finally:
+            self.close()
+
+    @asyncio.coroutine
+    def handle_request(self, method, path, headers, keep_alive):
+        if method not in ('GET', 'HEAD'):
+            self.send_response(405, keep_alive=keep_alive, extra_headers=[('Allow', 'GET, HEAD')])
+            return
+
+        if path == '/':
+            index = '\n'.join(sorted(self.cache.documents.keys())) + '\n'
+            self.send_response(200, 'text/plain', index.encode('ascii'), keep_alive=keep_alive,
+                               head_only=(method == 'HEAD'))
+            return
+
+        try:
+            result = yield from self.cache.get(path)
+        except asyncio.CancelledError:
+            raise
+        except DocumentUnavailable:
+            self.send_response(503, keep_alive=keep_alive)
+            return
+        except Exception:
+            self.logger.exception("Failed to build {path}".format(path=path))
+            self.send_response(500, keep_alive=keep_alive)
+            return
+
+        if result is None:
+            self.send_response(404, keep_alive=keep_alive)
+            return
+
+        content_type, body, etag = result
+        if headers.get('if-none-match') == etag:
+            self.send_response(304, keep_alive=keep_alive, extra_headers=[('ETag', etag)])
+            return
+
+        self.send_response(200, content_type, body, keep_alive=keep_alive,
+                           extra_headers=[('ETag', etag), ('Cache-Control', 'no-cache')],
+                           head_only=(method == 'HEAD'))
+
+    def send_response(self, status, content_type=None, body=b'', keep_alive=True, extra_headers=(),
+                      head_only=False):
+        if self.writer is None:
+            return
+
+        lines = ['HTTP/1.1 {status} {reason}'.format(status=status, reason=REASONS[status])]
+        if content_type:
+            lines.append('Content-Type: ' + content_type)
+        if status != 304:
+            lines.append('Content-Length: {0}'.format(len(body)))
+        for name, value in extra_headers:
+            lines.append(name + ': ' + value)
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        lines.append('')
+        lines.append('')
+
+        self.writer.write('\r\n'.join(lines).encode('iso-8859-1'))
+        if body and not head_only and status != 304:
+            self.writer.write(body)
+
+
+def make_status_listener(host, port, coordinator, max_age=5.0):
+    cache = StatusCache(coordinator, max_age=max_age)
+    factory = functools.partial(StatusClient, cache=cache)
+    return net.MonitoringListener(host, port, factory,
+                                  logger=glogger,
+                                  description='HTTP status listener')
@@ -31,20 +31,170 @@ import socket
 import inspect
 import sys
 import math
+import base64
+import binascii
 
 from mlat import constants, geodesy
-from mlat.server import net, util, connection, config
+from mlat.server import net, util, connection, config, metrics, timebase
 
 
 glogger = logging.getLogger("client")
 
 
+def pack_icao_set(icao_set):
+    """Encode a set of ICAO addresses in the packed form used by
+    start_sending_packed / stop_sending_packed / seen_packed / lost_packed.
+
+    The addresses are sorted and the differences between successive
+    addresses (the first is relative to zero) are written as big-endian
+    16-bit words. A difference below 0x8000 takes one word; larger
+    differences take two words, the first with the top bit set and
+    carrying the high bits. The result is base64-encoded so it can be
+    carried in a JSON string."""
+
+    words = []
+    last = 0
+    for icao in sorted(icao_set):
+        delta = icao - last
+        last = icao
+        if delta < 0x8000:
+            words.append(delta)
+        else:
+            words.append(0x8000 | (delta >> 16))
+            words.append(delta & 0xffff)
+
+    return base64.b64encode(struct.pack('>{0}H'.format(len(words)), *words)).decode('ascii')
+
+
+def unpack_icao_set(packed):
+    """Decode a packed set of ICAO addresses, see pack_icao_set.
+    Raises ValueError if the packed data is malformed."""
+
+    if not isinstance(packed, str):
+        raise ValueError('Packed ICAO set is not a string')
+
+    try:
+        data = base64.b64decode(packed.encode('ascii'), validate=True)
+    except (UnicodeEncodeError, binascii.Error):
+        raise ValueError('Packed ICAO set is not valid base64')
+
+    if len(data) % 2:
+        raise ValueError('Packed ICAO set has odd length')
+
+    result = set()
+    icao = 0
+    high = None
+    for word in struct.unpack('>{0}H'.format(len(data) // 2), data):
+        if high is not None:
+            icao += high | word
+            high = None
+            result.add(icao)
+        elif word & 0x8000:
+            high = (word & 0x7fff) << 16
+        else:
+            icao += word
+            result.add(icao)
+
+    if high is not None:
+        raise ValueError('Truncated packed ICAO set')
+    if icao > 0xffffff:
+        raise ValueError('Address out of range in packed ICAO set')
+
+    return result
+
+
+class RateLimited(Exception):
+    def __init__(self, message, reconnect_in):
+        super().__init__(message)
+        self.reconnect_in = reconnect_in
+
+
+class IngestLimits(object):
+    """Per-receiver limits on incoming mlat and sync messages, shared by all
+    clients of a listener.
+
+    Each client gets its own token buckets. A client that keeps exceeding
+    its limits for more than disconnect_after seconds is disconnected and
+    refused for a back-off period, which doubles for repeat offenders."""
+
+    # drops less than this many seconds apart count as one continuous period
+    # of exceeding the limits
+    streak_gap = 10.0
+
+    # forget about past offences after this many seconds
+    offence_memory = 86400.0
+
+    def __init__(self, mlat_rate=None, mlat_burst=None, sync_rate=None, sync_burst=None,
+                 disconnect_after=300.0, backoff=900.0, max_backoff=14400.0):
+        """mlat_rate, sync_rate: allowed average messages per second, or None for no limit
+        mlat_burst, sync_burst: allowed burst size, defaults to 10 seconds' worth of messages
+        disconnect_after: disconnect clients that exceed their limits for this many seconds,
+          or None to never disconnect
+        backoff: how long to refuse reconnections after a disconnect, in seconds
+        max_backoff: the upper limit on the back-off for repeat offenders
+        """
+
+        self.mlat_rate = mlat_rate
+        self.mlat_burst = mlat_burst if mlat_burst is not None else (mlat_rate * 10 if mlat_rate else None)
+        self.sync_rate = sync_rate
+        self.sync_burst = sync_burst if sync_burst is not None else (sync_rate * 10 if sync_rate else None)
+        self.disconnect_after = disconnect_after
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.offenders = {}  # user -> (reconnect allowed at, last backoff)
+        self.mlat_dropped = 0
+        self.sync_dropped = 0
+        self.disconnects = 0
+
+    @property
+    def enabled(self):
+        return self.mlat_rate is not None or self.sync_rate is not None
+
+    def penalize(self, user):
+        """Record that a user was disconnected for exceeding their limits.
+        Returns the back-off period in seconds."""
+
+        now = timebase.monotonic()
+        for u, (until, last) in list(self.offenders.items()):
+            if now - until > self.offence_memory:
+                del self.offenders[u]
+
+        previous = self.offenders.get(user)
+        backoff = self.backoff if previous is None else min(self.max_backoff, previous[1] * 2)
+        self.offenders[user] = (now + backoff, backoff)
+        self.disconnects += 1
+        return backoff
+
+    def penalty_remaining(self, user):
+        """Return the number of seconds until a user may reconnect, or None."""
+
+        offence = self.offenders.get(user)
+        if offence is None:
+            return None
+
+        remaining = offence[0] - timebase.monotonic()
+        return remaining if remaining > 0 else None
+
+    def collect_metrics(self):
+        yield metrics.counter('ingest_dropped_total', 'Messages dropped by ingest rate limits',
+                              self.mlat_dropped, {'type': 'mlat'})
+        yield metrics.counter('ingest_dropped_total', 'Messages dropped by ingest rate limits',
+                              self.sync_dropped, {'type': 'sync'})
+        yield metrics.counter('ingest_disconnects_total', 'Clients disconnected for exceeding ingest rate limits',
+                              self.disconnects)
+        now = timebase.monotonic()
+        yield metrics.gauge('ingest_penalized', 'Users currently refused for exceeding ingest rate limits',
+                            sum(1 for until, backoff in self.offenders.values() if until > now))
+
+
 class JsonClientListener(net.MonitoringListener):
-    def __init__(self, host, tcp_port, udp_port, motd, coordinator):
+    def __init__(self, host, tcp_port, udp_port, motd, coordinator, limits=None):
         super().__init__(host, tcp_port, None, logger=glogger, description='JSON client handler')
         self.coordinator = coordinator
         self.udp_port = udp_port
         self.motd = motd
+        self.limits = limits if limits is not None and limits.enabled else None
 
         self.udp_transport = None
         self.udp_protocol = None
@@ -73,7 +223,8 @@ class JsonClientListener(net.MonitoringListener):
                           motd=self.motd,
                           udp_protocol=self.udp_protocol,
                           udp_host=self.host,
-                          udp_port=self.udp_port)
+                          udp_port=self.udp_port,
+                          limits=self.limits)
 
     def _close(self):
         super()._close()
@@ -101,11 +252,11 @@ class PackedMlatServerProtocol(asyncio.DatagramProtocol):
         self._r = random.SystemRandom()
         self.listen_address = None
 
-    def add_client(self, sync_handler, mlat_handler):
+    def add_client(self, sync_handler, mlat_handler, receiver):
         newkey = self._r.getrandbits(32)
         while newkey in self.clients:
             newkey = self._r.getrandbits(32)
-        self.clients[newkey] = (sync_handler, mlat_handler)
+        self.clients[newkey] = (sync_handler, mlat_handler, receiver)
         return newkey
 
     def remove_client(self, key):
@@ -117,11 +268,14 @@ class PackedMlatServerProtocol(asyncio.DatagramProtocol):
     def datagram_received(self, data, addr):
         try:
             key, seq, base = self.STRUCT_HEADER.unpack_from(data, 0)
-            sync_handler, mlat_handler = self.clients[key]  # KeyError on bad client key
-            utc = time.time()
+            sync_handler, mlat_handler, receiver = self.clients[key]  # KeyError on bad client key
+            utc = timebase.time()
+            start = time.perf_counter()
 
             i = self.STRUCT_HEADER.size
-            while i < len(data):
+            # the handlers may disconnect the client (e.g. for exceeding rate
+            # limits), in which case the rest of the datagram is discarded
+            while i < len(data) and key in self.clients:
                 typebyte = data[i]
                 i += 1
 
@@ -153,6 +307,9 @@ class PackedMlatServerProtocol(asyncio.DatagramProtocol):
                     glogger.warn("bad UDP packet from {host}:{port}".format(host=addr[0],
                                                                             port=addr[1]))
                     break
+
+            receiver.bytes_received += len(data)
+            receiver.ingest_time += time.perf_counter() - start
         except struct.error:
             pass
         except KeyError:
@@ -163,11 +320,12 @@ class JsonClient(connection.Connection):
     write_heartbeat_interval = 30.0
     read_heartbeat_interval = 150.0
 
-    def __init__(self, reader, writer, *, coordinator, motd, udp_protocol, udp_host, udp_port):
+    def __init__(self, reader, writer, *, coordinator, motd, udp_protocol, udp_host, udp_port, limits=None):
         self.r = reader
         self.w = writer
         self.coordinator = coordinator
         self.motd = motd
+        self.limits = limits
 
         self.transport = writer.transport
         self.host, self.port = self.transport.get_extra_info('peername')
@@ -188,17 +346,22 @@ class JsonClient(connection.Connection):
 
         self._udp_key = None
         self._compression_methods = (
-            ('zlib2', self.handle_zlib_messages, self.write_zlib),
-            ('zlib', self.handle_zlib_messages, self.write_raw),
-            ('none', self.handle_line_messages, self.write_raw)
+            ('zlib2', self.handle_zlib_messages, self.write_zlib, self.write_zlib_line),
+            ('zlib', self.handle_zlib_messages, self.write_raw, self.write_raw_line),
+            ('none', self.handle_line_messages, self.write_raw, self.write_raw_line)
         )
         self._last_message_time = None
         self._compressor = None
         self._pending_flush = None
         self._writebuf = []
 
-        self._requested_traffic = set()
-        self._wanted_traffic = set()
+        # traffic request changes not yet sent to the client
+        self._pending_start_sending = set()
+        self._pending_stop_sending = set()
+
+        # rate limiting state, see IngestLimits
+        self._limited_since = None
+        self._last_limited = None
 
         # start!
         self._read_task = asyncio.async(self.handle_connection())
@@ -209,6 +372,7 @@ class JsonClient(connection.Connection):
 
         self.logger.info('Disconnected')
         self.send = self.write_discard  # suppress all output from hereon in
+        self.send_line = self.write_line_discard
 
         if self._udp_key is not None:
             self.udp_protocol.remove_client(self._udp_key)
@@ -251,13 +415,13 @@ class JsonClient(connection.Connection):
 
             # if we have seen no activity recently, declare the
             # connection dead and close it down
-            if (time.monotonic() - self._last_message_time) > self.read_heartbeat_interval:
+            if (timebase.monotonic() - self._last_message_time) > self.read_heartbeat_interval:
                 self.logger.warn("No recent messages seen, closing connection")
                 self.close()
                 return
 
             # write a heartbeat message
-            self.send(heartbeat={'server_time': round(time.time(), 3)})
+            self.send(heartbeat={'server_time': round(timebase.time(), 3)})
 
     @asyncio.coroutine
     def handle_connection(self):
@@ -279,7 +443,7 @@ class JsonClient(connection.Connection):
                 return
 
             # start heartbeat handling now that the handshake is done
-            self._last_message_time = time.monotonic()
+            self._last_message_time = timebase.monotonic()
             self._heartbeat_task = asyncio.async(self.handle_heartbeats())
 
             yield from self.handle_messages()
@@ -298,6 +462,7 @@ class JsonClient(connection.Connection):
 
     def process_handshake(self, line):
         deny = None
+        reconnect_in = util.fuzzy(900)
 
         try:
             hs = json.loads(line.decode('ascii'))
@@ -310,13 +475,19 @@ class JsonClient(connection.Connection):
 
                 user = str(hs['user'])
 
+                if self.limits is not None:
+                    remaining = self.limits.penalty_remaining(user)
+                    if remaining is not None:
+                        raise RateLimited('Too many messages sent recently, try again later', util.fuzzy(remaining))
+
                 peer_compression_methods = set(hs['compress'])
                 self.compress = None
-                for c, readmeth, writemeth in self._compression_methods:
+                for c, readmeth, writemeth, linemeth in self._compression_methods:
                     if c in peer_compression_methods:
                         self.compress = c
                         self.handle_messages = readmeth
                         self.send = writemeth
+                        self.send_line = linemeth
                         break
                 if self.compress is None:
                     raise ValueError('No mutually usable compression type')
@@ -350,6 +521,7 @@ class JsonClient(connection.Connection):
                     self.report_mlat_position = self.report_mlat_position_discard
 
                 self.use_udp = (self.udp_protocol is not None and hs.get('udp_transport', 0) == 2)
+                self.use_packed_traffic = (hs.get('packed_traffic', 0) == 1)
 
                 conn_info = 'v{v} {clock_type} {cversion} {udp} {compress}'.format(
                     v=hs['version'],
@@ -372,6 +544,13 @@ class JsonClient(connection.Connection):
                 else:
                     self.process_mlat = self.process_mlat_nongps
 
+                if self.limits is not None:
+                    self._setup_limits()
+
+            except RateLimited as e:
+                deny = str(e)
+                reconnect_in = e.reconnect_in
+
             except KeyError as e:
                 deny = 'Missing field in handshake: ' + str(e)
 
@@ -380,7 +559,7 @@ class JsonClient(connection.Connection):
 
         if deny:
             self.logger.info('Handshake failed: %s', deny)
-            self.write_raw(deny=[deny], reconnect_in=util.fuzzy(900))
+            self.write_raw(deny=[deny], reconnect_in=reconnect_in)
             return False
 
         expanded_motd = """
@@ -402,9 +581,13 @@ class JsonClient(connection.Connection):
                     "rate_reports": True,
                     "motd": expanded_motd}
 
+        if self.use_packed_traffic:
+            response['packed_traffic'] = 1
+
         if self.use_udp:
             self._udp_key = self.udp_protocol.add_client(sync_handler=self.process_sync,
-                                                         mlat_handler=self.process_mlat)
+                                                         mlat_handler=self.process_mlat,
+                                                         receiver=self.receiver)
             response['udp_transport'] = (self.udp_host,
                                          self.udp_port,
                                          self._udp_key)
@@ -421,10 +604,18 @@ class JsonClient(connection.Connection):
         #logging.info("%s <<  %s", self.receiver.user, line)
         self.w.write((line + '\n').encode('ascii'))
 
+    def write_raw_line(self, line):
+        # line is already JSON-encoded and newline-terminated
+        self.w.write(line.encode('ascii'))
+
     def write_zlib(self, **kwargs):
         line = json.dumps(kwargs)
         #logging.info("%s <<Z %s", self.receiver.user, line)
-        self._writebuf.append(line + '\n')
+        self.write_zlib_line(line + '\n')
+
+    def write_zlib_line(self, line):
+        # line is already JSON-encoded and newline-terminated
+        self._writebuf.append(line)
         if self._pending_flush is None:
             self._pending_flush = asyncio.get_event_loop().call_soon(self._flush_zlib)
 
@@ -433,6 +624,9 @@ class JsonClient(connection.Connection):
         #logging.info("%s <<D %s", self.receiver.user, line)
         pass
 
+    def write_line_discard(self, line):
+        pass
+
     def _flush_zlib(self):
         self._pending_flush = None
 
@@ -474,8 +668,11 @@ class JsonClient(connection.Connection):
             line = yield from self.r.readline()
             if not line:
                 return
-            self._last_message_time = time.monotonic()
+            self._last_message_time = timebase.monotonic()
+            start = time.perf_counter()
             self.process_message(line.decode('ascii'))
+            self.receiver.bytes_received += len(line)
+            self.receiver.ingest_time += time.perf_counter() - start
 
     @asyncio.coroutine
     def handle_zlib_messages(self):
@@ -488,7 +685,9 @@ class JsonClient(connection.Connection):
             packet = (yield from self.r.readexactly(hlen))
             packet += b'\x00\x00\xff\xff'
 
-            self._last_message_time = time.monotonic()
+            self._last_message_time = timebase.monotonic()
+            start = time.perf_counter()
+            self.receiver.bytes_received += hlen + 2
 
             linebuf = ''
             decompression_done = False
@@ -506,6 +705,8 @@ class JsonClient(connection.Connection):
                 linebuf += decompressed.decode('ascii')
                 lines = linebuf.split('\n')
                 for line in lines[:-1]:
+                    if self.transport is None:
+                        return  # closed while processing this packet
                     self.process_message(line)
 
                 linebuf = lines[-1]
@@ -514,7 +715,11 @@ class JsonClient(connection.Connection):
 
                 if packet:
                     # try to mitigate DoS attacks that send highly compressible data
+                    self.receiver.ingest_time += time.perf_counter() - start
                     yield from asyncio.sleep(0.1)
+                    start = time.perf_counter()
+
+            self.receiver.ingest_time += time.perf_counter() - start
 
             if decompressor.unused_data:
                 raise ValueError('Client sent a packet that had trailing uncompressed data')
@@ -533,11 +738,15 @@ class JsonClient(connection.Connection):
                               bytes.fromhex(sync['om']))
         elif 'mlat' in msg:
             mlat = msg['mlat']
-            self.process_mlat(float(mlat['t']), bytes.fromhex(mlat['m']), time.time())
+            self.process_mlat(float(mlat['t']), bytes.fromhex(mlat['m']), timebase.time())
         elif 'seen' in msg:
             self.process_seen_message(msg['seen'])
         elif 'lost' in msg:
             self.process_lost_message(msg['lost'])
+        elif 'seen_packed' in msg:
+            self.process_seen_packed_message(msg['seen_packed'])
+        elif 'lost_packed' in msg:
+            self.process_lost_packed_message(msg['lost_packed'])
         elif 'input_connected' in msg:
             self.process_input_connected_message(msg['input_connected'])
         elif 'input_disconnected' in msg:
@@ -556,6 +765,60 @@ class JsonClient(connection.Connection):
     def process_sync(self, et, ot, em, om):
         self.coordinator.receiver_sync(self.receiver, et, ot, em, om)
 
+    def _setup_limits(self):
+        # Replace the sync/mlat entry points (used by both the TCP and UDP
+        # paths) with rate-limited versions, so there is no cost when
+        # limits are not configured.
+        if self.limits.mlat_rate is not None:
+            self._mlat_bucket = util.TokenBucket(self.limits.mlat_rate, self.limits.mlat_burst)
+            self._process_mlat_unlimited = self.process_mlat
+            self.process_mlat = self.process_mlat_limited
+
+        if self.limits.sync_rate is not None:
+            self._sync_bucket = util.TokenBucket(self.limits.sync_rate, self.limits.sync_burst)
+            self._process_sync_unlimited = self.process_sync
+            self.process_sync = self.process_sync_limited
+
+    def process_mlat_limited(self, t, m, now):
+        if self._mlat_bucket.take():
+            self._process_mlat_unlimited(t, m, now)
+        else:
+            self.receiver.mlat_dropped_count += 1
+            self.limits.mlat_dropped += 1
+            self._rate_limited()
+
+    def process_sync_limited(self, et, ot, em, om):
+        if self._sync_bucket.take():
+            self._process_sync_unlimited(et, ot, em, om)
+        else:
+            self.receiver.sync_dropped_count += 1
+            self.limits.sync_dropped += 1
+            self._rate_limited()
+
+    def _rate_limited(self):
+        if self.transport is None:
+            return  # already disconnected
+
+        now = timebase.monotonic()
+        if self._last_limited is None or (now - self._last_limited) > self.limits.streak_gap:
+            self._limited_since = now
+            self.logger.info("Exceeding ingest rate limits, dropping messages")
+        self._last_limited = now
+
+        if self.limits.disconnect_after is not None and (now - self._limited_since) > self.limits.disconnect_after:
+            backoff = self.limits.penalize(self.receiver.user)
+            self.soft_disconnect('Too many messages sent, disconnecting', util.fuzzy(backoff))
+
+    def soft_disconnect(self, reason, reconnect_in):
+        """Tell the client why it is being disconnected and when to reconnect, then close the connection."""
+
+        self.logger.warn("{reason} (reconnect in {n:.0f}s)".format(reason=reason, n=reconnect_in))
+        self.send(disconnect=reason, reconnect_in=reconnect_in)
+        if self._pending_flush is not None:
+            self._pending_flush.cancel()
+            self._flush_zlib()
+        self.close()
+
     def process_mlat_gps(self, t, m, now):
         # extract UTC receive time from Radarcape timestamps
         start_of_day = now - math.fmod(now, 86400)
@@ -595,6 +858,12 @@ class JsonClient(connection.Connection):
         lost = {int(icao, 16) for icao in lost}
         self.coordinator.receiver_tracking_remove(self.receiver, lost)
 
+    def process_seen_packed_message(self, seen):
+        self.coordinator.receiver_tracking_add(self.receiver, unpack_icao_set(seen))
+
+    def process_lost_packed_message(self, lost):
+        self.coordinator.receiver_tracking_remove(self.receiver, unpack_icao_set(lost))
+
     def process_input_connected_message(self, m):
         self.coordinator.receiver_clock_reset(self.receiver)
 
@@ -633,77 +902,108 @@ class JsonClient(connection.Connection):
 
     # Connection interface
 
-    # For traffic management, we update the local set and schedule a task to write it out in a little while.
-    def request_traffic(self, receiver, icao_set):
+    # For traffic management, we merge the changes into the pending changes
+    # and schedule a task to write them out in a little while.
+    def request_traffic(self, receiver, start_set, stop_set):
         assert receiver is self.receiver
 
-        self._wanted_traffic = icao_set
+        # a change that reverses a pending, unsent, change just cancels it
+        for icao in start_set:
+            if icao in self._pending_stop_sending:
+                self._pending_stop_sending.remove(icao)
+            else:
+                self._pending_start_sending.add(icao)
+
+        for icao in stop_set:
+            if icao in self._pending_start_sending:
+                self._pending_start_sending.remove(icao)
+            else:
+                self._pending_stop_sending.add(icao)
+
         if self._pending_traffic_update is None:
             self._pending_traffic_update = asyncio.get_event_loop().call_soon(self.send_traffic_updates)
 
     def send_traffic_updates(self):
         self._pending_traffic_update = None
 
-        start_sending = self._wanted_traffic.difference(self._requested_traffic)
-        if start_sending:
-            self.send(start_sending=['{0:06x}'.format(i) for i in start_sending])
-
-        stop_sending = self._requested_traffic.difference(self._wanted_traffic)
-        if stop_sending:
-            self.send(stop_sending=['{0:06x}'.format(i) for i in stop_sending])
-
-        self._requested_traffic = set(self._wanted_traffic)
+        if self._pending_start_sending:
+            if self.use_packed_traffic:
+                self.send(start_sending_packed=pack_icao_set(self._pending_start_sending))
+            else:
+                self.send(start_sending=['{0:06x}'.format(i) for i in self._pending_start_sending])
+            self._pending_start_sending = set()
 
-    # one of these is assigned to report_mlat_position:
+        if self._pending_stop_sending:
+            if self.use_packed_traffic:
+                self.send(stop_sending_packed=pack_icao_set(self._pending_stop_sending))
+            else:
+                self.send(stop_sending=['{0:06x}'.format(i) for i in self._pending_stop_sending])
+            self._pending_stop_sending = set()
+
+    # one of these is assigned to report_mlat_position.
+    #
+    # result_cache is shared between all connections that are sent the same
+    # result, and maps a result format to the encoded line for that format,
+    # so each format is only encoded once per result.
     def report_mlat_position_discard(self, receiver,
                                      receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
-                                     dof, kalman_state):
+                                     dof, kalman_state, result_cache):
         # client is not interested
         pass
 
     def report_mlat_position_old(self, receiver,
                                  receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
-                                 dof, kalman_state):
+                                 dof, kalman_state, result_cache):
         # old client, use the old format (somewhat incomplete)
-        lat, lon, alt = geodesy.ecef2llh(ecef)
-        ac = self.coordinator.tracker.aircraft[address]
-        callsign = ac.callsign
-        squawk = ac.squawk
-
-        self.send(result={'@': round(receive_timestamp, 3),
-                          'addr': '{0:06x}'.format(address),
-                          'lat': round(lat, 4),
-                          'lon': round(lon, 4),
-                          'alt': round(alt * constants.MTOF, 0),
-                          'callsign': callsign,
-                          'squawk': squawk,
-                          'hdop': 0.0,
-                          'vdop': 0.0,
-                          'tdop': 0.0,
-                          'gdop': 0.0,
-                          'nstations': len(receivers)})
+        line = result_cache.get('old')
+        if line is None:
+            lat, lon, alt = geodesy.ecef2llh(ecef)
+            # the aircraft may have gone away since the result was produced
+            ac = self.coordinator.tracker.aircraft.get(address)
+            callsign = ac.callsign if ac else None
+            squawk = ac.squawk if ac else None
+
+            line = result_cache['old'] = json.dumps({'result': {
+                '@': round(receive_timestamp, 3),
+                'addr': '{0:06x}'.format(address),
+                'lat': round(lat, 4),
+                'lon': round(lon, 4),
+                'alt': round(alt * constants.MTOF, 0),
+                'callsign': callsign,
+                'squawk': squawk,
+                'hdop': 0.0,
+                'vdop': 0.0,
+                'tdop': 0.0,
+                'gdop': 0.0,
+                'nstations': len(receivers)}}) + '\n'
+
+        self.send_line(line)
 
     def report_mlat_position_ecef(self, receiver,
                                   receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
-                                  dof, kalman_state):
+                                  dof, kalman_state, result_cache):
         # newer client
-        result = {'@': round(receive_timestamp, 3),
-                  'addr': '{0:06x}'.format(address),
-                  'ecef': (round(ecef[0], 0),
-                           round(ecef[1], 0),
-                           round(ecef[2], 0)),
-                  'n': len(receivers),
-                  'nd': distinct}
-        if ecef_cov is not None:
-            result['cov'] = (round(ecef_cov[0, 0], 0),
-                             round(ecef_cov[0, 1], 0),
-                             round(ecef_cov[0, 2], 0),
-                             round(ecef_cov[1, 1], 0),
-                             round(ecef_cov[1, 2], 0),
-                             round(ecef_cov[2, 2], 0))
-        else:
-            # work around a client bug in 0.1.7 which will
-            # disconnect if the 'cov' key is missing
-            result['cov'] = None
+        line = result_cache.get('ecef')
+        if line is None:
+            result = {'@': round(receive_timestamp, 3),
+                      'addr': '{0:06x}'.format(address),
+                      'ecef': (round(ecef[0], 0),
+                               round(ecef[1], 0),
+                               round(ecef[2], 0)),
+                      'n': len(receivers),
+                      'nd': distinct}
+            if ecef_cov is not None:
+                result['cov'] = (round(ecef_cov[0, 0], 0),
+                                 round(ecef_cov[0, 1], 0),
+                                 round(ecef_cov[0, 2], 0),
+                                 round(ecef_cov[1, 1], 0),
+                                 round(ecef_cov[1, 2], 0),
+                                 round(ecef_cov[2, 2], 0))
+            else:
+                # work around a client bug in 0.1.7 which will
+                # disconnect if the 'cov' key is missing
+                result['cov'] = None
+
+            line = result_cache['ecef'] = json.dumps({'result': result}) + '\n'
 
-        self.send(result=result)
+        self.send_line(line)
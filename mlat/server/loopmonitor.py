@@ -0,0 +1,213 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Monitors event loop responsiveness: how late a periodic probe runs, and
+which callbacks block the loop for too long.
+"""
+
+import asyncio
+import collections
+import functools
+import logging
+import time
+
+from mlat.server import util, metrics
+
+__all__ = ('LoopMonitor',)
+
+glogger = logging.getLogger("loopmonitor")
+
+
+def _callback_name(callback):
+    """Return a readable name for an event loop callback."""
+
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        # a task step; report the coroutine that the task is running
+        coro = getattr(owner, '_coro', None)
+        return 'task:' + getattr(coro, '__qualname__', repr(coro))
+
+    return getattr(callback, '__qualname__', repr(callback))
+
+
+class LoopMonitor(object):
+    """Measures event loop scheduling lag, and optionally records slow callbacks.
+
+    Lag is measured by a probe that sleeps for probe_interval and notes how
+    late it wakes up. If slow_threshold is not None, every callback run by
+    the loop is timed, and any that run for longer than slow_threshold
+    seconds are recorded by name."""
+
+    def __init__(self, probe_interval=0.25, history=240, slow_threshold=None, log_interval=10.0):
+        """probe_interval: how often to probe the loop, in seconds
+        history: number of recent probe results to compute percentiles from
+        slow_threshold: report callbacks that run for longer than this many seconds,
+          or None to disable callback timing
+        log_interval: log slow callbacks at most this often, in seconds
+        """
+
+        self.probe_interval = probe_interval
+        self.slow_threshold = slow_threshold
+        self.log_interval = log_interval
+
+        self.lags = collections.deque(maxlen=history)
+        self.probe_count = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+        self.slow_callbacks = {}   # name -> [count, total time, max time]
+        self.slow_count = 0
+        self._last_log = 0.0
+        self._unlogged = 0
+
+        self._probe_task = None
+        self._original_run = None
+
+    def start(self):
+        if self._probe_task is None:
+            self._probe_task = asyncio.async(self.probe())
+            if self.slow_threshold is not None:
+                self._install()
+
+        return util.completed_future
+
+    def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+        self._uninstall()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        if self._probe_task is not None:
+            yield from util.safe_wait([self._probe_task])
+
+    @asyncio.coroutine
+    def probe(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.probe_interval
+            yield from asyncio.sleep(self.probe_interval)
+            lag = max(0.0, loop.time() - expected)
+
+            self.lags.append(lag)
+            self.probe_count += 1
+            self.total_lag += lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def _install(self):
+        # asyncio has no hook for timing callbacks outside of debug mode,
+        # so wrap Handle._run. This covers both plain callbacks and task steps.
+        original = self._original_run = asyncio.events.Handle._run
+        threshold = self.slow_threshold
+        monitor = self
+
+        def _timed_run(handle):
+            start = time.perf_counter()
+            try:
+                return original(handle)
+            finally:
+                elapsed = time.perf_counter() - start
+                if elapsed >= threshold:
+                    monitor._record_slow(handle._callback, elapsed)
+
+        self._timed_run = _timed_run
+        asyncio.events.Handle._run = _timed_run
+
+    def _uninstall(self):
+        if self._original_run is not None:
+            if asyncio.events.Handle._run is self._timed_run:
+                asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def _record_slow(self, callback, elapsed):
+        name = _callback_name(callback)
+        entry = self.slow_callbacks.get(name)
+        if entry is None:
+            entry = self.slow_callbacks[name] = [0, 0.0, 0.0]
+
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+        self.slow_count += 1
+
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval:
+            glogger.warning("Slow callback {name} took {ms:.0f}ms{more}".format(
+                name=name,
+                ms=elapsed * 1e3,
+                more=' ({n} more since last report)'.format(n=self._unlogged) if self._unlogged else ''))
+            self._last_log = now
+            self._unlogged = 0
+        else:
+            self._unlogged += 1
+
+    def recent_lag(self, count=8):
+        """Return the largest lag seen by the last few probes."""
+        if not self.lags:
+            return 0.0
+        return max(self.lags[i] for i in range(-min(count, len(self.lags)), 0))
+
+    def lag_percentiles(self, fractions=(0.5, 0.9, 0.99)):
+        """Return a list of (fraction, lag) for recent probe results."""
+
+        if not self.lags:
+            return [(f, None) for f in fractions]
+
+        ordered = sorted(self.lags)
+        last = len(ordered) - 1
+        return [(f, ordered[min(last, int(f * len(ordered)))]) for f in fractions]
+
+    def dump_state(self):
+        state = {
+            'probe_interval': self.probe_interval,
+            'probes': self.probe_count,
+            'max_lag': round(self.max_lag, 4),
+            'lag': {str(f): (None if lag is None else round(lag, 4)) for f, lag in self.lag_percentiles()},
+        }
+
+        if self.slow_threshold is not None:
+            state['slow_threshold'] = self.slow_threshold
+            state['slow_callbacks'] = {name: {'count': count,
+                                              'total': round(total, 3),
+                                              'max': round(maxval, 3)}
+                                       for name, (count, total, maxval) in self.slow_callbacks.items()}
+
+        return state
+
+    def collect_metrics(self):
+        lag = metrics.Metric('loop_lag_seconds', 'summary', 'Event loop scheduling lag of a periodic probe', [])
+        for f, value in self.lag_percentiles():
+            lag.samples.append(('', {'quantile': f}, value))
+        lag.samples.append(('_sum', None, self.total_lag))
+        lag.samples.append(('_count', None, self.probe_count))
+        yield lag
+
+        yield metrics.gauge('loop_lag_max_seconds', 'Largest event loop lag seen', self.max_lag)
+
+        if self.slow_threshold is not None:
+            slow = metrics.Metric('slow_callbacks_total', 'counter',
+                                  'Event loop callbacks that ran longer than the slow threshold', [])
+            for name, (count, total, maxval) in self.slow_callbacks.items():
+                slow.samples.append(('', {'callback': name}, count))
+            yield slow
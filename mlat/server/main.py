@@ -25,7 +25,7 @@ import logging
 import signal
 import argparse
 
-from mlat.server import jsonclient, output, coordinator, leakcheck
+from mlat.server import jsonclient, output, coordinator, leakcheck, outputbus, httpstatus, capture
 
 
 def hostport(s):
@@ -98,6 +98,30 @@ class MlatServer(object):
                             type=host_and_ports,
                             action='append',
                             default=[])
+        parser.add_argument('--mlat-rate-limit',
+                            help="maximum average mlat messages per second accepted from each receiver.",
+                            type=float,
+                            default=None)
+        parser.add_argument('--mlat-burst-limit',
+                            help="maximum burst of mlat messages accepted from each receiver (default: 10s worth).",
+                            type=float,
+                            default=None)
+        parser.add_argument('--sync-rate-limit',
+                            help="maximum average sync messages per second accepted from each receiver.",
+                            type=float,
+                            default=None)
+        parser.add_argument('--sync-burst-limit',
+                            help="maximum burst of sync messages accepted from each receiver (default: 10s worth).",
+                            type=float,
+                            default=None)
+        parser.add_argument('--rate-limit-disconnect',
+                            help="disconnect receivers that exceed their rate limits for this many seconds.",
+                            type=float,
+                            default=300.0)
+        parser.add_argument('--rate-limit-backoff',
+                            help="how long disconnected receivers must wait before reconnecting, in seconds.",
+                            type=float,
+                            default=900.0)
         parser.add_argument('--motd',
                             type=str,
                             help="set the server MOTD sent to clients.",
@@ -108,6 +132,22 @@ class MlatServer(object):
                             help="write results in CSV format to a local file.",
                             action='append',
                             default=[])
+        parser.add_argument('--csv-rotate-size',
+                            help="rotate CSV files when they reach this size, in megabytes.",
+                            type=float,
+                            default=None)
+        parser.add_argument('--csv-rotate-interval',
+                            help="rotate CSV files after this many seconds.",
+                            type=float,
+                            default=None)
+        parser.add_argument('--csv-compress',
+                            help="compress rotated CSV files (zstd requires the zstandard module).",
+                            choices=('gzip', 'zstd'),
+                            default=None)
+        parser.add_argument('--csv-fsync-interval',
+                            help="fsync CSV files at most this often, in seconds.",
+                            type=float,
+                            default=None)
 
         parser.add_argument('--basestation-connect',
                             help="connect to a host:port and send Basestation-format results.",
@@ -130,17 +170,73 @@ class MlatServer(object):
                             action='append',
                             type=port_or_hostport,
                             default=[])
+        parser.add_argument('--output-queue-limit',
+                            help="maximum number of results to queue for each output handler.",
+                            type=int,
+                            default=1000)
+        parser.add_argument('--output-overflow',
+                            help="what to do with new results when an output handler's queue is full (results forwarded to receivers are never dropped).",  # noqa
+                            choices=outputbus.OVERFLOW_POLICIES,
+                            default='drop-oldest')
+
+        parser.add_argument('--basestation-queue-limit',
+                            help="maximum number of Basestation-format lines to queue for a slow client before dropping the oldest.",  # noqa
+                            type=int,
+                            default=10000)
 
     def add_util_args(self, parser):
         parser.add_argument('--work-dir',
                             help="directory for debug/stats output and blacklist",
                             required=True)
+        parser.add_argument('--skip-unchanged-state',
+                            help="only rewrite state files in the work directory when their contents change.",
+                            action='store_true',
+                            default=False)
 
-        parser.add_argument('--check-leaks',
-                            help="run periodic memory leak checks (requires objgraph package).",
+        parser.add_argument('--status-listen',
+                            help="listen on a [host:]port and serve status and metrics over HTTP.",
+                            action='append',
+                            type=port_or_hostport,
+                            default=[])
+        parser.add_argument('--status-max-age',
+                            help="rebuild the HTTP metrics document at most this often, in seconds. State "
+                            "documents are served as last written to the work directory.",
+                            type=float,
+                            default=5.0)
+
+        parser.add_argument('--slow-callback-threshold',
+                            help="record event loop callbacks that run for longer than this, in seconds.",
+                            type=float,
+                            default=None)
+
+        parser.add_argument('--max-pending-groups',
+                            help="maximum number of mlat message groups to hold while waiting for copies.",
+                            type=int,
+                            default=50000)
+        parser.add_argument('--max-sync-points',
+                            help="maximum number of clock sync points to hold while waiting for copies.",
+                            type=int,
+                            default=50000)
+
+        parser.add_argument('--overload-control',
+                            help="shed load in stages when the event loop falls behind or queues fill up.",
                             action='store_true',
                             default=False)
 
+        parser.add_argument('--record',
+                            help="record all client input to a capture file, for replay with mlat.server.capture.",
+                            default=None)
+
+        parser.add_argument('--check-leaks',
+                            help="run periodic memory leak checks. 'objgraph' (the default, requires the objgraph "
+                            "package) periodically counts all objects by type; 'tracemalloc' traces allocations "
+                            "and reports growth by allocation site; each check pauses the server only while the "
+                            "allocation snapshot is copied.",
+                            nargs='?',
+                            choices=('objgraph', 'tracemalloc'),
+                            const='objgraph',
+                            default=None)
+
         parser.add_argument('--dump-pseudorange',
                             help="dump pseudorange data in json format to a file")
 
@@ -171,54 +267,86 @@ class MlatServer(object):
     def make_client_subtasks(self, args):
         subtasks = []
 
+        limits = jsonclient.IngestLimits(mlat_rate=args.mlat_rate_limit,
+                                         mlat_burst=args.mlat_burst_limit,
+                                         sync_rate=args.sync_rate_limit,
+                                         sync_burst=args.sync_burst_limit,
+                                         disconnect_after=args.rate_limit_disconnect,
+                                         backoff=args.rate_limit_backoff)
+        if limits.enabled:
+            self.coordinator.metrics.add_source(limits.collect_metrics)
+
         for host, tcp_port, udp_port in args.client_listen:
             subtasks.append(jsonclient.JsonClientListener(host=host,
                                                           tcp_port=tcp_port,
                                                           udp_port=udp_port,
                                                           coordinator=self.coordinator,
-                                                          motd=args.motd))
+                                                          motd=args.motd,
+                                                          limits=limits))
 
         return subtasks
 
     def make_output_subtasks(self, args):
         subtasks = []
 
+        # each feed formats results once and shares them between all its clients
+        raw_feed = output.BasestationFeed(coordinator=self.coordinator,
+                                          use_kalman_data=False,
+                                          queue_limit=args.basestation_queue_limit)
+        filtered_feed = output.BasestationFeed(coordinator=self.coordinator,
+                                               use_kalman_data=True,
+                                               queue_limit=args.basestation_queue_limit)
+
         for host, port in args.basestation_connect:
             subtasks.append(output.make_basestation_connector(host=host,
                                                               port=port,
-                                                              coordinator=self.coordinator,
-                                                              use_kalman_data=False))
+                                                              feed=raw_feed))
 
         for host, port in args.basestation_listen:
             subtasks.append(output.make_basestation_listener(host=host,
                                                              port=port,
-                                                             coordinator=self.coordinator,
-                                                             use_kalman_data=False))
+                                                             feed=raw_feed))
 
         for host, port in args.filtered_basestation_connect:
             subtasks.append(output.make_basestation_connector(host=host,
                                                               port=port,
-                                                              coordinator=self.coordinator,
-                                                              use_kalman_data=True))
+                                                              feed=filtered_feed))
 
         for host, port in args.filtered_basestation_listen:
             subtasks.append(output.make_basestation_listener(host=host,
                                                              port=port,
-                                                             coordinator=self.coordinator,
-                                                             use_kalman_data=True))
+                                                             feed=filtered_feed))
 
+        rotate_size = None if args.csv_rotate_size is None else int(args.csv_rotate_size * 1048576)
         for filename in args.write_csv:
             subtasks.append(output.LocalCSVWriter(coordinator=self.coordinator,
-                                                  filename=filename))
+                                                  filename=filename,
+                                                  rotate_size=rotate_size,
+                                                  rotate_interval=args.csv_rotate_interval,
+                                                  compress=args.csv_compress,
+                                                  fsync_interval=args.csv_fsync_interval))
 
         return subtasks
 
     def make_util_subtasks(self, args):
         subtasks = []
 
-        if args.check_leaks:
+        if args.check_leaks == 'tracemalloc':
+            subtasks.append(leakcheck.TracemallocLeakChecker())
+        elif args.check_leaks:
             subtasks.append(leakcheck.LeakChecker())
 
+        for host, port in args.status_listen:
+            subtasks.append(httpstatus.make_status_listener(host=host,
+                                                            port=port,
+                                                            coordinator=self.coordinator,
+                                                            max_age=args.status_max_age))
+
+        if args.record:
+            # must start before the client listeners, so that it sees every handshake
+            subtasks.append(capture.CaptureRecorder(coordinator=self.coordinator,
+                                                    filename=args.record))
+
         return subtasks
 
     def stop(self, msg):
@@ -231,7 +359,14 @@ class MlatServer(object):
         self.coordinator = coordinator.Coordinator(work_dir=args.work_dir,
                                                    pseudorange_filename=args.dump_pseudorange,
                                                    partition=args.partition,
-                                                   tag=args.tag)
+                                                   tag=args.tag,
+                                                   output_queue_limit=args.output_queue_limit,
+                                                   output_overflow=args.output_overflow,
+                                                   skip_unchanged_state=args.skip_unchanged_state,
+                                                   slow_callback_threshold=args.slow_callback_threshold,
+                                                   max_pending_groups=args.max_pending_groups,
+                                                   max_sync_points=args.max_sync_points,
+                                                   overload_control=args.overload_control)
 
         subtasks = self.make_subtasks(args)
 
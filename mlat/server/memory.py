@@ -0,0 +1,262 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Estimates the memory used by the server's main object classes.
+
+Sizes are estimated by sampling: a few instances of each class are measured
+with sys.getsizeof (plus the data buffers of numpy arrays) and the mean is
+scaled up by the number of instances. Large containers are themselves
+sampled, so the cost of a measurement is bounded regardless of how many
+receivers or aircraft there are.
+
+An object's size includes the containers and plain values (numbers,
+strings, arrays) it holds, but not other objects it refers to, which are
+counted under their own class. So a Receiver's tracking set is counted
+with the Receiver, but the aircraft in it are counted under TrackedAircraft.
+"""
+
+import gc
+import random
+import sys
+
+import numpy
+
+from mlat.server import metrics, timebase
+
+__all__ = ('sizeof', 'MemoryAccounting')
+
+_PLAIN = (int, float, complex, bool, str, bytes, bytearray, type(None))
+_CONTAINERS = (tuple, list, set, frozenset, dict)
+
+# containers with more than this many items are sampled
+CONTAINER_SAMPLE = 16
+
+
+def _array_size(a):
+    size = sys.getsizeof(a)
+    if a.flags.owndata and size < a.nbytes:
+        # older numpy does not include the data buffer in getsizeof
+        size += a.nbytes
+    return size
+
+
+def _value_size(value, depth):
+    """Size of a value that is owned by some object: plain values, arrays,
+    and containers of those. References to other objects count as zero."""
+
+    if isinstance(value, _PLAIN):
+        return sys.getsizeof(value)
+
+    if isinstance(value, numpy.ndarray):
+        return _array_size(value)
+
+    if isinstance(value, _CONTAINERS):
+        size = sys.getsizeof(value)
+        if depth <= 0 or not value:
+            return size
+
+        if isinstance(value, dict):
+            items = value.items()
+            if len(value) > CONTAINER_SAMPLE:
+                items = random.sample(list(items), CONTAINER_SAMPLE)
+            contents = sum(_value_size(k, depth - 1) + _value_size(v, depth - 1) for k, v in items)
+        else:
+            items = value
+            if len(value) > CONTAINER_SAMPLE:
+                items = random.sample(list(value), CONTAINER_SAMPLE)
+            contents = sum(_value_size(x, depth - 1) for x in items)
+
+        return size + contents * len(value) // len(items)
+
+    return 0
+
+
+def _slot_attributes(obj):
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name != '__dict__' and hasattr(obj, name):
+                yield name, getattr(obj, name)
+
+
+def _instance_dict(obj):
+    """Return obj's attribute dict, or None if it has none. For a slotted
+    class with a __dict__ slot, the dict is only created when first used,
+    and reading obj.__dict__ would create it; so look for an existing dict
+    among the objects that obj refers to instead."""
+
+    cls = type(obj)
+    if '__slots__' not in cls.__dict__:
+        return getattr(obj, '__dict__', None)
+    if not any('__dict__' in c.__dict__.get('__slots__', ()) for c in cls.__mro__):
+        return None
+
+    slot_values = {id(value) for name, value in _slot_attributes(obj)}
+    extra = False
+    for ref in gc.get_referents(obj):
+        if ref is cls or id(ref) in slot_values:
+            continue
+        if type(ref) is dict:
+            return ref
+        extra = True
+
+    # Some Python versions keep instance attributes without a dict object,
+    # in which case obj refers to the attribute values directly. If there
+    # are any, reading __dict__ is no worse than using the attributes.
+    return object.__getattribute__(obj, '__dict__') if extra else None
+
+
+def _attributes(obj):
+    d = _instance_dict(obj)
+    if d is not None:
+        yield from d.items()
+
+    yield from _slot_attributes(obj)
+
+
+def sizeof(obj, owned=(), depth=3):
+    """Estimate the memory used by obj, in bytes.
+
+    This includes the instance itself, its attribute dict, and any plain
+    values or containers held in its attributes (to the given container
+    depth). Attributes named in owned hold objects that belong to obj,
+    and are included in full."""
+
+    size = sys.getsizeof(obj)
+    d = _instance_dict(obj)
+    if d is not None:
+        size += sys.getsizeof(d)
+
+    for name, value in _attributes(obj):
+        if name in owned:
+            size += sizeof(value, depth=depth)
+        else:
+            size += _value_size(value, depth)
+
+    return size
+
+
+class MemoryAccounting(object):
+    """Periodically estimates the memory used by each class of object held by
+    a coordinator, and the total per subsystem."""
+
+    def __init__(self, coordinator, sample_size=100, max_age=60.0):
+        """sample_size: maximum number of instances of each class to measure
+        max_age: reuse a measurement for up to this many seconds"""
+
+        self.coordinator = coordinator
+        self.sample_size = sample_size
+        self.max_age = max_age
+        self._last = None
+        self._last_time = None
+
+    def _classes(self):
+        """Yield (subsystem, class name, instance collection, owned attributes) for each accounted class."""
+
+        coordinator = self.coordinator
+        yield ('receivers', 'Receiver', coordinator.receivers.values(), ('clock',))
+        yield ('tracker', 'TrackedAircraft', coordinator.tracker.aircraft.values(), ())
+        yield ('tracker', 'KalmanState', [ac.kalman for ac in coordinator.tracker.aircraft.values()], ())
+        yield ('clocksync', 'ClockPairing', coordinator.clock_tracker.clock_pairs.values(), ())
+        yield ('clocksync', 'SyncPoint', [p for points in coordinator.clock_tracker.sync_points.values()
+                                          for p in points], ())
+        yield ('mlat', 'MessageGroup', coordinator.mlat_tracker.pending.values(), ())
+
+    def _indexes(self):
+        """Yield (subsystem, index) for the top-level collections that hold the
+        accounted objects; their own overhead is counted with the subsystem."""
+
+        coordinator = self.coordinator
+        yield ('receivers', coordinator.receivers)
+        yield ('tracker', coordinator.tracker.aircraft)
+        yield ('clocksync', coordinator.clock_tracker.clock_pairs)
+        yield ('clocksync', coordinator.clock_tracker.sync_points)
+        yield ('mlat', coordinator.mlat_tracker.pending)
+
+    def measure(self):
+        """Measure memory use now. Returns a dict with per-class and
+        per-subsystem figures (see dump_state)."""
+
+        classes = {}
+        subsystems = {}
+
+        for subsystem, name, instances, owned in self._classes():
+            instances = list(instances)
+            count = len(instances)
+            if count > self.sample_size:
+                sample = random.sample(instances, self.sample_size)
+            else:
+                sample = instances
+
+            mean = sum(sizeof(obj, owned=owned) for obj in sample) / len(sample) if sample else 0.0
+            total = int(mean * count)
+            classes[name] = {'subsystem': subsystem,
+                             'count': count,
+                             'sampled': len(sample),
+                             'mean_bytes': round(mean),
+                             'total_bytes': total}
+            subsystems[subsystem] = subsystems.get(subsystem, 0) + total
+
+        for subsystem, index in self._indexes():
+            # the index's own table, plus its keys; the values are accounted above
+            size = sys.getsizeof(index)
+            if isinstance(index, dict) and index:
+                keys = list(index.keys())
+                if len(keys) > CONTAINER_SAMPLE:
+                    sample = random.sample(keys, CONTAINER_SAMPLE)
+                else:
+                    sample = keys
+                size += sum(_value_size(k, 2) for k in sample) * len(keys) // len(sample)
+            subsystems[subsystem] = subsystems.get(subsystem, 0) + size
+
+        return {'classes': classes, 'subsystems': subsystems}
+
+    def current(self):
+        """Return a recent measurement, measuring again if the last one is too old."""
+
+        now = timebase.monotonic()
+        if self._last is None or now - self._last_time > self.max_age:
+            self._last = self.measure()
+            self._last_time = now
+        return self._last
+
+    def dump_state(self):
+        state = self.current()
+        return {'classes': state['classes'],
+                'subsystems': state['subsystems'],
+                'total_bytes': sum(state['subsystems'].values()),
+                'sample_size': self.sample_size}
+
+    def collect_metrics(self):
+        state = self.current()
+
+        class_bytes = metrics.Metric('memory_class_bytes', 'gauge',
+                                     'Estimated memory used by all instances of a class', [])
+        class_objects = metrics.Metric('memory_class_objects', 'gauge', 'Number of instances of a class', [])
+        for name, info in sorted(state['classes'].items()):
+            labels = {'class': name, 'subsystem': info['subsystem']}
+            class_bytes.samples.append(('', labels, info['total_bytes']))
+            class_objects.samples.append(('', labels, info['count']))
+        yield class_bytes
+        yield class_objects
+
+        subsystem_bytes = metrics.Metric('memory_subsystem_bytes', 'gauge',
+                                         'Estimated memory used by a subsystem', [])
+        for name, total in sorted(state['subsystems'].items()):
+            subsystem_bytes.samples.append(('', {'subsystem': name}, total))
+        yield subsystem_bytes
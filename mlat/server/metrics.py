@@ -0,0 +1,130 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A minimal registry of metric sources, plus Prometheus text-format output.
+
+A metric source is a callable that returns an iterable of Metric tuples.
+Sources are polled only when metrics are collected, so subsystems can
+report counters they already maintain without any per-event cost.
+"""
+
+import collections
+import logging
+
+__all__ = ('Metric', 'Metrics', 'KINDS', 'gauge', 'counter', 'format_prometheus')
+
+glogger = logging.getLogger("metrics")
+
+# name:    metric name, without the mlat_ prefix
+# kind:    'gauge', 'counter', 'histogram' or 'summary'
+# help:    one-line description
+# samples: list of (suffix, labels, value) tuples; suffix is appended to the
+#          metric name (e.g. '_bucket'), labels is a dict or None
+#
+# A histogram has '_bucket' samples labelled with 'le', a summary has
+# unsuffixed samples labelled with 'quantile'; both also have '_sum' and
+# '_count' samples. Any other kind is exported as 'untyped'.
+Metric = collections.namedtuple('Metric', ('name', 'kind', 'help', 'samples'))
+
+KINDS = frozenset(('gauge', 'counter', 'histogram', 'summary'))
+
+
+def gauge(name, help, value, labels=None):
+    return Metric(name, 'gauge', help, [('', labels, value)])
+
+
+def counter(name, help, value, labels=None):
+    return Metric(name, 'counter', help, [('', labels, value)])
+
+
+class Metrics(object):
+    """A collection of metric sources."""
+
+    def __init__(self):
+        self.sources = []
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def remove_source(self, source):
+        self.sources.remove(source)
+
+    def collect(self):
+        """Return a list of Metric tuples from all sources. Metrics with the same
+        name from different sources are merged."""
+
+        merged = collections.OrderedDict()
+        for source in self.sources:
+            try:
+                for m in source():
+                    existing = merged.get(m.name)
+                    if existing is None:
+                        merged[m.name] = Metric(m.name, m.kind, m.help, list(m.samples))
+                    else:
+                        existing.samples.extend(m.samples)
+            except Exception:
+                glogger.exception("Metric source {0!r} failed".format(source))
+
+        return list(merged.values())
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{k}="{v}"'.format(k=k, v=_escape_label_value(v))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if value is None or value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value)
+
+
+def format_prometheus(metrics, prefix='mlat_'):
+    """Format a list of Metric tuples in the Prometheus text exposition format."""
+
+    lines = []
+    for m in metrics:
+        name = prefix + m.name
+        lines.append('# HELP {name} {help}'.format(name=name, help=_escape_help(m.help)))
+        lines.append('# TYPE {name} {kind}'.format(name=name, kind=m.kind if m.kind in KINDS else 'untyped'))
+        for suffix, labels, value in m.samples:
+            lines.append('{name}{suffix}{labels} {value}'.format(name=name,
+                                                                 suffix=suffix,
+                                                                 labels=_format_labels(labels),
+                                                                 value=_format_value(value)))
+
+    lines.append('')
+    return '\n'.join(lines)
@@ -23,30 +23,44 @@ derive positions.
 """
 
 import json
-import asyncio
+import time
 import logging
 import operator
+import copy
+import heapq
 import numpy
 from contextlib import closing
 
 import modes.message
 from mlat import geodesy, constants, profile
-from mlat.server import clocknorm, solver, config
+from mlat.server import clocknorm, solver, config, timebase
 
 glogger = logging.getLogger("mlattrack")
 
 
 class MessageGroup:
+    __slots__ = ('message', 'first_seen', 'opened', 'copies', 'handle')
+
     def __init__(self, message, first_seen):
         self.message = message
         self.first_seen = first_seen
+        self.opened = timebase.monotonic()
         self.copies = []
         self.handle = None
 
 
 class MlatTracker(object):
-    def __init__(self, coordinator, blacklist_filename=None, pseudorange_filename=None):
+    def __init__(self, coordinator, blacklist_filename=None, pseudorange_filename=None, max_pending=50000):
         self.pending = {}
+        self.max_pending = max_pending
+        self.evicted_count = 0
+
+        # load shedding, controlled by overload.OverloadController
+        self.skip_kalman = False
+        self.min_dof = 0
+        self.reject_new_groups = False
+        self.skipped_kalman_count = 0
+        self.rejected_group_count = 0
         self.coordinator = coordinator
         self.tracker = coordinator.tracker
         self.clock_tracker = coordinator.clock_tracker
@@ -84,20 +98,62 @@ class MlatTracker(object):
 
     @profile.trackcpu
     def receiver_mlat(self, receiver, timestamp, message, utc):
+        receiver.mlat_message_count += 1
+
         # use message as key
         group = self.pending.get(message)
         if not group:
+            if self.reject_new_groups:
+                self.rejected_group_count += 1
+                return
+            if len(self.pending) >= self.max_pending:
+                self._evict_pending()
             group = self.pending[message] = MessageGroup(message, utc)
-            group.handle = asyncio.get_event_loop().call_later(
+            group.handle = timebase.call_later(
                 config.MLAT_DELAY,
                 self._resolve,
                 group)
+            profile.record_latency('ingest', timebase.time() - utc)
 
         group.copies.append((receiver, timestamp, utc))
         group.first_seen = min(group.first_seen, utc)
 
+    @profile.trackcpu
+    def _evict_pending(self):
+        """Drop the pending groups with the fewest copies (which are the least
+        likely to produce a result) to make room for new groups. A tenth of the
+        groups are dropped at a time, so that the cost of finding them is spread
+        over many insertions."""
+
+        count = max(1, len(self.pending) // 10)
+        for group in heapq.nsmallest(count, self.pending.values(), key=lambda g: len(g.copies)):
+            group.handle.cancel()
+            del self.pending[group.message]
+
+        self.evicted_count += count
+        glogger.info("Pending group limit reached, dropped {n} groups".format(n=count))
+
     @profile.trackcpu
     def _resolve(self, group):
+        start = time.perf_counter()
+        try:
+            self._resolve_group(group)
+        finally:
+            # share the time spent between the receivers that contributed copies
+            share = (time.perf_counter() - start) / len(group.copies)
+            for receiver, timestamp, utc in group.copies:
+                receiver.resolve_time += share
+
+    def _resolve_group(self, group):
+        # latency stages, see mlat.profile:
+        #   ingest:    first copy's arrival time (or GPS time) to group open
+        #   wait:      group open to resolve (MLAT_DELAY plus any scheduling delay)
+        #   normalize, cluster, solve, kalman: time spent in each step
+        #   total:     first copy's arrival time to result publication
+        #   output:    queueing delay in the output bus
+        t_start = timebase.monotonic()
+        profile.record_latency('wait', t_start - group.opened)
+
         del self.pending[group.message]
 
         # less than 3 messages -> no go
@@ -105,6 +161,8 @@ class MlatTracker(object):
             return
 
         decoded = modes.message.decode(group.message)
+        if decoded is None:
+            return
 
         ac = self.tracker.aircraft.get(decoded.address)
         if not ac:
@@ -157,7 +215,7 @@ class MlatTracker(object):
 
         # check for minimum needed receivers
         dof = len(timestamp_map) + altitude_dof - 4
-        if dof < 0:
+        if dof < self.min_dof:
             return
 
         # basic ratelimit before we do more work
@@ -168,10 +226,16 @@ class MlatTracker(object):
         if elapsed < 2.0 and dof == last_result_dof:
             return
 
+        for receiver, timestamps in timestamp_map.items():
+            receiver.cluster_candidate_count += len(timestamps)
+
         # normalize timestamps. This returns a list of timestamp maps;
         # within each map, the timestamp values are comparable to each other.
+        t_normalize = time.perf_counter()
         components = clocknorm.normalize(clocktracker=self.clock_tracker,
                                          timestamp_map=timestamp_map)
+        t_cluster = time.perf_counter()
+        profile.record_latency('normalize', t_cluster - t_normalize)
 
         # cluster timestamps into clusters that are probably copies of the
         # same transmission.
@@ -181,6 +245,9 @@ class MlatTracker(object):
             if len(component) >= min_component_size:  # don't bother with orphan components at all
                 clusters.extend(_cluster_timestamps(component, min_component_size))
 
+        t_solve = time.perf_counter()
+        profile.record_latency('cluster', t_solve - t_cluster)
+
         if not clusters:
             return
 
@@ -196,6 +263,8 @@ class MlatTracker(object):
 
             elapsed = cluster_utc - last_result_time
             dof = distinct + altitude_dof - 4
+            if dof < self.min_dof:
+                continue
 
             if elapsed < 10.0 and dof < last_result_dof:
                 break
@@ -216,6 +285,8 @@ class MlatTracker(object):
                 altitude_error = None
 
             cluster.sort(key=operator.itemgetter(1))  # sort by increasing timestamp (todo: just assume descending..)
+            for receiver, timestamp, variance in cluster:
+                receiver.solver_count += 1
             r = solver.solve(cluster, altitude, altitude_error,
                              last_result_position if last_result_position else cluster[0][0].position)
             if r:
@@ -242,6 +313,9 @@ class MlatTracker(object):
                 # accept it
                 result = r
 
+        t_kalman = time.perf_counter()
+        profile.record_latency('solve', t_kalman - t_solve)
+
         if not result:
             return
 
@@ -252,8 +326,11 @@ class MlatTracker(object):
         ac.last_result_time = cluster_utc
         ac.mlat_result_count += 1
 
-        if ac.kalman.update(cluster_utc, cluster, altitude, altitude_error, ecef, ecef_cov, distinct, dof):
+        if self.skip_kalman:
+            self.skipped_kalman_count += 1
+        elif ac.kalman.update(cluster_utc, cluster, altitude, altitude_error, ecef, ecef_cov, distinct, dof):
             ac.mlat_kalman_count += 1
+        profile.record_latency('kalman', time.perf_counter() - t_kalman)
 
         if altitude is None:
             _, _, solved_alt = geodesy.ecef2llh(ecef)
@@ -262,11 +339,12 @@ class MlatTracker(object):
                 solved_alt=solved_alt*constants.MTOF,
                 dof=dof))
 
-        for handler in self.coordinator.output_handlers:
-            handler(cluster_utc, decoded.address,
-                    ecef, ecef_cov,
-                    [receiver for receiver, timestamp, error in cluster], distinct, dof,
-                    ac.kalman)
+        # handlers run later, so give them a snapshot of the current Kalman state
+        self.coordinator.output_bus.publish((cluster_utc, decoded.address,
+                                             ecef, ecef_cov,
+                                             [receiver for receiver, timestamp, error in cluster], distinct, dof,
+                                             copy.copy(ac.kalman)))
+        profile.record_latency('total', timebase.time() - group.first_seen)
 
         if self.pseudorange_file:
             cluster_state = []
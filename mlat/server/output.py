@@ -22,11 +22,23 @@ import time
 import math
 import functools
 import socket
+import collections
+import threading
+import queue
+import os
+import gzip
+import shutil
+from contextlib import closing
 import numpy
 
 from mlat import constants, geodesy
 from mlat.server import util, net
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 """
 Various output methods for multilateration results.
 """
@@ -50,16 +62,73 @@ def csv_quote(s):
 
 
 class LocalCSVWriter(object):
-    """Writes multilateration results to a local CSV file"""
+    """Writes multilateration results to a local CSV file.
+
+    Results are formatted and written by a background thread, so that disk
+    writes never stall the event loop. The file may optionally be rotated
+    by size and/or age, with rotated files compressed by a second thread
+    (so that compression doesn't hold up writing), and fsync()ed on a
+    schedule."""
 
     TEMPLATE = '{t:.3f},{address:06X},{callsign},{squawk},{lat:.4f},{lon:.4f},{alt:.0f},{err:.0f},{n},{d},{receivers},{dof}\n'  # noqa
     KTEMPLATE = '{t:.3f},{address:06X},{callsign},{squawk},{lat:.4f},{lon:.4f},{alt:.0f},{err:.0f},{n},{d},{receivers},{dof},{klat:.4f},{klon:.4f},{kalt:.0f},{kheading:.0f},{kspeed:.0f},{kvrate:.0f},{kerr:.0f}\n'  # noqa
 
-    def __init__(self, coordinator, filename):
+    # passed to the writer thread in place of a result, to wake it up
+    _WAKEUP = object()
+
+    # how often an idle writer thread checks whether to rotate or fsync
+    IDLE_INTERVAL = 1.0
+
+    def __init__(self, coordinator, filename,
+                 rotate_size=None, rotate_interval=None, compress=None, fsync_interval=None,
+                 queue_limit=100000, batch_size=500):
+        """coordinator: the coordinator to take results from
+        filename: the CSV file to append to
+        rotate_size: if not None, rotate the file once it reaches this many bytes
+        rotate_interval: if not None, rotate the file after this many seconds
+        compress: None, 'gzip' or 'zstd'; compress rotated files with this method
+        fsync_interval: if not None, fsync the file at most this often, in seconds
+        queue_limit: the maximum number of results waiting for the writer thread;
+          results beyond this are dropped
+        batch_size: the maximum number of results the writer thread writes at once
+        """
+
+        if compress not in (None, 'gzip', 'zstd'):
+            raise ValueError('Unknown CSV compression method: ' + str(compress))
+        if compress == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd compression of CSV files requires the zstandard module')
+
         self.logger = logging.getLogger("csv")
         self.coordinator = coordinator
         self.filename = filename
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+
+        self.written_count = 0
+        self.dropped_count = 0
+        self._logged_dropped_count = 0
+
         self.f = open(filename, 'a')
+        self._next_rotate = None if rotate_interval is None else time.time() + rotate_interval
+        self._next_fsync = None if fsync_interval is None else time.monotonic() + fsync_interval
+
+        self._queue = queue.Queue(maxsize=queue_limit)
+        self._stop = threading.Event()
+        self._reopen_requested = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='csv writer ' + filename, daemon=True)
+        self._thread.start()
+
+        if compress is not None:
+            self._compress_queue = queue.Queue()
+            self._compress_thread = threading.Thread(target=self._run_compress,
+                                                     name='csv compressor ' + filename, daemon=True)
+            self._compress_thread.start()
+        else:
+            self._compress_queue = self._compress_thread = None
+
         self.coordinator.add_output_handler(self.write_result)
         self.coordinator.add_sighup_handler(self.reopen)
 
@@ -69,12 +138,128 @@ class LocalCSVWriter(object):
     def close(self):
         self.coordinator.remove_output_handler(self.write_result)
         self.coordinator.remove_sighup_handler(self.reopen)
-        self.f.close()
+        self._stop.set()
+        self._wakeup()
 
     def wait_closed(self):
-        return util.completed_future
+        return asyncio.get_event_loop().run_in_executor(None, self._join)
+
+    def _join(self):
+        self._thread.join()
+        if self._compress_thread:
+            self._compress_thread.join()
 
     def reopen(self):
+        self._reopen_requested.set()
+        self._wakeup()
+
+    def _wakeup(self):
+        # never block the event loop; if the queue is full, the writer
+        # thread is busy and will notice the request after its next batch
+        try:
+            self._queue.put_nowait(self._WAKEUP)
+        except queue.Full:
+            pass
+
+    def write_result(self, receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof, kalman_state):
+        # the aircraft may have gone away since the result was produced
+        ac = self.coordinator.tracker.aircraft.get(address)
+        callsign = ac.callsign if ac else None
+        squawk = ac.squawk if ac else None
+
+        try:
+            self._queue.put_nowait((receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof,
+                                    kalman_state, callsign, squawk))
+        except queue.Full:
+            self.dropped_count += 1
+
+    # everything below here runs on the writer thread
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.IDLE_INTERVAL))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            for item in batch:
+                if item is not self._WAKEUP:
+                    try:
+                        lines.append(self._format_result(*item))
+                    except Exception:
+                        self.logger.exception("Failed to format result")
+            self._write_lines(lines)
+
+            if self._stop.is_set() and self._queue.empty():
+                self._close_file()
+                if self._compress_queue:
+                    self._compress_queue.put(None)
+                return
+
+            if self._reopen_requested.is_set():
+                self._reopen_requested.clear()
+                self._reopen()
+
+            self._check_schedule()
+
+    def _write_lines(self, lines):
+        if not lines:
+            return
+
+        try:
+            self.f.write(''.join(lines))
+            self.written_count += len(lines)
+            if self._queue.empty():
+                self.f.flush()
+        except Exception:
+            self.logger.exception("Failed to write results")
+
+    def _check_schedule(self):
+        """Rotate and fsync the file if they are due. This is called when
+        idle too, so an idle file is still rotated on time."""
+
+        try:
+            size = self.f.tell()
+        except Exception:
+            size = 0
+
+        if ((self.rotate_size is not None and size >= self.rotate_size) or
+                (self._next_rotate is not None and time.time() >= self._next_rotate)):
+            if size > 0:
+                self._rotate()
+            elif self.rotate_interval is not None:
+                # don't rotate empty files
+                self._next_rotate = time.time() + self.rotate_interval
+
+        if self._next_fsync is not None and time.monotonic() >= self._next_fsync:
+            self._next_fsync = time.monotonic() + self.fsync_interval
+            try:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+            except Exception:
+                self.logger.exception("Failed to fsync {filename}".format(filename=self.filename))
+
+    def _close_file(self):
+        try:
+            self.f.flush()
+            if self.fsync_interval is not None:
+                os.fsync(self.f.fileno())
+            self.f.close()
+        except Exception:
+            self.logger.exception("Failed to close {filename}".format(filename=self.filename))
+
+        dropped = self.dropped_count
+        if dropped > self._logged_dropped_count:
+            self.logger.warning("{filename}: {n} results dropped due to a full write queue".format(
+                filename=self.filename,
+                n=dropped - self._logged_dropped_count))
+            self._logged_dropped_count = dropped
+
+    def _reopen(self):
         try:
             self.f.close()
             self.f = open(self.filename, 'a')
@@ -82,60 +267,184 @@ class LocalCSVWriter(object):
         except Exception:
             self.logger.exception("Failed to reopen {filename}".format(filename=self.filename))
 
-    def write_result(self, receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof, kalman_state):
+    def _rotate(self):
+        if self.rotate_interval is not None:
+            self._next_rotate = time.time() + self.rotate_interval
+
+        base = self.filename + '.' + time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        rotated = base
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz') or os.path.exists(rotated + '.zst'):
+            rotated = '{base}.{n}'.format(base=base, n=n)
+            n += 1
+
+        self._close_file()
         try:
-            lat, lon, alt = geodesy.ecef2llh(ecef)
+            os.rename(self.filename, rotated)
+            self.logger.info("Rotated {filename} to {rotated}".format(filename=self.filename, rotated=rotated))
+        except Exception:
+            self.logger.exception("Failed to rotate {filename}".format(filename=self.filename))
+            rotated = None
 
-            ac = self.coordinator.tracker.aircraft[address]
-            callsign = ac.callsign
-            squawk = ac.squawk
+        try:
+            self.f = open(self.filename, 'a')
+        except Exception:
+            self.logger.exception("Failed to reopen {filename}".format(filename=self.filename))
 
-            if ecef_cov is None:
-                err_est = -1
+        if rotated is not None and self._compress_queue:
+            self._compress_queue.put(rotated)
+
+    # runs on the compressor thread
+
+    def _run_compress(self):
+        while True:
+            path = self._compress_queue.get()
+            if path is None:
+                return
+            self._compress_file(path)
+
+    def _compress_file(self, path):
+        try:
+            if self.compress == 'gzip':
+                with closing(open(path, 'rb')) as src, closing(gzip.open(path + '.gz', 'wb')) as dst:
+                    shutil.copyfileobj(src, dst)
             else:
-                var_est = numpy.sum(numpy.diagonal(ecef_cov))
-                if var_est >= 0:
-                    err_est = math.sqrt(var_est)
-                else:
-                    err_est = -1
-
-            if kalman_state.valid and kalman_state.last_update >= receive_timestamp:
-                line = self.KTEMPLATE.format(
-                    t=receive_timestamp,
-                    address=address,
-                    callsign=csv_quote(callsign),
-                    squawk=csv_quote(squawk),
-                    lat=lat,
-                    lon=lon,
-                    alt=alt * constants.MTOF,
-                    err=err_est,
-                    n=len(receivers),
-                    d=distinct,
-                    dof=dof,
-                    receivers=csv_quote(','.join([receiver.uuid for receiver in receivers])),
-                    klat=kalman_state.position_llh[0],
-                    klon=kalman_state.position_llh[1],
-                    kalt=kalman_state.position_llh[2] * constants.MTOF,
-                    kheading=kalman_state.heading,
-                    kspeed=kalman_state.ground_speed * constants.MS_TO_KTS,
-                    kvrate=kalman_state.vertical_speed * constants.MS_TO_FPM,
-                    kerr=kalman_state.position_error)
+                with closing(open(path, 'rb')) as src, closing(open(path + '.zst', 'wb')) as dst:
+                    zstandard.ZstdCompressor().copy_stream(src, dst)
+            os.unlink(path)
+        except Exception:
+            self.logger.exception("Failed to compress {path}".format(path=path))
+
+    def _format_result(self, receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof, kalman_state,
+                       callsign, squawk):
+        lat, lon, alt = geodesy.ecef2llh(ecef)
+
+        if ecef_cov is None:
+            err_est = -1
+        else:
+            var_est = numpy.sum(numpy.diagonal(ecef_cov))
+            if var_est >= 0:
+                err_est = math.sqrt(var_est)
+            else:
+                err_est = -1
+
+        if kalman_state.valid and kalman_state.last_update >= receive_timestamp:
+            return self.KTEMPLATE.format(
+                t=receive_timestamp,
+                address=address,
+                callsign=csv_quote(callsign),
+                squawk=csv_quote(squawk),
+                lat=lat,
+                lon=lon,
+                alt=alt * constants.MTOF,
+                err=err_est,
+                n=len(receivers),
+                d=distinct,
+                dof=dof,
+                receivers=csv_quote(','.join([receiver.uuid for receiver in receivers])),
+                klat=kalman_state.position_llh[0],
+                klon=kalman_state.position_llh[1],
+                kalt=kalman_state.position_llh[2] * constants.MTOF,
+                kheading=kalman_state.heading,
+                kspeed=kalman_state.ground_speed * constants.MS_TO_KTS,
+                kvrate=kalman_state.vertical_speed * constants.MS_TO_FPM,
+                kerr=kalman_state.position_error)
+        else:
+            return self.TEMPLATE.format(
+                t=receive_timestamp,
+                address=address,
+                callsign=csv_quote(callsign),
+                squawk=csv_quote(squawk),
+                lat=lat,
+                lon=lon,
+                alt=alt * constants.MTOF,
+                err=err_est,
+                n=len(receivers),
+                d=distinct,
+                dof=dof,
+                receivers=csv_quote(','.join([receiver.uuid for receiver in receivers])))
+
+
+class BasestationFeed(object):
+    """Formats results in Basestation port-30003 format once per result and
+    distributes the formatted lines to all connected BasestationClients."""
+
+    TEMPLATE = 'MSG,{mtype},1,1,{addr:06X},1,{rcv_date},{rcv_time},{now_date},{now_time},{callsign},{altitude},{speed},{heading},{lat},{lon},{vrate},{squawk},{fs},{emerg},{ident},{aog}\n'  # noqa
+
+    def __init__(self, coordinator, use_kalman_data, queue_limit=10000):
+        """coordinator: the coordinator to take results from
+        use_kalman_data: if True, send Kalman filter positions, otherwise send raw results
+        queue_limit: the maximum number of lines to queue for each client; when a slow
+          client's queue is full, the oldest queued lines are dropped
+        """
+
+        self.logger = logging.getLogger("basestation")
+        self.coordinator = coordinator
+        self.use_kalman_data = use_kalman_data
+        self.queue_limit = queue_limit
+        self.clients = []
+
+    def add_client(self, client):
+        if not self.clients:
+            self.coordinator.add_output_handler(self.write_result)
+        self.clients.append(client)
+
+    def remove_client(self, client):
+        self.clients.remove(client)
+        if not self.clients:
+            self.coordinator.remove_output_handler(self.write_result)
+
+    def dump_state(self):
+        return [{'peer': '{host}:{port}'.format(host=client.host, port=client.port),
+                 'queued': len(client.queue),
+                 'sent': client.sent_count,
+                 'dropped': client.dropped_count}
+                for client in self.clients]
+
+    def write_result(self, receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof, kalman_data):
+        try:
+            if self.use_kalman_data:
+                if not kalman_data.valid or kalman_data.last_update < receive_timestamp:
+                    return
+
+                lat, lon, alt = kalman_data.position_llh
+                speed = int(round(kalman_data.ground_speed * constants.MS_TO_KTS))
+                heading = int(round(kalman_data.heading))
+                vrate = int(round(kalman_data.vertical_speed * constants.MS_TO_FPM))
             else:
-                line = self.TEMPLATE.format(
-                    t=receive_timestamp,
-                    address=address,
-                    callsign=csv_quote(callsign),
-                    squawk=csv_quote(squawk),
-                    lat=lat,
-                    lon=lon,
-                    alt=alt * constants.MTOF,
-                    err=err_est,
-                    n=len(receivers),
-                    d=distinct,
-                    dof=dof,
-                    receivers=csv_quote(','.join([receiver.uuid for receiver in receivers])))
-
-            self.f.write(line)
+                lat, lon, alt = geodesy.ecef2llh(ecef)
+                speed = ''
+                heading = ''
+                vrate = ''
+
+            # the aircraft may have gone away since the result was produced
+            ac = self.coordinator.tracker.aircraft.get(address)
+            callsign = ac.callsign if ac else None
+            squawk = ac.squawk if ac else None
+            altitude = int(round(alt * constants.MTOF))
+            send_timestamp = time.time()
+
+            line = self.TEMPLATE.format(mtype=3,
+                                        addr=address,
+                                        rcv_date=format_date(receive_timestamp),
+                                        rcv_time=format_time(receive_timestamp),
+                                        now_date=format_date(send_timestamp),
+                                        now_time=format_time(send_timestamp),
+                                        callsign=csv_quote(callsign),
+                                        squawk=csv_quote(squawk),
+                                        lat=round(lat, 4),
+                                        lon=round(lon, 4),
+                                        altitude=altitude,
+                                        speed=speed,
+                                        heading=heading,
+                                        vrate=vrate,
+                                        fs='',
+                                        emerg='',
+                                        ident='',
+                                        aog='').encode('ascii')
+
+            for client in self.clients:
+                client.enqueue(line)
 
         except Exception:
             self.logger.exception("Failed to write result")
@@ -143,11 +452,14 @@ class LocalCSVWriter(object):
 
 
 class BasestationClient(object):
-    """Writes results in Basestation port-30003 format to network clients."""
+    """Writes results in Basestation port-30003 format to network clients.
 
-    TEMPLATE = 'MSG,{mtype},1,1,{addr:06X},1,{rcv_date},{rcv_time},{now_date},{now_time},{callsign},{altitude},{speed},{heading},{lat},{lon},{vrate},{squawk},{fs},{emerg},{ident},{aog}\n'  # noqa
+    Lines formatted by a BasestationFeed are held in a bounded queue and
+    written out as fast as the client will accept them; if the client falls
+    too far behind, the oldest lines are dropped. Heartbeats bypass the
+    queue, so they are never dropped."""
 
-    def __init__(self, reader, writer, *, coordinator, use_kalman_data, heartbeat_interval=30.0):
+    def __init__(self, reader, writer, *, feed, heartbeat_interval=30.0):
         peer = writer.get_extra_info('peername')
         self.host = peer[0]
         self.port = peer[1]
@@ -156,29 +468,40 @@ class BasestationClient(object):
                                                                         port=self.port)})
         self.reader = reader
         self.writer = writer
-        self.coordinator = coordinator
-        self.use_kalman_data = use_kalman_data
+        self.feed = feed
         self.heartbeat_interval = heartbeat_interval
         self.last_output = time.monotonic()
+
+        self.queue = collections.deque()
+        self.queue_limit = feed.queue_limit
+        self.sent_count = 0
+        self.dropped_count = 0
+        self._wakeup = asyncio.Event()
+
         self.heartbeat_task = asyncio.async(self.send_heartbeats())
         self.reader_task = asyncio.async(self.read_until_eof())
+        self.writer_task = asyncio.async(self.write_queued())
 
         self.logger.info("Connection established")
-        self.coordinator.add_output_handler(self.write_result)
+        self.feed.add_client(self)
 
     def close(self):
         if not self.writer:
             return  # already closed
 
-        self.logger.info("Connection lost")
-        self.coordinator.remove_output_handler(self.write_result)
+        self.logger.info("Connection lost ({sent} lines sent, {dropped} dropped)".format(
+            sent=self.sent_count,
+            dropped=self.dropped_count))
+        self.feed.remove_client(self)
         self.heartbeat_task.cancel()
+        self.writer_task.cancel()
         self.writer.close()
         self.writer = None
+        self.queue.clear()
 
     @asyncio.coroutine
     def wait_closed(self):
-        yield from util.safe_wait([self.heartbeat_task, self.reader_task])
+        yield from util.safe_wait([self.heartbeat_task, self.reader_task, self.writer_task])
 
     @asyncio.coroutine
     def read_until_eof(self):
@@ -204,6 +527,9 @@ class BasestationClient(object):
                     yield from asyncio.sleep(delay)
                     continue
 
+                # written directly, not queued: a queued heartbeat could be
+                # dropped along with results when the client falls behind.
+                # Whole lines are always written, so this can't split one.
                 self.writer.write(b'\n')
                 self.last_output = now
 
@@ -211,65 +537,48 @@ class BasestationClient(object):
             self.close()
             return
 
-    def write_result(self, receive_timestamp, address, ecef, ecef_cov, receivers, distinct, dof, kalman_data):
+    def enqueue(self, line):
+        """Queue a formatted line for writing to this client."""
+
+        if len(self.queue) >= self.queue_limit:
+            self.queue.popleft()
+            self.dropped_count += 1
+
+        self.queue.append(line)
+        self._wakeup.set()
+
+    @asyncio.coroutine
+    def write_queued(self):
         try:
-            if self.use_kalman_data:
-                if not kalman_data.valid or kalman_data.last_update < receive_timestamp:
-                    return
+            while True:
+                yield from self._wakeup.wait()
+                self._wakeup.clear()
 
-                lat, lon, alt = kalman_data.position_llh
-                speed = int(round(kalman_data.ground_speed * constants.MS_TO_KTS))
-                heading = int(round(kalman_data.heading))
-                vrate = int(round(kalman_data.vertical_speed * constants.MS_TO_FPM))
-            else:
-                lat, lon, alt = geodesy.ecef2llh(ecef)
-                speed = ''
-                heading = ''
-                vrate = ''
+                while self.queue:
+                    count = len(self.queue)
+                    data = b''.join(self.queue)
+                    self.queue.clear()
 
-            ac = self.coordinator.tracker.aircraft[address]
-            callsign = ac.callsign
-            squawk = ac.squawk
-            altitude = int(round(alt * constants.MTOF))
-            send_timestamp = time.time()
+                    self.writer.write(data)
+                    self.sent_count += count
+                    self.last_output = time.monotonic()
 
-            line = self.TEMPLATE.format(mtype=3,
-                                        addr=address,
-                                        rcv_date=format_date(receive_timestamp),
-                                        rcv_time=format_time(receive_timestamp),
-                                        now_date=format_date(send_timestamp),
-                                        now_time=format_time(send_timestamp),
-                                        callsign=csv_quote(callsign),
-                                        squawk=csv_quote(squawk),
-                                        lat=round(lat, 4),
-                                        lon=round(lon, 4),
-                                        altitude=altitude,
-                                        speed=speed,
-                                        heading=heading,
-                                        vrate=vrate,
-                                        fs='',
-                                        emerg='',
-                                        ident='',
-                                        aog='')
-            self.writer.write(line.encode('ascii'))
-            self.last_output = time.monotonic()
+                    # wait for the transport to drain below its high-water mark;
+                    # lines arriving meanwhile are queued (or dropped) above
+                    yield from self.writer.drain()
 
-        except Exception:
-            self.logger.exception("Failed to write result")
-            # swallow the exception so we don't affect our caller
+        except socket.error:
+            self.close()
+            return
 
 
-def make_basestation_listener(host, port, coordinator, use_kalman_data):
-    factory = functools.partial(BasestationClient,
-                                coordinator=coordinator,
-                                use_kalman_data=use_kalman_data)
+def make_basestation_listener(host, port, feed):
+    factory = functools.partial(BasestationClient, feed=feed)
     return net.MonitoringListener(host, port, factory,
                                   logger=logging.getLogger('basestation'),
                                   description='Basestation output listener')
 
 
-def make_basestation_connector(host, port, coordinator, use_kalman_data):
-    factory = functools.partial(BasestationClient,
-                                coordinator=coordinator,
-                                use_kalman_data=use_kalman_data)
+def make_basestation_connector(host, port, feed):
+    factory = functools.partial(BasestationClient, feed=feed)
     return net.MonitoringConnector(host, port, 30.0, factory)
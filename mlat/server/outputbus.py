@@ -0,0 +1,216 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decouples multilateration result producers from the output handlers that
+consume the results, so that a slow handler does not delay solving.
+"""
+
+import asyncio
+import collections
+import logging
+
+from mlat import profile
+from mlat.server import util, timebase
+
+__all__ = ('OutputBus', 'OVERFLOW_POLICIES')
+
+glogger = logging.getLogger("outputbus")
+
+# What to do when a handler's queue is full:
+#   drop-oldest: discard the oldest queued result to make room
+#   drop-newest: discard the new result
+#   inline:      call the handler immediately, bypassing the queue
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'inline')
+
+# log dropped results at most this often, per handler
+DROP_LOG_INTERVAL = 60.0
+
+
+class _HandlerQueue(object):
+    """The queue of pending results for a single output handler,
+    plus the task that feeds them to the handler.
+
+    An inline handler has no queue or task: it is called as each result
+    is pushed, and never drops results."""
+
+    def __init__(self, handler, limit, overflow, batch_size, inline=False):
+        self.handler = handler
+        self.name = getattr(handler, '__qualname__', repr(handler))
+        self.limit = limit
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.inline = inline
+        self.queue = collections.deque()
+
+        self.handled_count = 0
+        self.dropped_count = 0
+        self.inline_count = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self._logged_dropped_count = 0
+        self._last_drop_log = None
+
+        self._wakeup = asyncio.Event()
+        if inline:
+            self._task = None
+        else:
+            self._task = asyncio.async(self._run())
+
+    def push(self, record, now):
+        if self.inline:
+            self.inline_count += 1
+            self._call(record, 0.0)
+            return
+
+        if len(self.queue) >= self.limit:
+            if self.overflow == 'drop-oldest':
+                self.queue.popleft()
+                self._dropped()
+            elif self.overflow == 'drop-newest':
+                self._dropped()
+                return
+            else:
+                self.inline_count += 1
+                self._call(record, 0.0)
+                return
+
+        self.queue.append((now, record))
+        self._wakeup.set()
+
+    def _dropped(self):
+        self.dropped_count += 1
+
+        now = timebase.monotonic()
+        if self._last_drop_log is None or now - self._last_drop_log >= DROP_LOG_INTERVAL:
+            glogger.warning("Output handler {name} is not keeping up, dropped {n} results ({policy})".format(
+                name=self.name,
+                n=self.dropped_count - self._logged_dropped_count,
+                policy=self.overflow))
+            self._logged_dropped_count = self.dropped_count
+            self._last_drop_log = now
+
+    def _call(self, record, lag):
+        self.handled_count += 1
+        self.last_lag = lag
+        self.total_lag += lag
+        profile.record_latency('output', lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+        try:
+            self.handler(*record)
+        except Exception:
+            glogger.exception("Output handler {name} failed".format(name=self.name))
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            yield from self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self.queue:
+                now = timebase.monotonic()
+                for i in range(min(self.batch_size, len(self.queue))):
+                    pushed, record = self.queue.popleft()
+                    self._call(record, now - pushed)
+
+                # let other work run between batches
+                yield from asyncio.sleep(0)
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        self.queue.clear()
+
+    def wait_closed(self):
+        return util.safe_wait([self._task])
+
+    def dump_state(self):
+        return {'handler': self.name,
+                'mode': 'inline' if self.inline else self.overflow,
+                'queued': len(self.queue),
+                'handled': self.handled_count,
+                'dropped': self.dropped_count,
+                'inline': self.inline_count,
+                'last_lag': round(self.last_lag, 4),
+                'max_lag': round(self.max_lag, 4),
+                'mean_lag': round(self.total_lag / self.handled_count, 4) if self.handled_count else None}
+
+
+class OutputBus(object):
+    """Fans out multilateration results to a set of output handlers.
+
+    Each handler gets its own bounded queue and a task that calls the handler
+    for queued results in batches. Handlers are called with the same arguments
+    as the record that was published."""
+
+    def __init__(self, limit=1000, overflow='drop-oldest', batch_size=50):
+        """limit: the maximum number of results to queue per handler
+        overflow: what to do when a handler's queue is full, see OVERFLOW_POLICIES
+        batch_size: the maximum number of results to hand to a handler before
+          yielding to the event loop
+        """
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: ' + str(overflow))
+
+        self.limit = limit
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.queues = []
+        self._closing = []
+
+    def add_handler(self, handler, inline=False):
+        """Add an output handler. If inline is True, the handler is called
+        directly from publish() rather than from a queue, so it never has
+        results dropped; use this for handlers that must see every result
+        and are fast enough to run on the solve path."""
+
+        self.queues.append(_HandlerQueue(handler, self.limit, self.overflow, self.batch_size, inline=inline))
+
+    def remove_handler(self, handler):
+        for q in self.queues:
+            if q.handler == handler:
+                self.queues.remove(q)
+                q.close()
+                return
+        raise ValueError('Handler not registered')
+
+    def publish(self, record):
+        """Queue a result record (a tuple of output handler arguments) for all handlers."""
+        now = timebase.monotonic()
+        for q in self.queues:
+            q.push(record, now)
+
+    def fill_fraction(self):
+        """Return how full the fullest handler queue is, from 0 to 1."""
+        return max((len(q.queue) / q.limit for q in self.queues if not q.inline), default=0.0)
+
+    def close(self):
+        for q in self.queues:
+            q.close()
+        self._closing.extend(self.queues)
+        self.queues = []
+
+    def wait_closed(self):
+        return util.safe_wait([q._task for q in self._closing])
+
+    def dump_state(self):
+        return [q.dump_state() for q in self.queues]
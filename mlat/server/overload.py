@@ -0,0 +1,189 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Graded load shedding, driven by event loop lag and queue depth.
+"""
+
+import asyncio
+import logging
+
+from mlat.server import util, metrics, timebase
+
+__all__ = ('OverloadController', 'LEVELS')
+
+glogger = logging.getLogger("overload")
+
+# The load shedding levels. Each level also applies everything below it.
+LEVELS = (
+    'normal',
+    'skip-kalman',           # don't update Kalman filters for new results
+    'raise-min-dof',         # don't solve groups with no spare degrees of freedom
+    'skip-converged-sync',   # don't update clock pairings that are already converged
+    'reject-new-groups'      # don't start new mlat message groups
+)
+
+
+class OverloadController(object):
+    """Periodically measures load and moves between load shedding levels.
+
+    Load is the worse of two signals: the recent event loop lag (from the
+    coordinator's LoopMonitor), and how full the output bus and pending mlat
+    group queues are. Each signal has a threshold per level. Load has to
+    exceed a level's threshold to move up to it, and must fall below half
+    of that threshold for hold_time seconds before moving back down. Moves
+    are one level at a time.
+
+    The controller applies each level by setting plain attributes on the
+    mlat and clock trackers, so the cost on the hot paths is an attribute
+    check."""
+
+    def __init__(self, coordinator, interval=1.0, hold_time=10.0,
+                 lag_thresholds=(0.1, 0.25, 0.5, 1.0),
+                 queue_thresholds=(0.25, 0.5, 0.75, 0.9)):
+        """coordinator: the coordinator to monitor and control
+        interval: how often to evaluate load, in seconds
+        hold_time: how long load must stay low before stepping down a level, in seconds
+        lag_thresholds: loop lag, in seconds, needed to reach levels 1..4
+        queue_thresholds: queue fullness (0..1) needed to reach levels 1..4
+        """
+
+        self.coordinator = coordinator
+        self.interval = interval
+        self.hold_time = hold_time
+        self.lag_thresholds = lag_thresholds
+        self.queue_thresholds = queue_thresholds
+
+        self.level = 0
+        self.last_change = timebase.monotonic()
+        self.low_since = None   # when load last fell low enough to step down, or None
+        self.last_lag = 0.0
+        self.last_fill = 0.0
+        self.transitions = 0
+        self.time_at_level = [0.0] * len(LEVELS)
+
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.async(self.run())
+        return util.completed_future
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._apply(0)
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        if self._task is not None:
+            yield from util.safe_wait([self._task])
+
+    @asyncio.coroutine
+    def run(self):
+        last = timebase.monotonic()
+        while True:
+            yield from asyncio.sleep(self.interval)
+
+            now = timebase.monotonic()
+            self.time_at_level[self.level] += now - last
+            last = now
+
+            try:
+                self.evaluate(now)
+            except Exception:
+                glogger.exception("Overload evaluation failed")
+
+    def _fill(self):
+        """Return how full the most-full queue is, from 0 to 1."""
+
+        coordinator = self.coordinator
+        fill = coordinator.output_bus.fill_fraction()
+        mlat_tracker = coordinator.mlat_tracker
+        if mlat_tracker.max_pending:
+            fill = max(fill, len(mlat_tracker.pending) / mlat_tracker.max_pending)
+        return fill
+
+    @staticmethod
+    def _level_for(value, thresholds, scale=1.0):
+        level = 0
+        for i, threshold in enumerate(thresholds):
+            if value >= threshold * scale:
+                level = i + 1
+        return level
+
+    def evaluate(self, now):
+        lag = self.coordinator.loop_monitor.recent_lag()
+        fill = self._fill()
+        self.last_lag = lag
+        self.last_fill = fill
+
+        up = max(self._level_for(lag, self.lag_thresholds),
+                 self._level_for(fill, self.queue_thresholds))
+        down = max(self._level_for(lag, self.lag_thresholds, 0.5),
+                   self._level_for(fill, self.queue_thresholds, 0.5))
+
+        if up > self.level:
+            self.low_since = None
+            self._change(self.level + 1, now, lag, fill)
+        elif down < self.level:
+            if self.low_since is None:
+                self.low_since = now
+            elif (now - self.low_since) >= self.hold_time:
+                # the next step down needs another hold_time of low load
+                self.low_since = now
+                self._change(self.level - 1, now, lag, fill)
+        else:
+            self.low_since = None
+
+    def _change(self, level, now, lag, fill):
+        glogger.warning("Overload level {old} -> {new} ({name}), loop lag {lag:.0f}ms, queues {fill:.0f}% full".format(
+            old=self.level,
+            new=level,
+            name=LEVELS[level],
+            lag=lag * 1e3,
+            fill=fill * 100))
+
+        self.level = level
+        self.last_change = now
+        self.transitions += 1
+        self._apply(level)
+
+    def _apply(self, level):
+        mlat_tracker = self.coordinator.mlat_tracker
+        clock_tracker = self.coordinator.clock_tracker
+
+        mlat_tracker.skip_kalman = (level >= 1)
+        mlat_tracker.min_dof = 1 if level >= 2 else 0
+        clock_tracker.skip_converged_sync = (level >= 3)
+        mlat_tracker.reject_new_groups = (level >= 4)
+
+    def dump_state(self):
+        return {'level': self.level,
+                'name': LEVELS[self.level],
+                'since': round(timebase.monotonic() - self.last_change, 1),
+                'lag': round(self.last_lag, 4),
+                'fill': round(self.last_fill, 3),
+                'transitions': self.transitions,
+                'time_at_level': {name: round(t, 1) for name, t in zip(LEVELS, self.time_at_level)}}
+
+    def collect_metrics(self):
+        yield metrics.gauge('overload_level', 'Current load shedding level (0 = normal)', self.level)
+        yield metrics.counter('overload_transitions_total', 'Changes of load shedding level', self.transitions)
+        yield metrics.Metric('overload_seconds_total', 'counter', 'Time spent at each load shedding level',
+                             [('', {'level': name}, t) for name, t in zip(LEVELS, self.time_at_level)])
@@ -0,0 +1,824 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A synthetic load generator for testing and benchmarking.
+
+Simulated receivers with realistic clocks watch simulated aircraft flying
+straight-line trajectories. The aircraft transmit DF17 airborne positions
+(used for clock synchronization) and DF4/DF11 replies (used for
+multilateration), with valid CRCs. Each receiver reports what it hears,
+timestamped by its own drifting, jittery clock, either directly into a
+coordinator in the same process or to a running server over the client
+protocol. Results are compared with the true aircraft positions.
+
+  python3 -m mlat.server.simulator --receivers 50 --aircraft 100 --duration 300
+  python3 -m mlat.server.simulator --connect localhost:40147 --udp
+"""
+
+import asyncio
+import binascii
+import json
+import logging
+import math
+import operator
+import random
+import struct
+import time
+
+import numpy
+
+import modes.altitude
+import modes.cpr
+import modes.crc
+from mlat import geodesy, constants
+from mlat.server import clocksync, timebase
+
+__all__ = ('SimReceiver', 'SimAircraft', 'Simulation', 'AccuracyStats',
+           'InProcessDriver', 'NetworkDriver',
+           'encode_airborne_position', 'encode_altitude_reply', 'encode_all_call_reply')
+
+glogger = logging.getLogger("simulator")
+
+# event kinds
+SYNC = 1
+MLAT = 2
+
+
+def _with_parity(payload, address=0):
+    """Append Mode S parity to a payload. For Address/Parity messages, pass the
+    aircraft address so that the CRC residual is the address."""
+
+    message = bytearray(payload)
+    message.extend(b'\x00\x00\x00')
+    message[-3:] = (modes.crc.residual(message) ^ address).to_bytes(3, 'big')
+    return bytes(message)
+
+
+def encode_airborne_position(address, lat, lon, alt, odd):
+    """Return a DF17 airborne position message (type code 11, NUCp 7)."""
+
+    ac12 = modes.altitude.encode_ac12(alt)
+    cpr_lat, cpr_lon = modes.cpr.encode(lat, lon, odd)
+    return _with_parity(bytes((
+        (17 << 3) | 5,
+        (address >> 16) & 0xff,
+        (address >> 8) & 0xff,
+        address & 0xff,
+        11 << 3,
+        ac12 >> 4,
+        ((ac12 & 0x0f) << 4) | (0x04 if odd else 0) | (cpr_lat >> 15),
+        (cpr_lat >> 7) & 0xff,
+        ((cpr_lat & 0x7f) << 1) | (cpr_lon >> 16),
+        (cpr_lon >> 8) & 0xff,
+        cpr_lon & 0xff)))
+
+
+def encode_altitude_reply(address, alt):
+    """Return a DF4 altitude reply with Address/Parity."""
+
+    ac13 = modes.altitude.encode_ac13(alt)
+    return _with_parity(bytes((4 << 3, 0, ac13 >> 8, ac13 & 0xff)), address)
+
+
+def encode_all_call_reply(address):
+    """Return a DF11 all-call reply / acquisition squitter."""
+
+    return _with_parity(bytes((
+        (11 << 3) | 5,
+        (address >> 16) & 0xff,
+        (address >> 8) & 0xff,
+        address & 0xff)))
+
+
+def _hex(message):
+    return binascii.hexlify(message).decode('ascii')
+
+
+def _schedule(phase, interval, t0, t1):
+    """Yield (index, time) for each time phase + k*interval in [t0, t1)."""
+
+    k = max(0, math.ceil((t0 - phase) / interval))
+    t = phase + k * interval
+    while t < t1:
+        yield k, t
+        k += 1
+        t = phase + k * interval
+
+
+class SimReceiver(object):
+    """A simulated receiver at a fixed position, with its own clock."""
+
+    def __init__(self, uuid, position_llh, clock_type='dump1090', drift=None, jitter=None,
+                 max_range=300e3, rng=random):
+        """uuid: the receiver's name
+        position_llh: (latitude, longitude, altitude) of the receiver
+        clock_type: a clock type known to clocksync.make_clock
+        drift: relative frequency error of the clock; by default a random
+          value within the clock's nominal frequency error
+        jitter: standard deviation of timestamp errors, in seconds; by
+          default the clock's nominal jitter
+        max_range: the furthest aircraft the receiver can hear, in metres
+        """
+
+        self.uuid = uuid
+        self.position_llh = position_llh
+        self.ecef = geodesy.llh2ecef(position_llh)
+        self.clock_type = clock_type
+        self.clock = clocksync.make_clock(clock_type)
+        self.max_range = max_range
+        self.rng = rng
+
+        if self.clock.epoch is not None:
+            # GPS-disciplined: no drift, no arbitrary offset
+            self.drift = 0.0 if drift is None else drift
+            self.offset = None
+        else:
+            self.drift = rng.uniform(-0.5, 0.5) * self.clock.max_freq_error if drift is None else drift
+            self.offset = rng.uniform(0, 2**32)
+        self.jitter = self.clock.jitter if jitter is None else jitter
+
+    def timestamp(self, t, utc_base):
+        """Return the timestamp, in clock ticks, that this receiver's clock
+        assigns to a message arriving at simulation time t."""
+
+        if self.offset is None:
+            # ticks since UTC midnight; utc_base is reduced first to keep precision
+            seconds = math.fmod(utc_base, 86400.0) + t
+            ticks = seconds * self.clock.freq
+        else:
+            ticks = self.offset + t * self.clock.freq * (1.0 + self.drift)
+
+        return int(round(ticks + self.rng.gauss(0.0, self.jitter) * self.clock.freq))
+
+
+class SimAircraft(object):
+    """A simulated aircraft flying a straight, constant-speed trajectory."""
+
+    def __init__(self, address, position_llh, heading, speed, vertical_rate=0.0, adsb=True):
+        """address: 24-bit ICAO address
+        position_llh: (latitude, longitude, altitude in metres) at simulation time 0
+        heading: track in degrees
+        speed: ground speed in m/s
+        vertical_rate: climb rate in m/s
+        adsb: True if the aircraft transmits DF17 positions
+        """
+
+        self.address = address
+        self.position_llh = position_llh
+        self.heading = heading
+        self.speed = speed
+        self.vertical_rate = vertical_rate
+        self.adsb = adsb
+
+        self._north = speed * math.cos(heading * constants.DTOR)
+        self._east = speed * math.sin(heading * constants.DTOR)
+        self._coslat = math.cos(position_llh[0] * constants.DTOR)
+
+        # set by the simulation
+        self.phases = None
+        self.pending_even = {}
+        self.visible = numpy.zeros(0, dtype=int)
+
+    def position(self, t):
+        """Return the (lat, lon, alt) position at simulation time t."""
+
+        lat0, lon0, alt0 = self.position_llh
+        lat = lat0 + (self._north * t / geodesy.SPHERICAL_R) * constants.RTOD
+        lon = lon0 + (self._east * t / (geodesy.SPHERICAL_R * self._coslat)) * constants.RTOD
+        alt = min(13000.0, max(150.0, alt0 + self.vertical_rate * t))
+        return (lat, lon, alt)
+
+    def ecef(self, t):
+        return geodesy.llh2ecef(self.position(t))
+
+
+class Simulation(object):
+    """Generates the messages heard by a set of receivers from a set of aircraft.
+
+    The simulation runs in fixed steps; each call to events() covers the next
+    interval of simulation time. Transmission schedules are fixed per
+    aircraft, so a given seed always produces the same traffic."""
+
+    def __init__(self, receivers, aircraft, seed=None, utc_base=None,
+                 position_interval=0.5, squitter_interval=1.0, reply_interval=1.0,
+                 visibility_interval=5.0):
+        """receivers: list of SimReceiver
+        aircraft: list of SimAircraft
+        seed: random seed for transmission phases and timestamp noise
+        utc_base: the UTC time corresponding to simulation time 0
+        position_interval: time between DF17 positions (alternating even/odd)
+        squitter_interval: time between DF11 squitters
+        reply_interval: time between DF4 altitude replies
+        visibility_interval: how often to recompute which receivers can hear
+          which aircraft
+        """
+
+        self.receivers = receivers
+        self.aircraft = aircraft
+        self.rng = random.Random(seed)
+        self.utc_base = timebase.time() if utc_base is None else utc_base
+        self.position_interval = position_interval
+        self.squitter_interval = squitter_interval
+        self.reply_interval = reply_interval
+        self.visibility_interval = visibility_interval
+
+        self._receiver_ecef = numpy.array([r.ecef for r in receivers], dtype=float).reshape((-1, 3))
+        self._receiver_range = numpy.array([r.max_range for r in receivers], dtype=float)
+        self._by_address = {ac.address: ac for ac in aircraft}
+        self._next_visibility = 0.0
+        self.tracking = [set() for r in receivers]    # receiver index -> visible addresses
+        self._tracking_changes = {}                   # receiver index -> (added, removed)
+
+        for ac in aircraft:
+            ac.phases = (self.rng.uniform(0, position_interval),
+                         self.rng.uniform(0, squitter_interval),
+                         self.rng.uniform(0, reply_interval))
+
+    @classmethod
+    def random(cls, receiver_count, aircraft_count, center=(51.5, -0.5), radius=250e3,
+               adsb_fraction=0.5, clock_types=('dump1090', 'beast', 'radarcape_gps'),
+               max_range=300e3, seed=None, **kwargs):
+        """Build a simulation with receivers and aircraft scattered randomly
+        within radius metres of center."""
+
+        rng = random.Random(seed)
+
+        def scatter(alt_range):
+            r = radius * math.sqrt(rng.random())
+            bearing = rng.uniform(0, 2 * math.pi)
+            lat = center[0] + (r * math.cos(bearing) / geodesy.SPHERICAL_R) * constants.RTOD
+            lon = center[1] + (r * math.sin(bearing) /
+                               (geodesy.SPHERICAL_R * math.cos(center[0] * constants.DTOR))) * constants.RTOD
+            return (lat, lon, rng.uniform(*alt_range))
+
+        receivers = [SimReceiver(uuid='sim{0:05d}'.format(i),
+                                 position_llh=scatter((0, 300)),
+                                 clock_type=rng.choice(clock_types),
+                                 max_range=max_range,
+                                 rng=random.Random(rng.random()))
+                     for i in range(receiver_count)]
+
+        addresses = rng.sample(range(0x100000, 0xf00000), aircraft_count)
+        aircraft = [SimAircraft(address=address,
+                                position_llh=scatter((1000, 12000)),
+                                heading=rng.uniform(0, 360),
+                                speed=rng.uniform(100, 250),
+                                vertical_rate=rng.choice((0.0, 0.0, 5.0, -5.0)),
+                                adsb=(rng.random() < adsb_fraction))
+                    for address in addresses]
+
+        return cls(receivers, aircraft, seed=rng.random(), **kwargs)
+
+    def truth(self, address, t):
+        """Return the true ECEF position of an aircraft at simulation time t,
+        or None if there is no such aircraft."""
+
+        ac = self._by_address.get(address)
+        if ac is None:
+            return None
+        return ac.ecef(t)
+
+    def _update_visibility(self, t):
+        new_tracking = [set() for r in self.receivers]
+        for ac in self.aircraft:
+            distance = numpy.sqrt(((self._receiver_ecef - ac.ecef(t)) ** 2).sum(axis=1))
+            ac.visible = numpy.nonzero(distance < self._receiver_range)[0]
+            for i in ac.visible:
+                new_tracking[i].add(ac.address)
+
+        for i, (old, new) in enumerate(zip(self.tracking, new_tracking)):
+            added = new - old
+            removed = old - new
+            if added or removed:
+                prev_added, prev_removed = self._tracking_changes.get(i, (set(), set()))
+                self._tracking_changes[i] = ((prev_added - removed) | added,
+                                             (prev_removed - added) | removed)
+
+        self.tracking = new_tracking
+
+    def tracking_changes(self):
+        """Return a dict of receiver index -> (added addresses, removed
+        addresses) for changes since the last call."""
+
+        changes = self._tracking_changes
+        self._tracking_changes = {}
+        return changes
+
+    def rate_report(self, index):
+        """Return the ADS-B position rates that receiver index would report."""
+
+        rate = 1.0 / self.position_interval
+        return {address: rate for address in self.tracking[index] if self._by_address[address].adsb}
+
+    def _arrivals(self, ac, t):
+        """Return a list of (receiver index, arrival time) for a transmission at time t."""
+
+        visible = ac.visible
+        if len(visible) == 0:
+            return ()
+
+        distance = numpy.sqrt(((self._receiver_ecef[visible] - ac.ecef(t)) ** 2).sum(axis=1))
+        return zip(visible.tolist(), (t + distance / constants.Cair).tolist())
+
+    def events(self, t0, t1):
+        """Return a list of the events that arrive at receivers as a result of
+        transmissions in simulation time [t0, t1), ordered by arrival time.
+
+        Each event is a tuple (arrival time, receiver index, address, kind, args)
+        where kind is SYNC with args (even time, odd time, even message, odd message),
+        or MLAT with args (timestamp, message)."""
+
+        if t0 >= self._next_visibility:
+            self._update_visibility(t0)
+            self._next_visibility = t0 + self.visibility_interval
+
+        receivers = self.receivers
+        utc_base = self.utc_base
+        events = []
+
+        for ac in self.aircraft:
+            address = ac.address
+            position_phase, squitter_phase, reply_phase = ac.phases
+
+            if ac.adsb:
+                for k, t in _schedule(position_phase, self.position_interval, t0, t1):
+                    lat, lon, alt = ac.position(t)
+                    odd = bool(k & 1)
+                    message = encode_airborne_position(address, lat, lon, alt * constants.MTOF, odd)
+                    if not odd:
+                        ac.pending_even = pending = {}
+                        for i, arrival in self._arrivals(ac, t):
+                            pending[i] = (receivers[i].timestamp(arrival, utc_base), message)
+                    else:
+                        pending = ac.pending_even
+                        ac.pending_even = {}
+                        for i, arrival in self._arrivals(ac, t):
+                            even = pending.get(i)
+                            if even is not None:
+                                events.append((arrival, i, address, SYNC,
+                                               (even[0], receivers[i].timestamp(arrival, utc_base),
+                                                even[1], message)))
+
+            for k, t in _schedule(squitter_phase, self.squitter_interval, t0, t1):
+                message = encode_all_call_reply(address)
+                for i, arrival in self._arrivals(ac, t):
+                    events.append((arrival, i, address, MLAT,
+                                   (receivers[i].timestamp(arrival, utc_base), message)))
+
+            for k, t in _schedule(reply_phase, self.reply_interval, t0, t1):
+                message = encode_altitude_reply(address, ac.position(t)[2] * constants.MTOF)
+                for i, arrival in self._arrivals(ac, t):
+                    events.append((arrival, i, address, MLAT,
+                                   (receivers[i].timestamp(arrival, utc_base), message)))
+
+        events.sort(key=operator.itemgetter(0))
+        return events
+
+
+class AccuracyStats(object):
+    """Compares multilateration results against the simulation's truth."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.errors = []
+        self.unknown = 0
+
+    def add(self, utc, address, ecef):
+        truth = self.simulation.truth(address, utc - self.simulation.utc_base)
+        if truth is None:
+            self.unknown += 1
+        else:
+            self.errors.append(geodesy.ecef_distance(truth, ecef))
+
+    def summary(self):
+        result = {'results': len(self.errors) + self.unknown,
+                  'unknown': self.unknown}
+        if self.errors:
+            ordered = sorted(self.errors)
+            last = len(ordered) - 1
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                result[name] = round(ordered[min(last, int(fraction * len(ordered)))], 1)
+            result['max'] = round(ordered[-1], 1)
+        return result
+
+
+class _Driver(object):
+    """Common pacing logic for the drivers."""
+
+    def __init__(self, simulation, speed=1.0, step=0.1, rate_report_interval=30.0):
+        self.simulation = simulation
+        self.speed = speed
+        self.step = step
+        self.rate_report_interval = rate_report_interval
+        self.accuracy = AccuracyStats(simulation)
+        self.sync_count = 0
+        self.mlat_count = 0
+
+    @asyncio.coroutine
+    def run(self, duration):
+        """Run the simulation for duration seconds of simulation time.
+        If speed is None, run as fast as possible."""
+
+        loop = asyncio.get_event_loop()
+        yield from self._connect()
+        try:
+            start = loop.time()
+            next_rate_report = 0.0
+            t = 0.0
+            while t < duration:
+                if self.speed is not None:
+                    delay = start + t / self.speed - loop.time()
+                    yield from asyncio.sleep(max(0.0, delay))
+                else:
+                    yield from asyncio.sleep(0)
+
+                # generating events also updates what each receiver can see
+                events = self.simulation.events(t, t + self.step)
+
+                for i, (added, removed) in self.simulation.tracking_changes().items():
+                    self._tracking(i, added, removed)
+
+                if t >= next_rate_report:
+                    for i in range(len(self.simulation.receivers)):
+                        self._rate_report(i, self.simulation.rate_report(i))
+                    next_rate_report = t + self.rate_report_interval
+
+                self._deliver(events)
+                t += self.step
+        finally:
+            self._disconnect()
+
+    @asyncio.coroutine
+    def _connect(self):
+        raise NotImplementedError
+
+    def _disconnect(self):
+        raise NotImplementedError
+
+    def _tracking(self, index, added, removed):
+        raise NotImplementedError
+
+    def _rate_report(self, index, report):
+        raise NotImplementedError
+
+    def _deliver(self, events):
+        raise NotImplementedError
+
+
+class _SimConnection(object):
+    """Connection (see connection.Connection) for an in-process simulated receiver."""
+
+    def __init__(self):
+        self.wanted = set()
+
+    def request_traffic(self, receiver, start_set, stop_set):
+        self.wanted.update(start_set)
+        self.wanted.difference_update(stop_set)
+
+    def report_mlat_position(self, receiver,
+                             receive_timestamp, address, ecef, ecef_cov, receivers, distinct,
+                             dof, kalman_state, result_cache):
+        pass
+
+
+class InProcessDriver(_Driver):
+    """Feeds a simulation directly into a coordinator running in this process.
+
+    Like a real client, each receiver only reports traffic for aircraft that
+    the coordinator has asked for."""
+
+    def __init__(self, coordinator, simulation, **kwargs):
+        super().__init__(simulation, **kwargs)
+        self.coordinator = coordinator
+        self.connections = []
+        self.handles = []
+
+    def _result(self, receive_timestamp, address, ecef, *args):
+        self.accuracy.add(receive_timestamp, address, ecef)
+
+    @asyncio.coroutine
+    def _connect(self):
+        self.simulation.utc_base = timebase.time()
+        self.coordinator.add_output_handler(self._result)
+        for r in self.simulation.receivers:
+            connection = _SimConnection()
+            handle = self.coordinator.new_receiver(connection=connection,
+                                                   uuid=r.uuid,
+                                                   user=r.uuid,
+                                                   auth=None,
+                                                   position_llh=r.position_llh,
+                                                   clock_type=r.clock_type,
+                                                   privacy=False,
+                                                   connection_info='simulator')
+            self.connections.append(connection)
+            self.handles.append(handle)
+
+    def _disconnect(self):
+        for handle in self.handles:
+            self.coordinator.receiver_disconnect(handle)
+        self.handles = []
+        self.connections = []
+        self.coordinator.remove_output_handler(self._result)
+
+    def _tracking(self, index, added, removed):
+        if added:
+            self.coordinator.receiver_tracking_add(self.handles[index], added)
+        if removed:
+            self.coordinator.receiver_tracking_remove(self.handles[index], removed)
+
+    def _rate_report(self, index, report):
+        self.coordinator.receiver_rate_report(self.handles[index], report)
+
+    def _deliver(self, events):
+        coordinator = self.coordinator
+        handles = self.handles
+        connections = self.connections
+        utc_base = self.simulation.utc_base
+
+        for arrival, i, address, kind, args in events:
+            if address not in connections[i].wanted:
+                continue
+
+            if kind == SYNC:
+                coordinator.receiver_sync(handles[i], *args)
+                self.sync_count += 1
+            else:
+                timestamp, message = args
+                coordinator.receiver_mlat(handles[i], timestamp, message, utc_base + arrival)
+                self.mlat_count += 1
+
+
+class _SimClient(object):
+    """One simulated receiver's connection to a server."""
+
+    def __init__(self, driver, receiver):
+        self.driver = driver
+        self.receiver = receiver
+        self.reader = None
+        self.writer = None
+        self.udp_transport = None
+        self.udp_key = None
+        self.udp_seq = 0
+        self.wanted = set()
+        self.task = None
+
+    @asyncio.coroutine
+    def connect(self, host, port, use_udp):
+        self.reader, self.writer = yield from asyncio.open_connection(host, port)
+        lat, lon, alt = self.receiver.position_llh
+        self.send(version=3,
+                  user=self.receiver.uuid,
+                  lat=lat,
+                  lon=lon,
+                  alt=alt,
+                  clock_type=self.receiver.clock_type,
+                  client_version='simulator',
+                  compress=['none'],
+                  udp_transport=2 if use_udp else 0,
+                  return_results=True,
+                  return_result_format='ecef')
+
+        response = json.loads((yield from self.reader.readline()).decode('ascii'))
+        if 'deny' in response:
+            raise ValueError('{0}: server denied connection: {1}'.format(self.receiver.uuid, response['deny']))
+
+        if 'udp_transport' in response:
+            udp_host, udp_port, self.udp_key = response['udp_transport']
+            self.udp_transport, protocol = yield from asyncio.get_event_loop().create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(udp_host or host, udp_port))
+
+        self.task = asyncio.async(self.read_messages())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def send(self, **kwargs):
+        self.writer.write((json.dumps(kwargs) + '\n').encode('ascii'))
+
+    @asyncio.coroutine
+    def read_messages(self):
+        while True:
+            line = yield from self.reader.readline()
+            if not line:
+                glogger.warning("{0}: server closed the connection".format(self.receiver.uuid))
+                return
+
+            msg = json.loads(line.decode('ascii'))
+            if 'start_sending' in msg:
+                self.wanted.update(int(icao, 16) for icao in msg['start_sending'])
+            if 'stop_sending' in msg:
+                self.wanted.difference_update(int(icao, 16) for icao in msg['stop_sending'])
+            if 'result' in msg:
+                self.driver.result(msg['result'])
+
+    def send_udp(self, items):
+        """Send (kind, args) items in as few datagrams as possible."""
+
+        header = struct.Struct('>IHQ')
+        packet = None
+        base = None
+
+        for kind, args in items:
+            if packet is None:
+                base = args[0]
+                packet = [header.pack(self.udp_key, self.udp_seq, base)]
+                size = header.size
+                self.udp_seq = (self.udp_seq + 1) & 0xffff
+
+            if kind == SYNC:
+                et, ot, em, om = args
+                if abs(et - base) < 2**31 and abs(ot - base) < 2**31:
+                    packet.append(b'\x01' + struct.pack('>ii14s14s', et - base, ot - base, em, om))
+                else:
+                    packet.append(b'\x06' + struct.pack('>QQ14s14s', et, ot, em, om))
+            else:
+                t, m = args
+                if abs(t - base) >= 2**31:
+                    base = t
+                    packet.append(b'\x05' + struct.pack('>Q', base))
+                packet.append((b'\x02' if len(m) == 7 else b'\x03') + struct.pack('>i', t - base) + m)
+
+            size += len(packet[-1])
+            if size > 1400:
+                self.udp_transport.sendto(b''.join(packet))
+                packet = None
+
+        if packet is not None:
+            self.udp_transport.sendto(b''.join(packet))
+
+
+class NetworkDriver(_Driver):
+    """Connects each simulated receiver to a running server over the JSON
+    client protocol, optionally sending sync and mlat messages over UDP.
+
+    The server timestamps messages with its own clock, so this driver only
+    runs at real-time speed."""
+
+    def __init__(self, host, port, simulation, use_udp=False, **kwargs):
+        kwargs['speed'] = 1.0
+        super().__init__(simulation, **kwargs)
+        self.host = host
+        self.port = port
+        self.use_udp = use_udp
+        self.clients = []
+        self._seen_results = set()
+
+    def result(self, result):
+        # each result is sent to every receiver that contributed to it
+        key = (result['addr'], result['@'])
+        if key in self._seen_results:
+            return
+        if len(self._seen_results) > 100000:
+            self._seen_results.clear()
+        self._seen_results.add(key)
+
+        self.accuracy.add(result['@'], int(result['addr'], 16), result['ecef'])
+
+    @asyncio.coroutine
+    def _connect(self):
+        for r in self.simulation.receivers:
+            client = _SimClient(self, r)
+            yield from client.connect(self.host, self.port, self.use_udp)
+            self.clients.append(client)
+
+        # the server's clock defines UTC for results
+        self.simulation.utc_base = time.time()
+
+    def _disconnect(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+
+    def _tracking(self, index, added, removed):
+        client = self.clients[index]
+        if added:
+            client.send(seen=['{0:06x}'.format(a) for a in added])
+        if removed:
+            client.send(lost=['{0:06x}'.format(a) for a in removed])
+
+    def _rate_report(self, index, report):
+        self.clients[index].send(rate_report={'{0:06x}'.format(a): rate for a, rate in report.items()})
+
+    def _deliver(self, events):
+        udp_items = {}
+        for arrival, i, address, kind, args in events:
+            client = self.clients[i]
+            if address not in client.wanted:
+                continue
+
+            if kind == SYNC:
+                self.sync_count += 1
+            else:
+                self.mlat_count += 1
+
+            if client.udp_transport is not None:
+                udp_items.setdefault(client, []).append((kind, args))
+            elif kind == SYNC:
+                et, ot, em, om = args
+                client.send(sync={'et': et, 'ot': ot, 'em': _hex(em), 'om': _hex(om)})
+            else:
+                t, m = args
+                client.send(mlat={'t': t, 'm': _hex(m)})
+
+        for client, items in udp_items.items():
+            client.send_udp(items)
+
+
+def main():
+    import argparse
+    import tempfile
+    from mlat.server import coordinator as coordinator_module
+
+    def hostport(s):
+        host, sep, port = s.rpartition(':')
+        return (host or 'localhost', int(port))
+
+    parser = argparse.ArgumentParser(description="Generate synthetic receiver traffic.")
+    parser.add_argument('--receivers', type=int, default=50, help="number of simulated receivers")
+    parser.add_argument('--aircraft', type=int, default=100, help="number of simulated aircraft")
+    parser.add_argument('--adsb-fraction', type=float, default=0.5,
+                        help="fraction of aircraft that transmit ADS-B positions")
+    parser.add_argument('--clock-types', default='dump1090,beast,radarcape_gps',
+                        help="comma-separated clock types to assign to receivers")
+    parser.add_argument('--radius', type=float, default=250.0,
+                        help="radius of the simulated area, in km")
+    parser.add_argument('--duration', type=float, default=300.0,
+                        help="simulation time to run for, in seconds")
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="in-process mode: run at this multiple of real time")
+    parser.add_argument('--fast', action='store_true', default=False,
+                        help="in-process mode: run as fast as possible")
+    parser.add_argument('--virtual-time', action='store_true', default=False,
+                        help="in-process mode: run on a virtual clock, as fast as possible with real-time behaviour")
+    parser.add_argument('--connect', type=hostport, default=None,
+                        help="connect to a server at [host:]port instead of running in-process")
+    parser.add_argument('--udp', action='store_true', default=False,
+                        help="with --connect, send sync and mlat messages over UDP")
+    parser.add_argument('--work-dir', default=None,
+                        help="in-process mode: directory for state files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.virtual_time and not args.connect:
+        loop = timebase.use_virtual_time()
+    else:
+        loop = asyncio.get_event_loop()
+
+    simulation = Simulation.random(args.receivers, args.aircraft,
+                                   radius=args.radius * 1e3,
+                                   adsb_fraction=args.adsb_fraction,
+                                   clock_types=args.clock_types.split(','),
+                                   seed=args.seed)
+
+    coordinator = None
+    if args.connect:
+        driver = NetworkDriver(args.connect[0], args.connect[1], simulation, use_udp=args.udp)
+    else:
+        coordinator = coordinator_module.Coordinator(work_dir=args.work_dir or tempfile.mkdtemp(prefix='mlat-sim-'))
+        loop.run_until_complete(coordinator.start())
+        driver = InProcessDriver(coordinator, simulation, speed=None if args.fast else args.speed)
+
+    start = time.monotonic()
+    loop.run_until_complete(driver.run(args.duration))
+    elapsed = time.monotonic() - start
+
+    if coordinator is not None:
+        coordinator.close()
+        loop.run_until_complete(coordinator.wait_closed())
+
+    summary = {'receivers': args.receivers,
+               'aircraft': args.aircraft,
+               'duration': args.duration,
+               'elapsed': round(elapsed, 2),
+               'sync': driver.sync_count,
+               'mlat': driver.mlat_count,
+               'messages_per_second': round((driver.sync_count + driver.mlat_count) / elapsed, 1),
+               'accuracy': driver.accuracy.summary()}
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
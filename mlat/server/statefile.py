@@ -0,0 +1,78 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Atomic, compact writer for the JSON state files in the work directory.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from contextlib import closing
+
+__all__ = ('StateFileWriter',)
+
+glogger = logging.getLogger("statefile")
+
+
+class StateFileWriter(object):
+    """Serializes snapshots of server state to JSON files.
+
+    write() is intended to be run in a worker thread: it only touches the
+    snapshot it is given and this object's own state. Files are written to
+    a temporary file and then renamed into place, so readers never see a
+    partially written file.
+
+    The most recent serialized form of each file is kept in self.bodies as
+    a (body, digest) tuple, which the HTTP status listener serves instead of
+    serializing the state again. Entries are replaced whole, so a reader on
+    another thread always sees a matching body and digest.
+    """
+
+    def __init__(self, directory, skip_unchanged=False):
+        """directory: the directory to write files to
+        skip_unchanged: if True, don't rewrite a file if its contents have not changed
+        """
+
+        self.directory = directory
+        self.skip_unchanged = skip_unchanged
+        self.bodies = {}
+        self._written = {}
+
+    def write(self, snapshot):
+        """Write a snapshot, which is a dict of filename -> JSON-serializable object."""
+
+        for name, state in snapshot.items():
+            try:
+                body = json.dumps(state, separators=(',', ':')).encode('ascii')
+                digest = hashlib.sha1(body).hexdigest()
+                self.bodies[name] = (body, digest)
+
+                if self.skip_unchanged and self._written.get(name) == digest:
+                    continue
+
+                path = os.path.join(self.directory, name)
+                temp_path = path + '.tmp'
+                with closing(open(temp_path, 'wb')) as f:
+                    f.write(body)
+                os.replace(temp_path, path)
+                self._written[name] = digest
+
+            except Exception:
+                glogger.exception("Failed to write {name}".format(name=name))
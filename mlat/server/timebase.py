@@ -0,0 +1,131 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-server: a Mode S multilateration server
+# Copyright (C) 2015  Oliver Jowett <oliver@mutability.co.uk>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The server's clock and timer scheduling.
+
+Server code reads the current time and schedules timers through this
+module, rather than using the time module or the event loop directly, so
+that offline runs (replays, simulations) can substitute a virtual clock
+that skips over idle periods.
+
+Always call these through the module (timebase.monotonic()), never import
+the functions by name: use_virtual_time() replaces them.
+"""
+
+import asyncio
+import selectors
+import time as _time
+
+__all__ = ('monotonic', 'time', 'call_later', 'VirtualTimeEventLoop', 'use_virtual_time', 'use_real_time')
+
+# The current monotonic time, in seconds. Comparable with the event loop's time().
+monotonic = _time.monotonic
+
+# The current UTC time, in seconds since the epoch.
+time = _time.time
+
+
+def call_later(delay, callback, *args):
+    """Arrange for callback(*args) to be called after delay seconds; returns
+    a handle that can be cancelled."""
+    return asyncio.get_event_loop().call_later(delay, callback, *args)
+
+
+class _VirtualSelector(object):
+    """Wraps a real selector. Instead of blocking while waiting for a timer,
+    it polls for I/O and then advances the loop's virtual clock."""
+
+    def __init__(self, selector):
+        self._selector = selector
+        self._advance = None
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout is None:
+            # I/O is ready, or there are no timers at all
+            return events or self._selector.select(timeout)
+
+        if timeout > 0:
+            self._advance(timeout)
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """An event loop with a virtual clock.
+
+    Whenever the loop would wait for its next timer, the clock jumps forward
+    to that timer instead. Time does not advance while callbacks run, so
+    timer-driven behaviour is identical to a real-time run, just faster.
+
+    I/O is still polled, but is not waited for while timers are pending, so
+    this is only suitable for loops that are driven by timers, e.g. an
+    in-process simulation or replay.
+
+    utc: the initial virtual UTC time (default: the current time)."""
+
+    def __init__(self, utc=None):
+        self._now = _time.monotonic()
+        self._utc_offset = (_time.time() if utc is None else utc) - self._now
+
+        selector = _VirtualSelector(selectors.DefaultSelector())
+        super().__init__(selector=selector)
+        selector._advance = self.advance
+
+    def time(self):
+        return self._now
+
+    def utc(self):
+        """Return the virtual UTC time."""
+        return self._utc_offset + self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+
+def use_virtual_time(loop=None):
+    """Install a VirtualTimeEventLoop as the current event loop and use it as
+    the server's clock. Returns the loop."""
+
+    global monotonic, time
+
+    if loop is None:
+        loop = VirtualTimeEventLoop()
+    asyncio.set_event_loop(loop)
+
+    # futures belong to a particular loop, so util.completed_future (created
+    # at import time, on the default loop) must be replaced
+    from mlat.server import util
+    util.completed_future = asyncio.Future(loop=loop)
+    util.completed_future.set_result(True)
+
+    monotonic = loop.time
+    time = loop.utc
+    return loop
+
+
+def use_real_time():
+    """Go back to using the real clock."""
+
+    global monotonic, time
+
+    monotonic = _time.monotonic
+    time = _time.time
@@ -22,14 +22,19 @@ Works out the set of "interesting" aircraft and arranges for clients to
 send us traffic for these.
 """
 
-import asyncio
 from mlat import profile
-from mlat.server import kalman
+from mlat.server import kalman, timebase
 
 
 class TrackedAircraft(object):
     """A single tracked aircraft."""
 
+    __slots__ = ('icao', 'allow_mlat', 'tracking', 'sync_interest', 'mlat_interest', 'successful_mlat',
+                 'mlat_message_count', 'mlat_result_count', 'mlat_kalman_count',
+                 'altitude', 'last_altitude_time',
+                 'last_result_time', 'last_result_position', 'last_result_var', 'last_result_distinct',
+                 'last_result_dof', 'kalman', 'callsign', 'squawk')
+
     def __init__(self, icao, allow_mlat):
         # ICAO address of this aircraft
         self.icao = icao
@@ -75,6 +80,8 @@ class TrackedAircraft(object):
         self.last_result_var = None
         # last multilateration, distinct receivers
         self.last_result_distinct = None
+        # last multilateration, degrees of freedom
+        self.last_result_dof = None
         # kalman filter state
         self.kalman = kalman.KalmanStateCA(self.icao)
 
@@ -94,11 +101,41 @@ class Tracker(object):
     """Tracks which receivers can see which aircraft, and asks receivers to
     forward traffic accordingly."""
 
+    # how often to send updated traffic requests to receivers, seconds
+    traffic_request_interval = 15.0
+
     def __init__(self, partition):
         self.aircraft = {}
         self.partition_id = partition[0] - 1
         self.partition_count = partition[1]
 
+        # receivers whose interest sets have changed since the last
+        # traffic request flush
+        self.dirty_receivers = set()
+
+        # schedule periodic traffic request flushes
+        self._flush_handle = timebase.call_later(self.traffic_request_interval, self._flush_traffic_requests)
+
+    def close(self):
+        """Stop the periodic traffic request flushes."""
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    @profile.trackcpu
+    def _flush_traffic_requests(self):
+        """Called periodically to refresh the traffic requests of all
+        receivers that have been marked dirty since the last flush."""
+
+        self._flush_handle = timebase.call_later(self.traffic_request_interval, self._flush_traffic_requests)
+
+        dirty = self.dirty_receivers
+        self.dirty_receivers = set()
+        for receiver in dirty:
+            if not receiver.dead:
+                receiver.refresh_traffic_requests()
+
     def in_local_partition(self, icao):
         if self.partition_count == 1:
             return True
@@ -143,6 +180,7 @@ class Tracker(object):
         receiver.tracking.clear()
         receiver.sync_interest.clear()
         receiver.mlat_interest.clear()
+        self.dirty_receivers.discard(receiver)
 
     @profile.trackcpu
     def update_interest(self, receiver):
@@ -154,7 +192,7 @@ class Tracker(object):
             new_sync = {ac for ac in receiver.tracking if len(ac.tracking) > 1}
             new_mlat = {ac for ac in receiver.tracking if ac.allow_mlat}
             receiver.update_interest_sets(new_sync, new_mlat)
-            asyncio.get_event_loop().call_later(15.0, receiver.refresh_traffic_requests)
+            self.dirty_receivers.add(receiver)
             return
 
         # Work out the aircraft that are transmitting ADS-B that this
@@ -213,4 +251,4 @@ class Tracker(object):
                 new_mlat_set.add(ac)
 
         receiver.update_interest_sets(new_sync_set, new_mlat_set)
-        asyncio.get_event_loop().call_later(15.0, receiver.refresh_traffic_requests)
+        self.dirty_receivers.add(receiver)
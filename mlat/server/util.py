@@ -24,6 +24,8 @@ import random
 import asyncio
 import logging
 
+from mlat.server import timebase
+
 
 def fuzzy(t):
     return round(random.uniform(0.9*t, 1.1*t), 0)
@@ -57,6 +59,33 @@ class TaggingLogger(logging.LoggerAdapter):
             return (msg, kwargs)
 
 
+class TokenBucket(object):
+    """A token bucket rate limiter: allows an average of rate events per
+    second, with bursts of up to burst events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = timebase.monotonic()
+
+    def take(self):
+        """Take a token if one is available. Returns True if the event is allowed."""
+
+        now = timebase.monotonic()
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.last = now
+
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return True
+
+        self.tokens = tokens
+        return False
+
+
 def setproctitle(title):
     """Set the process title. This implementation does nothing."""
     pass
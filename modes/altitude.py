@@ -21,7 +21,7 @@ Decoders for the 12- and 13-bit altitude encodings used in Mode S responses
 and ADS-B extended squitter messages.
 """
 
-__all__ = ('decode_ac12', 'decode_ac13')
+__all__ = ('decode_ac12', 'decode_ac13', 'encode_ac12', 'encode_ac13')
 
 
 def _decode_ac13(ac13):
@@ -109,6 +109,26 @@ def decode_ac12(ac12):
     return _alt_table[((ac12 & 0x0fc0) << 1) | (ac12 & 0x003f)]
 
 
+def encode_ac13(alt):
+    """Encode an altitude in feet as a 13-bit AC field, using 25-foot
+    increments (Q bit set). The altitude is rounded to the nearest 25 feet.
+
+    Raises ValueError if the altitude is outside -1000 .. 50175 feet."""
+
+    n = int(round((alt + 1000) / 25.0))
+    if n < 0 or n > 0x7ff:
+        raise ValueError('altitude out of range for a 25-foot encoding')
+    return ((n & 0x7e0) << 2) | ((n & 0x010) << 1) | (n & 0x00f) | 0x0010
+
+
+def encode_ac12(alt):
+    """Encode an altitude in feet as a 12-bit AC field for an extended
+    squitter (see encode_ac13)."""
+
+    ac13 = encode_ac13(alt)
+    return ((ac13 & 0x1f80) >> 1) | (ac13 & 0x003f)
+
+
 def _make_table():
     # precompute the lookup table
     return [_decode_ac13(i) for i in range(2**13)]
@@ -17,14 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
-Decoder for the Compact Position Reporting (CPR) position encoding used in
-ADS-B extended squitter messages.
+Decoder (and encoder) for the Compact Position Reporting (CPR) position
+encoding used in ADS-B extended squitter messages.
 """
 
 import math
 import bisect
 
-__all__ = ['decode']
+__all__ = ['decode', 'encode']
 
 
 nl_table = (
@@ -155,3 +155,22 @@ def decode(latE, lonE, latO, lonO):
     rlonO -= math.floor((rlonO + 180) / 360) * 360
 
     return (rlatE, rlonE, rlatO, rlonO)
+
+
+def encode(lat, lon, odd):
+    """Encode a position as an airborne CPR message would.
+
+    lat, lon: the position to encode, in degrees
+    odd: True to produce an odd (F=1) encoding, False for even (F=0)
+
+    Return a tuple of (raw latitude, raw longitude), each 17 bits."""
+
+    i = 1 if odd else 0
+    dlat = 360.0 / (60 - i)
+    yz = math.floor(131072.0 * MOD(lat, dlat) / dlat + 0.5)
+    rlat = dlat * (yz / 131072.0 + math.floor(lat / dlat))
+
+    dlon = 360.0 / max(1, NL(rlat) - i)
+    xz = math.floor(131072.0 * MOD(lon, dlon) / dlon + 0.5)
+
+    return (yz & 0x1ffff, xz & 0x1ffff)
@@ -47,8 +47,47 @@ class ModeSMessage:
       squawk: decoded squawk, or None if not present
       crc_ok: True if the CRC is OK. False if it is bad. None if the correctness
         of the CRC cannot be checked (e.g. the messages uses AP or PI)
+
+    Where a message carries a callsign, it is decoded from the message buffer
+    when it is first read, so the buffer must not be modified after decoding.
+    Only such messages keep a reference to the buffer, and only until then.
+    All other fields are decoded eagerly.
     """
 
+    __slots__ = ('DF', 'address', 'altitude', 'squawk', 'crc_ok')
+
+    # overridden by messages that can carry a callsign
+    callsign = None
+
+
+# marks a lazily decoded field that has not been decoded yet
+_UNSET = object()
+
+
+def _decode_callsign(buf):
+    """Decode the 8-character callsign in bytes 5-10 of buf."""
+    return (
+        ais_charset[(buf[5] & 0xfc) >> 2] +
+        ais_charset[((buf[5] & 0x03) << 4) | ((buf[6] & 0xf0) >> 4)] +
+        ais_charset[((buf[6] & 0x0f) << 2) | ((buf[7] & 0xc0) >> 6)] +
+        ais_charset[buf[7] & 0x3f] +
+        ais_charset[(buf[8] & 0xfc) >> 2] +
+        ais_charset[((buf[8] & 0x03) << 4) | ((buf[9] & 0xf0) >> 4)] +
+        ais_charset[((buf[9] & 0x0f) << 2) | ((buf[10] & 0xc0) >> 6)] +
+        ais_charset[buf[10] & 0x3f]
+    )
+
+
+def _df11_crc_ok(r):
+    """crc_ok for a DF11 message with CRC residual r: the parity may be
+    overlaid with a nonzero interrogator code."""
+    if r == 0:
+        return True
+    elif (r & ~0x7f) == 0:
+        return None
+    else:
+        return False
+
 
 class DF0(ModeSMessage):
     """
@@ -57,6 +96,8 @@ class DF0(ModeSMessage):
     Fields: DF, VS, CC, SL, RI, AC, altitude, address
     """
 
+    __slots__ = ('VS', 'CC', 'SL', 'RI', 'AC')
+
     def __init__(self, frombuf):
         self.DF = (frombuf[0] & 0xf8) >> 3  # 5 bits
         self.VS = (frombuf[0] & 0x04) >> 2  # 1 bit
@@ -69,7 +110,7 @@ class DF0(ModeSMessage):
         self.AC = ((frombuf[2] & 0x1f) << 8) | frombuf[3]  # 13 bits
         # 24 bits A/P
 
-        self.squawk = self.callsign = None
+        self.squawk = None
         self.altitude = altitude.decode_ac13(self.AC)
         self.crc_ok = None
         self.address = crc.residual(frombuf)
@@ -82,6 +123,8 @@ class DF4(ModeSMessage):
     Fields: DF, FS, DR, UM, AC, altitude, address
     """
 
+    __slots__ = ('FS', 'DR', 'UM', 'AC')
+
     def __init__(self, frombuf):
         self.DF = (frombuf[0] & 0xf8) >> 3  # 5 bits
         self.FS = (frombuf[0] & 0x07)       # 3 bits
@@ -90,7 +133,7 @@ class DF4(ModeSMessage):
         self.AC = ((frombuf[2] & 0x1f) << 8) | frombuf[3]  # 13 bits
         # 24 bits A/P
 
-        self.squawk = self.callsign = None
+        self.squawk = None
         self.altitude = altitude.decode_ac13(self.AC)
         self.crc_ok = None
         self.address = crc.residual(frombuf)
@@ -103,6 +146,8 @@ class DF5(ModeSMessage):
     Fields: DF, FS, DR, UM, ID, squawk, address
     """
 
+    __slots__ = ('FS', 'DR', 'UM', 'ID')
+
     def __init__(self, frombuf):
         self.DF = (frombuf[0] & 0xf8) >> 3  # 5 bits
         self.FS = (frombuf[0] & 0x07)       # 3 bits
@@ -111,7 +156,7 @@ class DF5(ModeSMessage):
         self.ID = ((frombuf[2] & 0x1f) << 8) | frombuf[3]  # 13 bits
         # 24 bits A/P
 
-        self.altitude = self.callsign = None
+        self.altitude = None
         self.squawk = squawk.decode_id13(self.ID)
         self.crc_ok = None
         self.address = crc.residual(frombuf)
@@ -124,21 +169,16 @@ class DF11(ModeSMessage):
     Fields: DF, CA, AA, address, crc_ok
     """
 
+    __slots__ = ('CA', 'AA')
+
     def __init__(self, frombuf):
         self.DF = (frombuf[0] & 0xf8) >> 3  # 5 bits
         self.CA = (frombuf[0] & 0x07)       # 3 bits
         self.AA = (frombuf[1] << 16) | (frombuf[2] << 8) | frombuf[3]  # 24 bits
         # 24 bits P/I
 
-        self.squawk = self.callsign = self.altitude = None
-
-        r = crc.residual(frombuf)
-        if r == 0:
-            self.crc_ok = True
-        elif (r & ~0x7f) == 0:
-            self.crc_ok = None
-        else:
-            self.crc_ok = False
+        self.squawk = self.altitude = None
+        self.crc_ok = _df11_crc_ok(crc.residual(frombuf))
         self.address = self.AA
 
 
@@ -149,6 +189,8 @@ class DF16(ModeSMessage):
     Fields: DF, VS, SL, RI, AC, altitude, address
     """
 
+    __slots__ = ('VS', 'SL', 'RI', 'AC', 'MV')
+
     def __init__(self, frombuf):
         self.DF = (frombuf[0] & 0xf8) >> 3  # 5 bits
         self.VS = (frombuf[0] & 0x04) >> 2  # 1 bit
@@ -161,7 +203,7 @@ class DF16(ModeSMessage):
         self.MV = frombuf[4:11]  # 56 bits
         # 24 bits A/P
 
-        self.squawk = self.callsign = None
+        self.squawk = None
         self.altitude = altitude.decode_ac13(self.AC)
         self.crc_ok = None
         self.address = crc.residual(frombuf)
@@ -173,27 +215,26 @@ class CommB(ModeSMessage):
     Fields: MB, callsign
     """
 
+    __slots__ = ('MB', '_buf', '_callsign')
+
     def __init__(self, frombuf):
         self.MB = frombuf[4:11]  # 56 bits
-
-        if frombuf[4] != 0x20:
-            self.callsign = None
+        if frombuf[4] == 0x20:
+            self._buf = frombuf
+            self._callsign = _UNSET
         else:
-            callsign = (
-                ais_charset[(frombuf[5] & 0xfc) >> 2] +
-                ais_charset[((frombuf[5] & 0x03) << 4) | ((frombuf[6] & 0xf0) >> 4)] +
-                ais_charset[((frombuf[6] & 0x0f) << 2) | ((frombuf[7] & 0xc0) >> 6)] +
-                ais_charset[frombuf[7] & 0x3f] +
-                ais_charset[(frombuf[8] & 0xfc) >> 2] +
-                ais_charset[((frombuf[8] & 0x03) << 4) | ((frombuf[9] & 0xf0) >> 4)] +
-                ais_charset[((frombuf[9] & 0x0f) << 2) | ((frombuf[10] & 0xc0) >> 6)] +
-                ais_charset[frombuf[10] & 0x3f]
-            )
+            self._callsign = None
 
+    @property
+    def callsign(self):
+        if self._callsign is _UNSET:
+            callsign = _decode_callsign(self._buf)
             if callsign != '        ' and callsign.find('?') == -1:
-                self.callsign = callsign
+                self._callsign = callsign
             else:
-                self.callsign = None
+                self._callsign = None
+            del self._buf
+        return self._callsign
 
 
 class DF20(CommB):
@@ -203,6 +244,8 @@ class DF20(CommB):
     Fields: DF, FS, DR, UM, AC, altitude, address, MB, callsign
     """
 
+    __slots__ = ('FS', 'DR', 'UM', 'AC')
+
     def __init__(self, frombuf):
         CommB.__init__(self, frombuf)
 
@@ -227,6 +270,8 @@ class DF21(CommB):
     Fields: DF, FS, DR, UM, ID, squawk, address, MB, callsign
     """
 
+    __slots__ = ('FS', 'DR', 'UM', 'ID')
+
     def __init__(self, frombuf):
         CommB.__init__(self, frombuf)
 
@@ -288,6 +333,8 @@ class ExtendedSquitter(ModeSMessage):
     For id and category: CATEGORY, callsign
     """
 
+    __slots__ = ('estype', 'nuc', 'SS', 'SAF', 'AC12', 'T', 'F', 'LAT', 'LON', 'CATEGORY', '_buf', '_callsign')
+
     def __init__(self, frombuf):
         metype = (frombuf[4] & 0xf8) >> 3
         self.estype, self.nuc = es_types.get(metype, (ESType.other, None))
@@ -305,25 +352,24 @@ class ExtendedSquitter(ModeSMessage):
                         (frombuf[9] << 8) |
                         frombuf[10])
             self.altitude = altitude.decode_ac12(self.AC12)
-            self.callsign = None
+            self._callsign = None
 
         elif self.estype is ESType.id_and_category:
             self.CATEGORY = frombuf[4] & 0x07
             self.altitude = None
-            self.callsign = (
-                ais_charset[(frombuf[5] & 0xfc) >> 2] +
-                ais_charset[((frombuf[5] & 0x03) << 4) | ((frombuf[6] & 0xf0) >> 4)] +
-                ais_charset[((frombuf[6] & 0x0f) << 2) | ((frombuf[7] & 0xc0) >> 6)] +
-                ais_charset[frombuf[7] & 0x3f] +
-                ais_charset[(frombuf[8] & 0xfc) >> 2] +
-                ais_charset[((frombuf[8] & 0x03) << 4) | ((frombuf[9] & 0xf0) >> 4)] +
-                ais_charset[((frombuf[9] & 0x0f) << 2) | ((frombuf[10] & 0xc0) >> 6)] +
-                ais_charset[frombuf[10] & 0x3f]
-            )
+            self._buf = frombuf
+            self._callsign = _UNSET
 
         else:
             self.altitude = None
-            self.callsign = None
+            self._callsign = None
+
+    @property
+    def callsign(self):
+        if self._callsign is _UNSET:
+            self._callsign = _decode_callsign(self._buf)
+            del self._buf
+        return self._callsign
 
 
 class DF17(ExtendedSquitter):
@@ -332,6 +378,8 @@ class DF17(ExtendedSquitter):
     Fields: DF, CA, AA, address, crc_ok; plus those of ExtendedSquitter.
     """
 
+    __slots__ = ('CA', 'AA')
+
     def __init__(self, frombuf):
         ExtendedSquitter.__init__(self, frombuf)
 
@@ -352,6 +400,8 @@ class DF18(ExtendedSquitter):
     Fields: DF, CF, AA, address, crc_ok; plus those of ExtendedSquitter.
     """
 
+    __slots__ = ('CF', 'AA')
+
     def __init__(self, frombuf):
         ExtendedSquitter.__init__(self, frombuf)
 
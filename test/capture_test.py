@@ -0,0 +1,130 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from mlat.server import capture, coordinator, simulator, timebase
+
+
+def make_simulation():
+    return simulator.Simulation.random(6, 4, radius=50e3, adsb_fraction=1.0, seed=42)
+
+
+class CaptureRoundTripTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='mlat-capture-test-')
+        self.filename = os.path.join(self.tmpdir, 'capture.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def run_coordinator(self, feed):
+        """Run a fresh coordinator on a virtual clock, calling feed(coordinator)
+        to drive it. Returns (feed's result, results published)."""
+
+        loop = timebase.use_virtual_time()
+        try:
+            c = coordinator.Coordinator(work_dir='/nonexistent')
+            results = []
+            c.add_output_handler(lambda *args: results.append(args[:2]))
+            loop.run_until_complete(c.start())
+            value = loop.run_until_complete(feed(c))
+            # let pending groups resolve
+            loop.run_until_complete(asyncio.sleep(5.0))
+            c.close()
+            loop.run_until_complete(c.wait_closed())
+            return value, results
+        finally:
+            loop.close()
+
+    def record(self):
+        driver = []
+
+        @asyncio.coroutine
+        def feed(c):
+            recorder = capture.CaptureRecorder(c, self.filename)
+            recorder.start()
+            driver.append(simulator.InProcessDriver(c, make_simulation()))
+            try:
+                yield from driver[0].run(60.0)
+            finally:
+                recorder.close()
+            return recorder.record_count
+
+        record_count, results = self.run_coordinator(feed)
+        return driver[0], record_count, results
+
+    def test_read_capture(self):
+        driver, record_count, results = self.record()
+
+        with open(self.filename, 'rb') as f:
+            events = list(capture.read_capture(f))
+
+        self.assertEqual(len(events), record_count)
+        counts = collections.Counter(event for event, t, index, args in events)
+        self.assertEqual(counts[capture.NEW_RECEIVER], 6)
+        self.assertEqual(counts[capture.DISCONNECT], 6)
+        self.assertEqual(counts[capture.SYNC], driver.sync_count)
+        self.assertEqual(counts[capture.MLAT], driver.mlat_count)
+        self.assertGreater(counts[capture.TRACKING_ADD], 0)
+        self.assertGreater(counts[capture.RATE_REPORT], 0)
+
+        times = [t for event, t, index, args in events]
+        self.assertEqual(times, sorted(times))
+        self.assertLessEqual(times[-1], 60.0)
+
+        event, t, index, (info,) = events[0]
+        self.assertEqual(event, capture.NEW_RECEIVER)
+        self.assertEqual((t, index), (0.0, 0))
+        self.assertEqual(info['uuid'], 'sim00000')
+        self.assertEqual(info['connection_info'], 'simulator')
+
+        for event, t, index, args in events:
+            if event == capture.SYNC:
+                even_time, odd_time, even_message, odd_message = args
+                self.assertEqual((len(even_message), len(odd_message)), (14, 14))
+            elif event == capture.MLAT:
+                timestamp, message, utc = args
+                self.assertIn(len(message), (7, 14))
+
+    def test_replay(self):
+        driver, record_count, recorded_results = self.record()
+        self.assertGreater(len(recorded_results), 0)
+
+        @asyncio.coroutine
+        def feed(c):
+            with open(self.filename, 'rb') as f:
+                count = yield from capture.replay(c, f)
+            # every replayed receiver disconnected again
+            self.assertEqual(c.receivers, {})
+            return count
+
+        count, replayed_results = self.run_coordinator(feed)
+        self.assertEqual(count, record_count)
+
+        # the replayed input produces the same results as the original run
+        self.assertEqual(len(replayed_results), len(recorded_results))
+        self.assertEqual([address for utc, address in replayed_results],
+                         [address for utc, address in recorded_results])
+
+    def test_replay_needs_speed_on_real_clock(self):
+        self.record()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with open(self.filename, 'rb') as f:
+                with self.assertRaises(ValueError):
+                    loop.run_until_complete(capture.replay(None, f))
+        finally:
+            loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
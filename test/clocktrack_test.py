@@ -0,0 +1,145 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import clocksync, clocktrack, coordinator, simulator, timebase
+
+
+def make_receiver(name):
+    return coordinator.Receiver(name, name, None, clocksync.make_clock('dump1090'),
+                                position_llh=(51.5, -0.5, 100.0),
+                                privacy=False,
+                                connection_info='test')
+
+
+def sync_messages(address):
+    return (simulator.encode_airborne_position(address, 51.6, -0.4, 30000, False),
+            simulator.encode_airborne_position(address, 51.6, -0.4, 30000, True))
+
+
+class ClockTrackerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.errors = []
+        self.loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.receivers = [make_receiver('r{0}'.format(i)) for i in range(4)]
+
+    def tearDown(self):
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def advance(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def sync(self, tracker, receiver, address):
+        even, odd = sync_messages(address)
+        tracker.receiver_sync(receiver, 12e6, 12e6 + 6e6, even, odd)
+
+    def syncpoints(self, tracker):
+        return [syncpoint for l in tracker.sync_points.values() for syncpoint in l]
+
+    def test_synced_bitmask(self):
+        tracker = clocktrack.ClockTracker()
+        r0, r1, r2, r3 = self.receivers
+
+        # only r0 and r2 manage to pair
+        paired = []
+
+        def do_sync(address, posA, posB, ra, taA, taB, rb, tbA, tbB):
+            paired.append((ra, rb))
+            return {ra, rb} == {r0, r2}
+        tracker._do_sync = do_sync
+
+        for r in self.receivers:
+            self.sync(tracker, r, 0x400001)
+
+        syncpoint, = self.syncpoints(tracker)
+        self.assertEqual([r for r, tA, tB in syncpoint.receivers], self.receivers)
+        self.assertEqual(syncpoint.synced, 0b0101)
+        # every receiver tried to pair with each earlier one
+        self.assertEqual(len(paired), 6)
+        self.assertEqual([r.sync_pair_count for r in self.receivers], [0, 1, 2, 3])
+
+        # sync counts are credited when the sync point expires
+        self.assertEqual([r.sync_count for r in self.receivers], [0, 0, 0, 0])
+        self.advance(2.5)
+        self.assertEqual(tracker.sync_points, {})
+        self.assertEqual(tracker.sync_point_count, 0)
+        self.assertEqual([r.sync_count for r in self.receivers], [1, 0, 1, 0])
+        self.assertEqual(self.errors, [])
+
+    def test_dead_receiver_not_synced(self):
+        tracker = clocktrack.ClockTracker()
+        r0, r1, r2, r3 = self.receivers
+        tracker._do_sync = lambda *args: True
+
+        self.sync(tracker, r0, 0x400001)
+        self.sync(tracker, r1, 0x400001)
+        r1.dead = True
+        self.sync(tracker, r2, 0x400001)
+
+        syncpoint, = self.syncpoints(tracker)
+        self.assertEqual(syncpoint.synced, 0b0111)
+
+        r0.dead = True
+        self.sync(tracker, r3, 0x400001)
+        # r3 paired with r2 only, which was already marked
+        self.assertEqual(syncpoint.synced, 0b1111)
+
+        r0.dead = r1.dead = False
+        tracker = clocktrack.ClockTracker()
+        tracker._do_sync = lambda *args: True
+        self.sync(tracker, r0, 0x400002)
+        r0.dead = True
+        self.sync(tracker, r1, 0x400002)
+        syncpoint, = self.syncpoints(tracker)
+        self.assertEqual(syncpoint.synced, 0)
+
+    def test_eviction(self):
+        tracker = clocktrack.ClockTracker(max_sync_points=20)
+        r0, r1 = self.receivers[:2]
+        tracker._do_sync = lambda *args: True
+
+        # 20 sync points, the first 5 also seen by a second receiver
+        for i in range(20):
+            self.sync(tracker, r0, 0x400000 + i)
+            if i < 5:
+                self.sync(tracker, r1, 0x400000 + i)
+        self.assertEqual(tracker.sync_point_count, 20)
+        before = self.syncpoints(tracker)
+
+        self.advance(1.0)
+        with self.assertLogs(level='INFO'):
+            self.sync(tracker, r0, 0x400100)
+
+        # a tenth were dropped: the oldest of those with the fewest receivers
+        evicted = [before[5], before[6]]
+        self.assertEqual(tracker.evicted_count, 2)
+        self.assertEqual(tracker.sync_point_count, 19)
+        remaining = self.syncpoints(tracker)
+        self.assertEqual(len(remaining), 19)
+        for syncpoint in evicted:
+            self.assertNotIn(syncpoint, remaining)
+            self.assertTrue(syncpoint.handle._cancelled)
+        for syncpoint in remaining:
+            self.assertFalse(syncpoint.handle._cancelled)
+        self.assertEqual([syncpoint.address for syncpoint in remaining[:5]], [0x400000 + i for i in range(5)])
+
+        # the remaining sync points expire normally; nothing fires for the
+        # evicted ones
+        self.advance(1.5)
+        self.assertEqual(tracker.sync_point_count, 1)
+        self.advance(1.0)
+        self.assertEqual(tracker.sync_point_count, 0)
+        self.assertEqual(tracker.sync_points, {})
+        self.assertEqual(self.errors, [])
+
+        # only the pairs on surviving sync points were credited
+        self.assertEqual(r0.sync_count, 5)
+        self.assertEqual(r1.sync_count, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import config, coordinator, metrics, timebase
+
+
+class AccountingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.coordinator = coordinator.Coordinator(work_dir='/nonexistent')
+        self.coordinator.metrics_top_receivers = 2
+        self.loop.run_until_complete(self.coordinator.start())
+
+    def tearDown(self):
+        self.coordinator.close()
+        self.loop.run_until_complete(self.coordinator.wait_closed())
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def add_receiver(self, name):
+        self.coordinator.new_receiver(connection=None, uuid=name, user=name, auth=None,
+                                      position_llh=(51.5, -0.5, 100.0), clock_type='dump1090',
+                                      privacy=False, connection_info='test')
+        return self.coordinator.receivers[name]
+
+    def receiver_metrics(self, name):
+        collected = {m.name: m for m in self.coordinator._collect_metrics()}
+        return {labels['receiver']: value for suffix, labels, value in collected[name].samples}
+
+    def test_counters(self):
+        r1 = self.add_receiver('r1')
+        r2 = self.add_receiver('r2')
+
+        # distinct messages, so each opens a group that resolves with too few copies
+        for i in range(3):
+            self.coordinator.receiver_mlat(r1, 1000.0 + i, bytes([0x5d, 0x40, 0x00, i, 0, 0, 0]), timebase.time())
+        self.coordinator.receiver_mlat(r2, 2000.0, bytes([0x5d, 0x40, 0x00, 0, 0, 0, 0]), timebase.time())
+        self.assertEqual(len(self.coordinator.mlat_tracker.pending), 3)
+
+        self.loop.run_until_complete(asyncio.sleep(config.MLAT_DELAY + 1.0))
+        self.assertEqual(len(self.coordinator.mlat_tracker.pending), 0)
+
+        self.assertEqual(r1.mlat_message_count, 3)
+        self.assertEqual(r2.mlat_message_count, 1)
+        # no solve was attempted
+        self.assertEqual(r1.cluster_candidate_count, 0)
+        self.assertEqual(r1.solver_count, 0)
+        self.assertGreater(r1.resolve_time, 0.0)
+
+        accounting = r1.dump_accounting()
+        self.assertEqual(accounting['user'], 'r1')
+        self.assertEqual(accounting['mlat_messages'], 3)
+        self.assertEqual(accounting['sync_messages'], 0)
+        self.assertEqual(set(accounting), {'user', 'mlat_messages', 'sync_messages', 'mlat_dropped', 'sync_dropped',
+                                           'bytes', 'sync_pairs', 'cluster_candidates', 'solver',
+                                           'ingest_time', 'resolve_time'})
+
+        self.assertEqual(self.receiver_metrics('receiver_mlat_messages_total'), {'r1': 3, 'r2': 1})
+
+    def test_top_receivers(self):
+        receivers = [self.add_receiver(name) for name in ('r1', 'r2', 'r3', 'r4')]
+        for r, (ingest, resolve) in zip(receivers, [(1.0, 0.0), (0.5, 3.0), (2.0, 0.5), (0.0, 0.1)]):
+            r.ingest_time = ingest
+            r.resolve_time = resolve
+            r.bytes_received = int(ingest * 1000)
+
+        # ordered by ingest + resolve time
+        self.assertEqual([r.uuid for r in self.coordinator.top_receivers()], ['r2', 'r3', 'r1', 'r4'])
+        self.assertEqual([r.uuid for r in self.coordinator.top_receivers(2)], ['r2', 'r3'])
+        self.assertEqual([entry['uuid'] for entry in self.coordinator.dump_receiver_accounting()],
+                         ['r2', 'r3', 'r1', 'r4'])
+
+        # only the most expensive receivers are exported as metrics
+        self.assertEqual(self.receiver_metrics('receiver_cpu_seconds_total'), {'r2': 3.5, 'r3': 2.5})
+        self.assertEqual(self.receiver_metrics('receiver_bytes_total'), {'r2': 500, 'r3': 2000})
+
+        text = metrics.format_prometheus(list(self.coordinator._collect_metrics()))
+        self.assertIn('mlat_receiver_bytes_total{receiver="r3"} 2000\n', text)
+        self.assertNotIn('receiver="r1"', text)
+
+        # receivers drop out of the metrics when they disconnect
+        self.coordinator.receiver_disconnect(receivers[1])
+        self.assertEqual(self.receiver_metrics('receiver_bytes_total'), {'r3': 2000, 'r1': 1000})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import collections
+import logging
+import shutil
+import tempfile
+import unittest
+
+from mlat.server import httpstatus, metrics, statefile
+
+
+class BrokenMetrics(metrics.Metrics):
+    broken = False
+
+    def collect(self):
+        if self.broken:
+            raise RuntimeError('failed to collect metrics')
+        return super().collect()
+
+
+class DummyCoordinator(object):
+    def __init__(self, work_dir):
+        self.state_documents = collections.OrderedDict([
+            ('ok.json', lambda: {'answer': 42}),
+            ('unwritten.json', lambda: {})
+        ])
+        self.state_writer = statefile.StateFileWriter(work_dir)
+        self.state_writer.write({'ok.json': self.state_documents['ok.json']()})
+        self.metrics = BrokenMetrics()
+        self.metrics.add_source(lambda: [metrics.gauge('x', 'X', 1)])
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StatusClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.work_dir = tempfile.mkdtemp(prefix='mlat-test-')
+        self.coordinator = DummyCoordinator(self.work_dir)
+        cache = httpstatus.StatusCache(self.coordinator, max_age=0.0)
+        self.clients = []
+
+        def factory(reader, writer):
+            self.clients.append(httpstatus.StatusClient(reader, writer, cache=cache, idle_timeout=0.2))
+
+        self.server = self.loop.run_until_complete(asyncio.start_server(factory, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        self.log = RecordingHandler()
+        logging.getLogger('httpstatus').addHandler(self.log)
+
+    def tearDown(self):
+        logging.getLogger('httpstatus').removeHandler(self.log)
+        self.server.close()
+        for client in self.clients:
+            client.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.work_dir)
+
+    def run_coroutine(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 5.0))
+
+    @asyncio.coroutine
+    def exchange(self, request):
+        """Send request; return (status line, body) of the response."""
+
+        status, headers, body = yield from self.exchange_headers(request)
+        return status, body
+
+    @asyncio.coroutine
+    def exchange_headers(self, request):
+        """Send request; return (status line, headers, body) of the response."""
+
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(request)
+            status = yield from reader.readline()
+            headers = {}
+            while True:
+                line = yield from reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, sep, value = line.decode('ascii').partition(':')
+                headers[name.lower()] = value.strip()
+            body = yield from reader.readexactly(int(headers.get('content-length', 0)))
+            return status.decode('ascii').strip(), headers, body
+        finally:
+            writer.close()
+
+    def test_document(self):
+        status, headers, body = self.run_coroutine(self.exchange_headers(b'GET /ok.json HTTP/1.0\r\n\r\n'))
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertEqual(body, b'{"answer":42}')
+
+        # served as last written by the state writer, with its digest as the ETag
+        self.assertEqual(headers['etag'], '"' + self.coordinator.state_writer.bodies['ok.json'][1] + '"')
+        status, body = self.run_coroutine(self.exchange(
+            'GET /ok.json HTTP/1.0\r\nIf-None-Match: {etag}\r\n\r\n'.format(etag=headers['etag']).encode('ascii')))
+        self.assertEqual(status, 'HTTP/1.1 304 Not Modified')
+
+        self.coordinator.state_writer.write({'ok.json': {'answer': 43}})
+        status, body = self.run_coroutine(self.exchange(b'GET /ok.json HTTP/1.0\r\n\r\n'))
+        self.assertEqual(body, b'{"answer":43}')
+
+    def test_unavailable(self):
+        status, body = self.run_coroutine(self.exchange(b'GET /unwritten.json HTTP/1.0\r\n\r\n'))
+        self.assertEqual(status, 'HTTP/1.1 503 Service Unavailable')
+
+    def test_metrics(self):
+        status, body = self.run_coroutine(self.exchange(b'GET /metrics HTTP/1.0\r\n\r\n'))
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertIn(b'\nmlat_x 1\n', body)
+
+    def test_not_found(self):
+        status, body = self.run_coroutine(self.exchange(b'GET /nothing HTTP/1.0\r\n\r\n'))
+        self.assertEqual(status, 'HTTP/1.1 404 Not Found')
+
+    def test_build_error(self):
+        self.coordinator.metrics.broken = True
+        status, body = self.run_coroutine(self.exchange(b'GET /metrics HTTP/1.1\r\n\r\n'))
+        self.assertEqual(status, 'HTTP/1.1 500 Internal Server Error')
+        self.assertTrue(any(r.levelno == logging.ERROR for r in self.log.records))
+
+    def test_header_timeout(self):
+        @asyncio.coroutine
+        def stall():
+            reader, writer = yield from asyncio.open_connection('127.0.0.1', self.port)
+            try:
+                # request line, but the headers never finish
+                writer.write(b'GET /ok.json HTTP/1.1\r\nHost: x\r\n')
+                return (yield from reader.read())
+            finally:
+                writer.close()
+
+        # the server closes the connection without a response ...
+        self.assertEqual(self.run_coroutine(stall()), b'')
+        # ... and without treating the timeout as an unexpected error
+        self.assertEqual([r for r in self.log.records if r.levelno >= logging.WARNING], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import base64
+import json
+import random
+import struct
+import unittest
+import zlib
+
+import numpy
+
+from mlat.server import coordinator, jsonclient, timebase
+from mlat.server.jsonclient import pack_icao_set, unpack_icao_set
+
+
+def _packed(*words):
+    return base64.b64encode(struct.pack('>{0}H'.format(len(words)), *words)).decode('ascii')
+
+
+class PackedIcaoSetTestCase(unittest.TestCase):
+    def roundtrip(self, icao_set):
+        packed = pack_icao_set(icao_set)
+        self.assertIsInstance(packed, str)
+        self.assertEqual(unpack_icao_set(packed), set(icao_set))
+        return packed
+
+    def test_empty(self):
+        self.assertEqual(self.roundtrip(set()), '')
+
+    def test_extremes(self):
+        self.roundtrip({0x000000})
+        self.roundtrip({0xffffff})
+        self.roundtrip({0x000000, 0xffffff})
+        self.roundtrip({0x000000, 0x000001, 0xfffffe, 0xffffff})
+
+    def test_small_deltas(self):
+        # every delta fits in one word
+        packed = self.roundtrip({0x100, 0x101, 0x200, 0x7fff + 0x200})
+        self.assertEqual(len(base64.b64decode(packed)), 8)
+
+    def test_escaped_deltas(self):
+        # deltas of 0x8000 and above take two words
+        packed = self.roundtrip({0x8000})
+        self.assertEqual(base64.b64decode(packed), struct.pack('>HH', 0x8000, 0x8000))
+        self.roundtrip({0x7fff, 0x7fff + 0x8000})
+        self.roundtrip({0x10000, 0x123456, 0xabcdef})
+
+    def test_random(self):
+        rng = random.Random(1)
+        for i in range(50):
+            self.roundtrip(set(rng.sample(range(0x1000000), rng.randrange(1, 2000))))
+
+    def test_odd_length(self):
+        with self.assertRaises(ValueError):
+            unpack_icao_set(base64.b64encode(b'\x00\x01\x02').decode('ascii'))
+
+    def test_truncated_escape(self):
+        with self.assertRaises(ValueError):
+            unpack_icao_set(_packed(0x0001, 0x8001))
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            unpack_icao_set(_packed(0x80ff, 0xffff, 0x0001))
+
+    def test_bad_base64(self):
+        with self.assertRaises(ValueError):
+            unpack_icao_set('AAE')
+        with self.assertRaises(ValueError):
+            unpack_icao_set('éééé')
+
+    def test_corrupted_base64(self):
+        # characters outside the base64 alphabet are not silently skipped
+        packed = pack_icao_set({0x123456, 0x654321})
+        for corrupted in (packed[:2] + '!' + packed[2:], packed[:2] + '\n' + packed[2:], packed + ' '):
+            with self.assertRaises(ValueError):
+                unpack_icao_set(corrupted)
+
+    def test_not_a_string(self):
+        with self.assertRaises(ValueError):
+            unpack_icao_set(12345)
+        with self.assertRaises(ValueError):
+            unpack_icao_set(None)
+
+
+class IngestLimitsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+
+    def tearDown(self):
+        self.loop.close()
+        timebase.use_real_time()
+
+    def test_default_burst(self):
+        limits = jsonclient.IngestLimits(mlat_rate=50.0)
+        self.assertTrue(limits.enabled)
+        self.assertEqual(limits.mlat_burst, 500.0)
+        self.assertIsNone(limits.sync_burst)
+        self.assertFalse(jsonclient.IngestLimits().enabled)
+
+    def test_backoff(self):
+        limits = jsonclient.IngestLimits(mlat_rate=50.0, backoff=100.0, max_backoff=300.0)
+        self.assertIsNone(limits.penalty_remaining('user'))
+
+        self.assertEqual(limits.penalize('user'), 100.0)
+        self.assertEqual(limits.penalty_remaining('user'), 100.0)
+        self.loop.advance(60.0)
+        self.assertEqual(limits.penalty_remaining('user'), 40.0)
+        self.loop.advance(40.0)
+        self.assertIsNone(limits.penalty_remaining('user'))
+
+        # repeat offences double the back-off, up to the maximum
+        self.assertEqual(limits.penalize('user'), 200.0)
+        self.assertEqual(limits.penalize('user'), 300.0)
+        self.assertEqual(limits.disconnects, 3)
+        self.assertIsNone(limits.penalty_remaining('other'))
+
+    def test_offences_forgotten(self):
+        limits = jsonclient.IngestLimits(mlat_rate=50.0, backoff=100.0)
+        limits.penalize('user')
+        self.loop.advance(100.0 + limits.offence_memory + 1.0)
+        self.assertEqual(limits.penalize('other'), 100.0)
+        self.assertNotIn('user', limits.offenders)
+        self.assertEqual(limits.penalize('user'), 100.0)
+
+
+class DummyReceiver(object):
+    def __init__(self):
+        self.bytes_received = 0
+        self.ingest_time = 0.0
+
+
+class PackedMlatServerProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = jsonclient.PackedMlatServerProtocol()
+        self.receiver = DummyReceiver()
+        self.mlat = []
+        self.sync = []
+        self.key = self.protocol.add_client(lambda *args: self.sync.append(args), self.mlat_handler, self.receiver)
+        self.disconnect_after = None
+
+    def mlat_handler(self, t, m, utc):
+        self.mlat.append((t, m))
+        if len(self.mlat) == self.disconnect_after:
+            self.protocol.remove_client(self.key)
+
+    def datagram(self, key, count, base=1000):
+        P = jsonclient.PackedMlatServerProtocol
+        data = P.STRUCT_HEADER.pack(key, 1, base)
+        for i in range(count):
+            data += bytes([P.TYPE_MLAT_SHORT]) + P.STRUCT_MLAT_SHORT.pack(i, bytes(7))
+        return data
+
+    def test_messages(self):
+        data = self.datagram(self.key, 3)
+        self.protocol.datagram_received(data, ('127.0.0.1', 1234))
+        self.assertEqual([t for t, m in self.mlat], [1000, 1001, 1002])
+        self.assertEqual(self.receiver.bytes_received, len(data))
+
+    def test_unknown_client(self):
+        self.protocol.datagram_received(self.datagram(self.key + 1, 3), ('127.0.0.1', 1234))
+        self.assertEqual(self.mlat, [])
+
+    def test_disconnect_midway(self):
+        # a client disconnected while handling a datagram (e.g. by rate
+        # limiting) doesn't have the rest of the datagram delivered
+        self.disconnect_after = 2
+        self.protocol.datagram_received(self.datagram(self.key, 5), ('127.0.0.1', 1234))
+        self.assertEqual([t for t, m in self.mlat], [1000, 1001])
+
+
+class FakeTransport(object):
+    def __init__(self, port):
+        self.port = port
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', self.port) if name == 'peername' else None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeWriter(object):
+    def __init__(self, port):
+        self.transport = FakeTransport(port)
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+class JsonClientTestCase(unittest.TestCase):
+    """Runs JsonClients, with a real handshake, against a coordinator."""
+
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.coordinator = coordinator.Coordinator(work_dir='/nonexistent')
+        self.wait(self.coordinator.start())
+        self.clients = []
+
+    def tearDown(self):
+        for client, writer in self.clients:
+            client.close()
+        self.wait(asyncio.sleep(0))
+        self.coordinator.close()
+        self.wait(self.coordinator.wait_closed())
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def connect(self, user, **handshake):
+        hs = {'version': 3, 'user': user, 'lat': 51.5, 'lon': -0.5, 'alt': 100, 'compress': ['none']}
+        hs.update(handshake)
+
+        reader = asyncio.StreamReader()
+        reader.feed_data((json.dumps(hs) + '\n').encode('ascii'))
+        writer = FakeWriter(len(self.clients) + 1000)
+        client = jsonclient.JsonClient(reader, writer,
+                                       coordinator=self.coordinator,
+                                       motd='',
+                                       udp_protocol=None, udp_host=None, udp_port=None)
+        self.clients.append((client, writer))
+        self.wait(asyncio.sleep(0.1))
+
+        # the handshake response is never compressed
+        response = json.loads(writer.data.decode('ascii'))
+        del writer.data[:]
+        self.assertNotIn('deny', response)
+        return client, writer
+
+    def received(self, client, writer):
+        """Return the messages written to a client since the last call."""
+
+        self.wait(asyncio.sleep(0))
+        data = bytes(writer.data)
+        del writer.data[:]
+
+        if client.compress == 'zlib2' and data:
+            if not hasattr(client, 'test_decompressor'):
+                client.test_decompressor = zlib.decompressobj()
+            text = ''
+            while data:
+                hlen, = struct.unpack('!H', data[:2])
+                text += client.test_decompressor.decompress(data[2:2+hlen] + b'\x00\x00\xff\xff').decode('ascii')
+                data = data[2+hlen:]
+        else:
+            text = data.decode('ascii')
+
+        return [json.loads(line) for line in text.split('\n') if line]
+
+
+class TrafficRequestTestCase(JsonClientTestCase):
+    def test_changes_merged(self):
+        client, writer = self.connect('user1')
+        client.request_traffic(client.receiver, {1, 2, 3}, set())
+        client.request_traffic(client.receiver, {4}, {2, 5})
+        self.assertEqual(self.received(client, writer),
+                         [{'start_sending': ['000001', '000003', '000004']},
+                          {'stop_sending': ['000005']}])
+
+        client.request_traffic(client.receiver, set(), {1})
+        client.request_traffic(client.receiver, {1}, set())
+        self.assertEqual(self.received(client, writer), [])
+
+    def test_packed(self):
+        client, writer = self.connect('user1', packed_traffic=1)
+        client.request_traffic(client.receiver, {1, 0x123456}, {7})
+        start, stop = self.received(client, writer)
+        self.assertEqual(unpack_icao_set(start['start_sending_packed']), {1, 0x123456})
+        self.assertEqual(unpack_icao_set(stop['stop_sending_packed']), {7})
+
+
+class ResultTestCase(JsonClientTestCase):
+    ECEF = (3980000.0, -35000.0, 4970000.0)
+
+    def forward(self, receivers, cov=None):
+        self.coordinator.forward_results(1500000000.1234, 0x4ca123, self.ECEF, cov,
+                                         receivers, 3, 2, None)
+
+    def test_shared_encoding(self):
+        # the same cached line is sent raw and zlib-compressed
+        zclient, zwriter = self.connect('user1', compress=['zlib2'], return_results=True,
+                                        return_result_format='ecef')
+        rclient, rwriter = self.connect('user2', compress=['none'], return_results=True,
+                                        return_result_format='ecef')
+        self.assertEqual(zclient.compress, 'zlib2')
+        self.assertEqual(rclient.compress, 'none')
+
+        cache = {}
+        for client in (zclient, rclient):
+            client.report_mlat_position(client.receiver, 1500000000.1234, 0x4ca123, self.ECEF, None,
+                                        {zclient.receiver, rclient.receiver}, 2, 2, None, cache)
+        self.assertEqual(list(cache.keys()), ['ecef'])
+
+        expected = json.loads(cache['ecef'])
+        self.assertEqual(expected['result']['addr'], '4ca123')
+        self.assertEqual(self.received(zclient, zwriter), [expected])
+        self.assertEqual(self.received(rclient, rwriter), [expected])
+
+        # the compressed stream carries on correctly across results
+        cache = {}
+        zclient.report_mlat_position(zclient.receiver, 1500000001.0, 0x4ca123, self.ECEF, None,
+                                     {zclient.receiver}, 1, 0, None, cache)
+        self.assertEqual(self.received(zclient, zwriter), [json.loads(cache['ecef'])])
+
+    def test_forward_results(self):
+        clients = [self.connect('user1', compress=['zlib2'], return_results=True, return_result_format='ecef'),
+                   self.connect('user2', compress=['zlib'], return_results=True, return_result_format='old'),
+                   self.connect('user3', compress=['none'], return_results=True, return_result_format='ecef'),
+                   self.connect('user4', compress=['none'])]
+
+        self.forward({client.receiver for client, writer in clients}, cov=numpy.eye(3) * 100.0)
+
+        ecef1, old, ecef2, discarded = [self.received(client, writer) for client, writer in clients]
+        self.assertEqual(ecef1, ecef2)
+        self.assertEqual(ecef1[0]['result']['ecef'], list(self.ECEF))
+        self.assertEqual(ecef1[0]['result']['cov'], [100.0, 0.0, 0.0, 100.0, 0.0, 100.0])
+        self.assertEqual(ecef1[0]['result']['n'], 4)
+        self.assertEqual(old[0]['result']['addr'], '4ca123')
+        self.assertAlmostEqual(old[0]['result']['lat'], 51.3, delta=0.5)
+        self.assertEqual(old[0]['result']['nstations'], 4)
+        self.assertEqual(discarded, [])
+
+
+class MalformedInputTestCase(JsonClientTestCase):
+    def test_corrupted_packed_set_disconnects(self):
+        client, writer = self.connect('user1', packed_traffic=1)
+        packed = pack_icao_set({0x123456})
+        client.r.feed_data(json.dumps({'seen_packed': packed[:2] + '!' + packed[2:]}).encode('ascii') + b'\n')
+        with self.assertLogs('client', 'ERROR'):
+            self.wait(asyncio.sleep(0.1))
+        self.assertIsNone(client.transport)
+        self.assertEqual(self.coordinator.tracker.aircraft, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
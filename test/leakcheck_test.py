@@ -0,0 +1,81 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import tracemalloc
+import unittest
+
+from mlat.server import leakcheck, timebase
+
+
+def allocate(n):
+    return [bytearray(1000) for i in range(n)]
+
+
+class TracemallocLeakCheckerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.checker = leakcheck.TracemallocLeakChecker()
+        tracemalloc.start(self.checker.frames)
+
+    def tearDown(self):
+        tracemalloc.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_check_finds_growth(self):
+        before = self.loop.run_until_complete(self.checker.check())
+        kept = allocate(1000)
+        after = self.loop.run_until_complete(self.checker.check())
+
+        growth = {tb: size - before.get(tb, (0, 0))[0] for tb, (size, count) in after.items()}
+        tb, size = max(growth.items(), key=lambda x: x[1])
+        self.assertEqual(tb[0].lineno, allocate.__code__.co_firstlineno + 1)
+        self.assertGreaterEqual(size, 1000 * 1000)
+        self.assertEqual(len(kept), 1000)
+
+    def test_ignored_files(self):
+        totals = self.loop.run_until_complete(self.checker.check())
+        for tb in totals:
+            self.assertEqual(len(tb), 1)
+            self.assertNotIn(tb[0].filename, leakcheck.TracemallocLeakChecker.IGNORED_FILES)
+
+
+class CheckerTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.checker = leakcheck.TracemallocLeakChecker(interval=600.0)
+        self.results = [RuntimeError('snapshot failed'), {'a': (1, 1)}, {'a': (2, 2)}]
+        self.shown = []
+        self.checker.check = self.fake_check
+        self.checker.show_growth = lambda previous, current: self.shown.append((previous, current))
+
+    def tearDown(self):
+        self.checker.close()
+        self.loop.run_until_complete(self.checker.wait_closed())
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    @asyncio.coroutine
+    def fake_check(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def test_first_check_fails(self):
+        self.checker.start()
+        with self.assertLogs('leaks', 'ERROR'):
+            self.loop.run_until_complete(asyncio.sleep(121.0))
+        self.assertIsNone(self.checker.previous)
+        self.assertFalse(self.checker._task.done())
+
+        # the next check becomes the baseline, and the one after is compared with it
+        self.loop.run_until_complete(asyncio.sleep(600.0))
+        self.assertEqual(self.checker.previous, {'a': (1, 1)})
+        self.assertEqual(self.shown, [])
+
+        self.loop.run_until_complete(asyncio.sleep(600.0))
+        self.assertEqual(self.shown, [({'a': (1, 1)}, {'a': (2, 2)})])
+        self.assertEqual(self.checker.previous, {'a': (2, 2)})
@@ -0,0 +1,117 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import time
+import unittest
+
+from mlat.server import loopmonitor, metrics
+
+
+def slow_callback():
+    time.sleep(0.03)
+
+
+def fast_callback():
+    pass
+
+
+class LoopMonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.original_run = asyncio.events.Handle._run
+        self.monitors = []
+
+    def tearDown(self):
+        for monitor in self.monitors:
+            monitor.close()
+            self.loop.run_until_complete(monitor.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        # never leak the patch into other tests
+        asyncio.events.Handle._run = self.original_run
+
+    def make_monitor(self, **kwargs):
+        monitor = loopmonitor.LoopMonitor(**kwargs)
+        self.monitors.append(monitor)
+        monitor.start()
+        return monitor
+
+    def run_callbacks(self, *callbacks):
+        for callback in callbacks:
+            self.loop.call_soon(callback)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_not_installed_without_threshold(self):
+        self.make_monitor()
+        self.assertIs(asyncio.events.Handle._run, self.original_run)
+
+    def test_installed_and_removed(self):
+        monitor = self.make_monitor(slow_threshold=0.01)
+        self.assertIs(asyncio.events.Handle._run, monitor._timed_run)
+
+        monitor.close()
+        self.assertIs(asyncio.events.Handle._run, self.original_run)
+
+        # closing again is harmless
+        monitor.close()
+        self.assertIs(asyncio.events.Handle._run, self.original_run)
+
+    def test_records_slow_callbacks(self):
+        monitor = self.make_monitor(slow_threshold=0.01)
+        with self.assertLogs('loopmonitor', 'WARNING') as logs:
+            self.run_callbacks(fast_callback, slow_callback, slow_callback)
+
+        self.assertEqual(list(monitor.slow_callbacks), ['slow_callback'])
+        count, total, maxval = monitor.slow_callbacks['slow_callback']
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(maxval, 0.03)
+        self.assertGreaterEqual(total, 0.06)
+        self.assertEqual(monitor.slow_count, 2)
+
+        # the second report falls inside log_interval and is only counted
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Slow callback slow_callback', logs.output[0])
+        self.assertEqual(monitor._unlogged, 1)
+
+        state = monitor.dump_state()
+        self.assertEqual(state['slow_callbacks']['slow_callback']['count'], 2)
+
+        text = metrics.format_prometheus(list(monitor.collect_metrics()))
+        self.assertIn('mlat_slow_callbacks_total{callback="slow_callback"} 2\n', text)
+
+    def test_task_steps_named_by_coroutine(self):
+        monitor = self.make_monitor(slow_threshold=0.01)
+
+        @asyncio.coroutine
+        def slow_task():
+            time.sleep(0.03)
+            yield from asyncio.sleep(0)
+
+        with self.assertLogs('loopmonitor', 'WARNING'):
+            self.loop.run_until_complete(asyncio.async(slow_task()))
+
+        names = list(monitor.slow_callbacks)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith('task:'))
+        self.assertIn('slow_task', names[0])
+
+    def test_not_recorded_after_close(self):
+        monitor = self.make_monitor(slow_threshold=0.01)
+        monitor.close()
+        self.run_callbacks(slow_callback)
+        self.assertEqual(monitor.slow_callbacks, {})
+
+    def test_lag_summary(self):
+        monitor = self.make_monitor(probe_interval=0.01)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertGreater(monitor.probe_count, 0)
+
+        text = metrics.format_prometheus(list(monitor.collect_metrics()))
+        self.assertIn('# TYPE mlat_loop_lag_seconds summary\n', text)
+        self.assertIn('mlat_loop_lag_seconds{quantile="0.5"} ', text)
+        self.assertIn('mlat_loop_lag_seconds_count {n}\n'.format(n=monitor.probe_count), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import gc
+import sys
+import unittest
+
+from mlat.server import memory
+
+
+class Plain(object):
+    def __init__(self):
+        self.name = 'x' * 100
+        self.values = [1.5] * 10
+
+
+class Slotted(object):
+    __slots__ = ('name', 'values')
+
+    def __init__(self):
+        self.name = 'x' * 100
+        self.values = [1.5] * 10
+
+
+class SlottedWithDict(object):
+    __slots__ = ('name', 'values', '__dict__')
+
+    def __init__(self):
+        self.name = 'x' * 100
+        self.values = [1.5] * 10
+
+
+def has_dict(obj):
+    # without touching obj.__dict__, which would create it
+    return any(type(ref) is dict for ref in gc.get_referents(obj))
+
+
+class SizeofTestCase(unittest.TestCase):
+    def test_contents_counted(self):
+        for cls in (Plain, Slotted, SlottedWithDict):
+            obj = cls()
+            self.assertGreaterEqual(memory.sizeof(obj),
+                                    sys.getsizeof(obj) + sys.getsizeof(obj.name) + sys.getsizeof(obj.values))
+
+    def test_slotted_is_smaller(self):
+        self.assertLess(memory.sizeof(Slotted()), memory.sizeof(Plain()))
+
+    def test_unused_dict_slot(self):
+        obj = SlottedWithDict()
+        other = Slotted()
+        self.assertEqual(memory.sizeof(obj) - sys.getsizeof(obj), memory.sizeof(other) - sys.getsizeof(other))
+        # measuring doesn't create the dict
+        self.assertFalse(has_dict(obj))
+
+    def test_used_dict_slot(self):
+        # attributes added outside the slots (e.g. by an authenticator) are counted
+        obj = SlottedWithDict()
+        obj.extra = 'y' * 1000
+        self.assertGreater(memory.sizeof(obj), memory.sizeof(Slotted()) + 1000)
+
+    def test_owned(self):
+        outer = Slotted()
+        outer.values = Plain()
+        self.assertEqual(memory.sizeof(outer) - memory.sizeof(outer, owned=('values',)),
+                         -memory.sizeof(outer.values))
+
+    def test_sampled_container(self):
+        obj = Plain()
+        obj.values = list(range(100000, 101000))
+        size = memory.sizeof(obj)
+        exact = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__) + sys.getsizeof(obj.name) + \
+            sys.getsizeof(obj.values) + sum(sys.getsizeof(v) for v in obj.values)
+        self.assertAlmostEqual(size, exact, delta=exact * 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import unittest
+
+import modes.message
+from mlat.server import simulator
+
+
+class DecodeTestCase(unittest.TestCase):
+    def test_altitude_reply(self):
+        decoded = modes.message.decode(simulator.encode_altitude_reply(0x4ca123, 35000))
+        self.assertEqual(decoded.DF, 4)
+        self.assertEqual(decoded.address, 0x4ca123)
+        self.assertEqual(decoded.altitude, 35000)
+        self.assertIsNone(decoded.squawk)
+        self.assertIsNone(decoded.callsign)
+
+    def test_extended_squitter_callsign(self):
+        decoded = modes.message.decode(bytes.fromhex('8d4ca1232010c2f2cb18206a2c1a'))
+        self.assertIs(decoded.estype, modes.message.ESType.id_and_category)
+        self.assertIsNone(decoded.altitude)
+        self.assertEqual(decoded.callsign, 'DLK221  ')
+        self.assertIs(decoded.callsign, decoded.callsign)
+
+    def test_commb_callsign(self):
+        buf = bytearray(bytes.fromhex('a8000000') + bytes.fromhex('8d4ca1232010c2f2cb18206a2c1a')[4:])
+        self.assertEqual(modes.message.decode(bytes(buf)).callsign, 'DLK221  ')
+
+        buf[4] = 0x30  # not BDS 2,0
+        self.assertIsNone(modes.message.decode(bytes(buf)).callsign)
+
+        buf[4:11] = b'\x20' + bytes(6)  # blank callsign
+        self.assertIsNone(modes.message.decode(bytes(buf)).callsign)
+
+    def test_buffer_released(self):
+        # only messages with an undecoded callsign keep the buffer
+        decoded = modes.message.decode(simulator.encode_airborne_position(0x4ca123, 51.5, -0.5, 35000, False))
+        self.assertFalse(hasattr(decoded, '_buf'))
+        self.assertFalse(hasattr(modes.message.decode(simulator.encode_altitude_reply(0x4ca123, 35000)), '_buf'))
+
+        decoded = modes.message.decode(bytes.fromhex('8d4ca1232010c2f2cb18206a2c1a'))
+        self.assertTrue(hasattr(decoded, '_buf'))
+        self.assertEqual(decoded.callsign, 'DLK221  ')
+        self.assertFalse(hasattr(decoded, '_buf'))
+        self.assertEqual(decoded.callsign, 'DLK221  ')
+
+
+if __name__ == '__main__':
+    unittest.main()
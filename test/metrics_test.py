@@ -0,0 +1,101 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import unittest
+
+from mlat.server import metrics
+
+
+class FormatPrometheusTestCase(unittest.TestCase):
+    def test_format(self):
+        text = metrics.format_prometheus([
+            metrics.gauge('receivers', 'Connected receivers', 12),
+            metrics.counter('results_total', 'Results', 3.5, labels={'b': 'y', 'a': 'x'}),
+        ])
+        self.assertEqual(text.split('\n'), [
+            '# HELP mlat_receivers Connected receivers',
+            '# TYPE mlat_receivers gauge',
+            'mlat_receivers 12',
+            '# HELP mlat_results_total Results',
+            '# TYPE mlat_results_total counter',
+            'mlat_results_total{a="x",b="y"} 3.5',
+            ''])
+
+    def test_histogram_suffixes(self):
+        m = metrics.Metric('lag', 'histogram', 'Lag', [('_bucket', {'le': '0.1'}, 2),
+                                                       ('_bucket', {'le': '+Inf'}, 3),
+                                                       ('_sum', None, 0.25),
+                                                       ('_count', None, 3)])
+        lines = metrics.format_prometheus([m], prefix='').split('\n')
+        self.assertEqual(lines[2:6], ['lag_bucket{le="0.1"} 2',
+                                      'lag_bucket{le="+Inf"} 3',
+                                      'lag_sum 0.25',
+                                      'lag_count 3'])
+
+    def test_summary(self):
+        m = metrics.Metric('lag', 'summary', 'Lag', [('', {'quantile': 0.5}, 0.01),
+                                                     ('', {'quantile': 0.99}, None),
+                                                     ('_sum', None, 0.25),
+                                                     ('_count', None, 3)])
+        lines = metrics.format_prometheus([m], prefix='').split('\n')
+        self.assertEqual(lines[1:6], ['# TYPE lag summary',
+                                      'lag{quantile="0.5"} 0.01',
+                                      'lag{quantile="0.99"} NaN',
+                                      'lag_sum 0.25',
+                                      'lag_count 3'])
+
+    def test_unknown_kind(self):
+        text = metrics.format_prometheus([metrics.Metric('x', 'bogus', 'X', [('', None, 1)])], prefix='')
+        self.assertEqual(text.split('\n')[1], '# TYPE x untyped')
+
+    def test_label_escaping(self):
+        text = metrics.format_prometheus([
+            metrics.gauge('x', 'X', 1, labels={'user': 'a"b\\c\nd'})
+        ], prefix='')
+        self.assertIn('x{user="a\\"b\\\\c\\nd"} 1\n', text)
+        # a newline in a label value must not split the sample line
+        self.assertEqual(len(text.split('\n')), 4)
+
+    def test_help_escaping(self):
+        text = metrics.format_prometheus([metrics.gauge('x', 'one\ntwo \\ three', 1)], prefix='')
+        self.assertEqual(text.split('\n')[0], '# HELP x one\\ntwo \\\\ three')
+
+    def test_special_values(self):
+        text = metrics.format_prometheus([
+            metrics.Metric('v', 'gauge', 'V', [('', {'k': 'none'}, None),
+                                               ('', {'k': 'nan'}, float('nan')),
+                                               ('', {'k': 'inf'}, float('inf')),
+                                               ('', {'k': '-inf'}, float('-inf')),
+                                               ('', {'k': 'true'}, True)])
+        ], prefix='')
+        self.assertEqual(text.split('\n')[2:7], ['v{k="none"} NaN',
+                                                 'v{k="nan"} NaN',
+                                                 'v{k="inf"} +Inf',
+                                                 'v{k="-inf"} -Inf',
+                                                 'v{k="true"} 1'])
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_merge(self):
+        registry = metrics.Metrics()
+        registry.add_source(lambda: [metrics.gauge('x', 'X', 1, labels={'s': 'a'})])
+        registry.add_source(lambda: [metrics.gauge('x', 'X', 2, labels={'s': 'b'}),
+                                     metrics.gauge('y', 'Y', 3)])
+        collected = registry.collect()
+        self.assertEqual([m.name for m in collected], ['x', 'y'])
+        self.assertEqual([value for suffix, labels, value in collected[0].samples], [1, 2])
+
+    def test_failing_source(self):
+        registry = metrics.Metrics()
+
+        def fail():
+            raise RuntimeError('source failed')
+
+        registry.add_source(fail)
+        registry.add_source(lambda: [metrics.gauge('y', 'Y', 3)])
+        with self.assertLogs('metrics', 'ERROR'):
+            collected = registry.collect()
+        self.assertEqual([m.name for m in collected], ['y'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import config, coordinator, timebase
+
+
+class PendingEvictionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.errors = []
+        self.loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.coordinator = coordinator.Coordinator(work_dir='/nonexistent', max_pending_groups=20)
+        self.loop.run_until_complete(self.coordinator.start())
+        self.mlat_tracker = self.coordinator.mlat_tracker
+        self.receivers = []
+        for name in ('r0', 'r1'):
+            self.coordinator.new_receiver(connection=None, uuid=name, user=name, auth=None,
+                                          position_llh=(51.5, -0.5, 100.0), clock_type='dump1090',
+                                          privacy=False, connection_info='test')
+            self.receivers.append(self.coordinator.receivers[name])
+
+    def tearDown(self):
+        self.coordinator.close()
+        self.loop.run_until_complete(self.coordinator.wait_closed())
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def advance(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def mlat(self, receiver, i):
+        self.mlat_tracker.receiver_mlat(receiver, 1000.0, bytes([0x20, 0, i >> 8, i & 0xff, 0, 0, 0]),
+                                        timebase.time())
+
+    def test_eviction(self):
+        r0, r1 = self.receivers
+
+        # 20 groups, the first 5 with a second copy
+        for i in range(20):
+            self.mlat(r0, i)
+            if i < 5:
+                self.mlat(r1, i)
+        self.assertEqual(len(self.mlat_tracker.pending), 20)
+        before = list(self.mlat_tracker.pending.values())
+
+        self.advance(1.0)
+        with self.assertLogs('mlattrack', 'INFO'):
+            self.mlat(r0, 100)
+
+        # a tenth were dropped: the oldest of those with the fewest copies
+        evicted = [before[5], before[6]]
+        self.assertEqual(self.mlat_tracker.evicted_count, 2)
+        self.assertEqual(len(self.mlat_tracker.pending), 19)
+        remaining = list(self.mlat_tracker.pending.values())
+        for group in evicted:
+            self.assertNotIn(group, remaining)
+            self.assertTrue(group.handle._cancelled)
+        for group in remaining:
+            self.assertFalse(group.handle._cancelled)
+        self.assertEqual(remaining[:5], before[:5])
+
+        # the remaining groups resolve normally; nothing fires for the evicted ones
+        self.advance(config.MLAT_DELAY - 0.5)
+        self.assertEqual(len(self.mlat_tracker.pending), 1)
+        self.advance(1.0)
+        self.assertEqual(self.mlat_tracker.pending, {})
+        self.assertEqual(self.errors, [])
+
+    def test_evicted_copy_starts_new_group(self):
+        r0, r1 = self.receivers
+        for i in range(20):
+            self.mlat(r0, i)
+        evicted = next(iter(self.mlat_tracker.pending.values()))
+
+        with self.assertLogs('mlattrack', 'INFO'):
+            self.mlat(r0, 100)
+        self.assertTrue(evicted.handle._cancelled)
+
+        # a late copy of an evicted message opens a fresh group
+        self.mlat(r1, 0)
+        group = self.mlat_tracker.pending[evicted.message]
+        self.assertIsNot(group, evicted)
+        self.assertEqual([r for r, timestamp, utc in group.copies], [r1])
+
+        self.advance(config.MLAT_DELAY + 1.0)
+        self.assertEqual(self.mlat_tracker.pending, {})
+        self.assertEqual(self.errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mlat.server import output
+
+
+class DummyTracker(object):
+    def __init__(self):
+        self.aircraft = {}
+
+
+class DummyCoordinator(object):
+    def __init__(self):
+        self.tracker = DummyTracker()
+        self.output_handlers = []
+        self.sighup_handlers = []
+
+    def add_output_handler(self, handler):
+        self.output_handlers.append(handler)
+
+    def remove_output_handler(self, handler):
+        self.output_handlers.remove(handler)
+
+    def add_sighup_handler(self, handler):
+        self.sighup_handlers.append(handler)
+
+    def remove_sighup_handler(self, handler):
+        self.sighup_handlers.remove(handler)
+
+
+class DummyReceiver(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class DummyKalmanState(object):
+    valid = False
+
+
+RESULT = (1500000000.0, 0x4840d6, (3978000.0, -35000.0, 4969000.0), None,
+          [DummyReceiver('a'), DummyReceiver('b'), DummyReceiver('c')], 3, 1, DummyKalmanState())
+
+
+class LocalCSVWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.work_dir = tempfile.mkdtemp(prefix='mlat-test-')
+        self.filename = os.path.join(self.work_dir, 'results.csv')
+        self.coordinator = DummyCoordinator()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.work_dir)
+
+    def close(self, writer):
+        writer.close()
+        self.loop.run_until_complete(writer.wait_closed())
+
+    def lines(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            return f.readlines()
+
+    def test_write(self):
+        writer = output.LocalCSVWriter(self.coordinator, self.filename)
+        for i in range(10):
+            writer.write_result(*RESULT)
+        self.close(writer)
+
+        lines = self.lines(self.filename)
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(lines[0].startswith('1500000000.000,4840D6,'))
+        self.assertEqual(self.coordinator.output_handlers, [])
+
+    def test_close_with_full_queue(self):
+        writer = output.LocalCSVWriter(self.coordinator, self.filename, queue_limit=5)
+
+        # hold up the writer thread so the queue fills
+        release = threading.Event()
+        format_result = writer._format_result
+
+        def slow_format(*args):
+            release.wait()
+            return format_result(*args)
+
+        writer._format_result = slow_format
+        for i in range(100):
+            writer.write_result(*RESULT)
+        self.assertGreater(writer.dropped_count, 0)
+
+        # must not block the event loop, even though the queue is full
+        start = time.monotonic()
+        writer.close()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+        release.set()
+        self.loop.run_until_complete(writer.wait_closed())
+        self.assertEqual(len(self.lines(self.filename)) + writer.dropped_count, 100)
+
+    def test_dropped_logged_once(self):
+        writer = output.LocalCSVWriter(self.coordinator, self.filename)
+        writer.dropped_count = 7
+        with self.assertLogs('csv', 'WARNING') as logs:
+            writer._close_file()
+            writer.f = open(self.filename, 'a')
+            writer._close_file()
+            writer.f = open(self.filename, 'a')
+            writer.dropped_count += 2
+            writer._close_file()
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('7 results dropped', logs.output[0])
+        self.assertIn('2 results dropped', logs.output[1])
+
+        writer.f = open(self.filename, 'a')
+        self.close(writer)
+
+    def test_rotate_by_size(self):
+        writer = output.LocalCSVWriter(self.coordinator, self.filename, rotate_size=1000, compress='gzip')
+        for i in range(50):
+            writer.write_result(*RESULT)
+            time.sleep(0.002)
+        self.close(writer)
+
+        rotated = glob.glob(self.filename + '.*')
+        self.assertTrue(rotated)
+        self.assertTrue(all(path.endswith('.gz') for path in rotated))
+        total = len(self.lines(self.filename)) + sum(len(self.lines(path)) for path in rotated)
+        self.assertEqual(total, 50)
+
+    def test_idle_rotation(self):
+        writer = output.LocalCSVWriter(self.coordinator, self.filename, rotate_interval=0.5, compress='gzip')
+        writer.IDLE_INTERVAL = 0.1
+        writer.write_result(*RESULT)
+
+        # nothing else is written, but the file is still rotated and compressed
+        deadline = time.monotonic() + 5.0
+        while not glob.glob(self.filename + '.*.gz') and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.close(writer)
+
+        rotated = glob.glob(self.filename + '.*')
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(len(self.lines(rotated[0])), 1)
+        self.assertEqual(self.lines(self.filename), [])
+
+
+class FakeWriter(object):
+    def __init__(self, reader, port):
+        self.reader = reader
+        self.port = port
+        self.written = []
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', self.port) if name == 'peername' else None
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self.drained.wait()
+
+    def close(self):
+        self.closed = True
+        self.reader.feed_eof()
+
+
+class BasestationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.coordinator = DummyCoordinator()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+            self.loop.run_until_complete(client.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def connect(self, feed, heartbeat_interval=30.0):
+        reader = asyncio.StreamReader()
+        writer = FakeWriter(reader, len(self.clients) + 1000)
+        client = output.BasestationClient(reader, writer, feed=feed,
+                                          heartbeat_interval=heartbeat_interval)
+        self.clients.append(client)
+        return client, writer
+
+    def run_briefly(self, seconds=0.01):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_formatted_once(self):
+        feed = output.BasestationFeed(self.coordinator, use_kalman_data=False)
+        c1, w1 = self.connect(feed)
+        c2, w2 = self.connect(feed)
+        self.assertEqual(self.coordinator.output_handlers, [feed.write_result])
+
+        feed.write_result(*RESULT)
+        self.assertIs(c1.queue[0], c2.queue[0])
+
+        self.run_briefly()
+        self.assertEqual(w1.written, w2.written)
+        self.assertEqual(len(w1.written), 1)
+        fields = w1.written[0].decode('ascii').rstrip('\n').split(',')
+        self.assertEqual(fields[:5], ['MSG', '3', '1', '1', '4840D6'])
+        self.assertEqual(c1.sent_count, 1)
+
+        # the handler is removed with the last client
+        c1.close()
+        c2.close()
+        self.assertEqual(self.coordinator.output_handlers, [])
+
+    def test_drops_oldest(self):
+        feed = output.BasestationFeed(self.coordinator, use_kalman_data=False, queue_limit=3)
+        client, writer = self.connect(feed)
+
+        # the client stops reading; the first line is written, then the
+        # writer waits for the transport to drain
+        writer.drained.clear()
+        client.enqueue(b'0\n')
+        self.run_briefly()
+        self.assertEqual(writer.written, [b'0\n'])
+
+        for i in range(1, 6):
+            client.enqueue('{0}\n'.format(i).encode('ascii'))
+        self.run_briefly()
+        self.assertEqual(list(client.queue), [b'3\n', b'4\n', b'5\n'])
+        self.assertEqual(client.dropped_count, 2)
+        self.assertEqual(feed.dump_state()[0]['queued'], 3)
+
+        # once drained, everything queued goes out in one write
+        writer.drained.set()
+        self.run_briefly()
+        self.assertEqual(writer.written, [b'0\n', b'3\n4\n5\n'])
+        self.assertEqual(client.sent_count, 4)
+        self.assertEqual(len(client.queue), 0)
+
+    def test_heartbeat_not_dropped(self):
+        feed = output.BasestationFeed(self.coordinator, use_kalman_data=False, queue_limit=2)
+        client, writer = self.connect(feed, heartbeat_interval=0.2)
+
+        writer.drained.clear()
+        client.enqueue(b'0\n')
+        self.run_briefly()
+
+        # the queue stays full while the heartbeat interval passes
+        for i in range(1, 30):
+            client.enqueue('{0}\n'.format(i).encode('ascii'))
+            self.run_briefly()
+        self.assertIn(b'\n', writer.written)
+        self.assertEqual(client.dropped_count, 27)
+        self.assertEqual(list(client.queue), [b'28\n', b'29\n'])
+
+    def test_idle_heartbeat(self):
+        feed = output.BasestationFeed(self.coordinator, use_kalman_data=False)
+        client, writer = self.connect(feed, heartbeat_interval=0.2)
+        self.run_briefly(0.5)
+        self.assertTrue(writer.written)
+        self.assertTrue(all(data == b'\n' for data in writer.written))
+        self.assertEqual(client.sent_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import outputbus
+
+
+class OutputBusTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+        # let the cancelled tasks finish
+        self.drain()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def make_bus(self, **kwargs):
+        bus = outputbus.OutputBus(**kwargs)
+        self.buses.append(bus)
+        return bus
+
+    def drain(self):
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_delivery(self):
+        bus = self.make_bus(batch_size=3)
+        seen = []
+        bus.add_handler(lambda *args: seen.append(args))
+        for i in range(10):
+            bus.publish((i, 'x'))
+
+        self.assertEqual(seen, [])
+        self.drain()
+        self.assertEqual(seen, [(i, 'x') for i in range(10)])
+        self.assertEqual(bus.dump_state()[0]['handled'], 10)
+
+    def test_drop_oldest(self):
+        bus = self.make_bus(limit=5, overflow='drop-oldest')
+        seen = []
+        bus.add_handler(lambda i: seen.append(i))
+        with self.assertLogs('outputbus', 'WARNING') as logs:
+            for i in range(8):
+                bus.publish((i,))
+        # drops are logged at most once per interval
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(bus.fill_fraction(), 1.0)
+
+        self.drain()
+        self.assertEqual(seen, [3, 4, 5, 6, 7])
+        self.assertEqual(bus.dump_state()[0]['dropped'], 3)
+        self.assertEqual(bus.fill_fraction(), 0.0)
+
+    def test_drop_newest(self):
+        bus = self.make_bus(limit=5, overflow='drop-newest')
+        seen = []
+        bus.add_handler(lambda i: seen.append(i))
+        for i in range(8):
+            bus.publish((i,))
+
+        self.drain()
+        self.assertEqual(seen, [0, 1, 2, 3, 4])
+        self.assertEqual(bus.dump_state()[0]['dropped'], 3)
+
+    def test_inline_overflow(self):
+        bus = self.make_bus(limit=5, overflow='inline')
+        seen = []
+        bus.add_handler(lambda i: seen.append(i))
+        for i in range(8):
+            bus.publish((i,))
+
+        # the overflow is handled immediately, ahead of the queue
+        self.assertEqual(seen, [5, 6, 7])
+        self.drain()
+        self.assertEqual(sorted(seen), list(range(8)))
+        state = bus.dump_state()[0]
+        self.assertEqual((state['dropped'], state['inline'], state['handled']), (0, 3, 8))
+
+    def test_inline_handler(self):
+        bus = self.make_bus(limit=2, overflow='drop-newest')
+        inline_seen = []
+        queued_seen = []
+        bus.add_handler(lambda i: inline_seen.append(i), inline=True)
+        bus.add_handler(lambda i: queued_seen.append(i))
+        for i in range(5):
+            bus.publish((i,))
+
+        # inline handlers never queue or drop, and don't count towards the fill level
+        self.assertEqual(inline_seen, [0, 1, 2, 3, 4])
+        self.drain()
+        self.assertEqual(queued_seen, [0, 1])
+        inline_state, queued_state = bus.dump_state()
+        self.assertEqual((inline_state['mode'], inline_state['dropped']), ('inline', 0))
+        self.assertEqual(queued_state['dropped'], 3)
+
+    def test_failing_handler(self):
+        bus = self.make_bus()
+        seen = []
+
+        def fail(i):
+            raise RuntimeError('handler failed')
+
+        bus.add_handler(fail)
+        bus.add_handler(lambda i: seen.append(i))
+        bus.publish((1,))
+        bus.publish((2,))
+        with self.assertLogs('outputbus', 'ERROR'):
+            self.drain()
+        self.assertEqual(seen, [1, 2])
+
+    def test_remove_handler(self):
+        bus = self.make_bus()
+        seen = []
+
+        def handler(i):
+            seen.append(i)
+
+        bus.add_handler(handler)
+        bus.remove_handler(handler)
+        bus.publish((1,))
+        self.drain()
+        self.assertEqual(seen, [])
+        with self.assertRaises(ValueError):
+            bus.remove_handler(handler)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            outputbus.OutputBus(overflow='discard')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import clocktrack, overload, timebase
+
+
+class Dummy(object):
+    pass
+
+
+class DummyCoordinator(object):
+    def __init__(self):
+        self.lag = 0.0
+        self.fill = 0.0
+
+        self.loop_monitor = Dummy()
+        self.loop_monitor.recent_lag = lambda: self.lag
+        self.output_bus = Dummy()
+        self.output_bus.fill_fraction = lambda: self.fill
+
+        self.mlat_tracker = Dummy()
+        self.mlat_tracker.pending = {}
+        self.mlat_tracker.max_pending = 100
+        self.mlat_tracker.skip_kalman = False
+        self.mlat_tracker.min_dof = 0
+        self.mlat_tracker.reject_new_groups = False
+        self.clock_tracker = Dummy()
+        self.clock_tracker.skip_converged_sync = False
+
+
+class OverloadControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = DummyCoordinator()
+        self.controller = overload.OverloadController(self.coordinator, hold_time=10.0)
+        self.now = 1000.0
+
+    def evaluate(self, lag=None, fill=None, elapsed=1.0):
+        if lag is not None:
+            self.coordinator.lag = lag
+        if fill is not None:
+            self.coordinator.fill = fill
+        self.now += elapsed
+        self.controller.evaluate(self.now)
+        return self.controller.level
+
+    def test_steps_up_one_level_at_a_time(self):
+        self.assertEqual(self.evaluate(lag=2.0), 1)
+        self.assertEqual(self.evaluate(), 2)
+        self.assertEqual(self.evaluate(), 3)
+        self.assertEqual(self.evaluate(), 4)
+        self.assertEqual(self.evaluate(), 4)
+        self.assertEqual(self.controller.transitions, 4)
+
+    def test_thresholds(self):
+        self.assertEqual(self.evaluate(lag=0.05), 0)
+        self.assertEqual(self.evaluate(lag=0.3), 1)
+        self.assertEqual(self.evaluate(), 2)
+        self.assertEqual(self.evaluate(), 2)
+
+    def test_queue_fill(self):
+        self.assertEqual(self.evaluate(fill=0.6), 1)
+        self.assertEqual(self.evaluate(), 2)
+        self.assertEqual(self.evaluate(), 2)
+
+        # pending mlat groups count as a queue too
+        self.coordinator.mlat_tracker.pending = dict.fromkeys(range(95))
+        self.assertEqual(self.evaluate(fill=0.0), 3)
+        self.assertEqual(self.evaluate(), 4)
+
+    def test_steps_down_after_hold_time(self):
+        self.evaluate(lag=0.3)
+        self.evaluate()
+        self.assertEqual(self.controller.level, 2)
+
+        # still above half the level 2 threshold: stay
+        self.assertEqual(self.evaluate(lag=0.2, elapsed=30.0), 2)
+
+        # load has to stay low for hold_time before each step down, no
+        # matter how long ago the last change was
+        self.assertEqual(self.evaluate(lag=0.0, elapsed=5.0), 2)
+        self.assertEqual(self.evaluate(elapsed=5.0), 2)
+        self.assertEqual(self.evaluate(elapsed=5.0), 1)
+        self.assertEqual(self.evaluate(elapsed=5.0), 1)
+        self.assertEqual(self.evaluate(elapsed=5.0), 0)
+
+    def test_brief_dip_does_not_step_down(self):
+        self.evaluate(lag=0.3)
+        self.assertEqual(self.evaluate(lag=0.0, elapsed=8.0), 1)
+        self.assertEqual(self.evaluate(lag=0.3, elapsed=1.0), 2)
+        self.assertEqual(self.evaluate(lag=0.2, elapsed=1.0), 2)
+        self.assertEqual(self.evaluate(lag=0.0, elapsed=8.0), 2)
+        self.assertEqual(self.evaluate(lag=0.2, elapsed=8.0), 2)
+        self.assertEqual(self.evaluate(lag=0.0, elapsed=8.0), 2)
+
+    def test_applies_levels(self):
+        mlat_tracker = self.coordinator.mlat_tracker
+        clock_tracker = self.coordinator.clock_tracker
+
+        def flags():
+            return (mlat_tracker.skip_kalman, mlat_tracker.min_dof,
+                    clock_tracker.skip_converged_sync, mlat_tracker.reject_new_groups)
+
+        self.evaluate(lag=2.0)
+        self.assertEqual(flags(), (True, 0, False, False))
+        self.evaluate()
+        self.assertEqual(flags(), (True, 1, False, False))
+        self.evaluate()
+        self.assertEqual(flags(), (True, 1, True, False))
+        self.evaluate()
+        self.assertEqual(flags(), (True, 1, True, True))
+
+        self.controller.close()
+        self.assertEqual(flags(), (False, 0, False, False))
+
+    def test_state(self):
+        self.evaluate(lag=0.3)
+        state = self.controller.dump_state()
+        self.assertEqual((state['level'], state['name'], state['transitions']), (1, 'skip-kalman', 1))
+        metrics = {m.name: m for m in self.controller.collect_metrics()}
+        self.assertEqual(metrics['overload_level'].samples[0][2], 1)
+
+
+class DummyPairing(object):
+    def __init__(self, n, valid, validity):
+        self.n = n
+        self.valid = valid
+        self.validity = validity
+
+
+class SkipConvergedSyncTestCase(unittest.TestCase):
+    def setUp(self):
+        # the tracker schedules its periodic cleanup on the current loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_skipped_pairing_is_not_a_sync(self):
+        tracker = clocktrack.ClockTracker()
+        tracker.skip_converged_sync = True
+        r0, r1 = object(), object()
+        tracker.clock_pairs[(r0, r1)] = DummyPairing(n=10, valid=True, validity=timebase.monotonic() + 30.0)
+
+        self.assertFalse(tracker._do_sync(0x123456, None, None, r0, 0, 1, r1, 0, 1))
+        self.assertEqual(tracker.skipped_sync_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import importlib
+import io
+import os
+import signal
+import threading
+import time
+import unittest
+
+from mlat import profile
+from mlat.server import coordinator, metrics, timebase
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    def setUp(self):
+        # latency profiling is selected when the module is imported
+        self.saved_env = os.environ.get('MLAT_LATENCY_PROFILE')
+        os.environ['MLAT_LATENCY_PROFILE'] = '1'
+        importlib.reload(profile)
+
+    def tearDown(self):
+        if self.saved_env is None:
+            del os.environ['MLAT_LATENCY_PROFILE']
+        else:
+            os.environ['MLAT_LATENCY_PROFILE'] = self.saved_env
+        importlib.reload(profile)
+
+    def record_samples(self):
+        profile.record_latency('solve', 0.0002)
+        profile.record_latency('solve', 0.001)     # exactly on a bound
+        profile.record_latency('solve', 0.003)
+        profile.record_latency('solve', 100.0)     # above the largest bound
+        profile.record_latency('output', 0.02)
+
+    def test_histograms(self):
+        self.assertTrue(profile.latency_enabled)
+        self.record_samples()
+
+        histograms = profile.latency_histograms()
+        self.assertEqual([h[0] for h in histograms], ['solve', 'output'])
+
+        stage, counts, total, maxval = histograms[0]
+        self.assertEqual(len(counts), len(profile.LATENCY_BUCKETS) + 1)
+        self.assertEqual(sum(counts), 4)
+        self.assertEqual(counts[profile.LATENCY_BUCKETS.index(0.00025)], 1)
+        self.assertEqual(counts[profile.LATENCY_BUCKETS.index(0.001)], 1)
+        self.assertEqual(counts[profile.LATENCY_BUCKETS.index(0.005)], 1)
+        self.assertEqual(counts[-1], 1)
+        self.assertAlmostEqual(total, 100.0042)
+        self.assertEqual(maxval, 100.0)
+
+    def test_dump(self):
+        self.record_samples()
+        out = io.StringIO()
+        profile.dump_latency_profiles(out)
+        lines = out.getvalue().split('\n')
+        self.assertTrue(lines[0].startswith('Stage'))
+        self.assertTrue(lines[1].startswith('solve'))
+        self.assertEqual(lines[1].split()[1], '4')
+
+    def test_prometheus(self):
+        self.record_samples()
+
+        loop = timebase.use_virtual_time()
+        try:
+            c = coordinator.Coordinator(work_dir='/nonexistent')
+            text = metrics.format_prometheus(list(c._collect_metrics()))
+        finally:
+            loop.close()
+            timebase.use_real_time()
+            asyncio.set_event_loop(None)
+
+        self.assertIn('# TYPE mlat_latency_seconds histogram\n', text)
+        lines = [line for line in text.split('\n') if line.startswith('mlat_latency_seconds')]
+
+        solve = [line for line in lines if 'stage="solve"' in line]
+        buckets = [line for line in solve if line.startswith('mlat_latency_seconds_bucket')]
+        self.assertEqual(len(buckets), len(profile.LATENCY_BUCKETS) + 1)
+        # buckets are cumulative, with a bound equal to a sample counting it
+        self.assertIn('mlat_latency_seconds_bucket{le="0.0001",stage="solve"} 0', buckets)
+        self.assertIn('mlat_latency_seconds_bucket{le="0.00025",stage="solve"} 1', buckets)
+        self.assertIn('mlat_latency_seconds_bucket{le="0.001",stage="solve"} 2', buckets)
+        self.assertIn('mlat_latency_seconds_bucket{le="0.005",stage="solve"} 3', buckets)
+        self.assertIn('mlat_latency_seconds_bucket{le="50.0",stage="solve"} 3', buckets)
+        self.assertEqual(buckets[-1], 'mlat_latency_seconds_bucket{le="+Inf",stage="solve"} 4')
+        self.assertIn('mlat_latency_seconds_count{stage="solve"} 4', solve)
+        self.assertEqual(len([line for line in solve if line.startswith('mlat_latency_seconds_sum')]), 1)
+        sum_line = [line for line in solve if line.startswith('mlat_latency_seconds_sum')][0]
+        self.assertAlmostEqual(float(sum_line.split()[1]), 100.0042)
+
+        self.assertIn('mlat_latency_seconds_bucket{le="+Inf",stage="output"} 1', lines)
+        self.assertIn('mlat_latency_seconds_count{stage="output"} 1', lines)
+        self.assertIn('mlat_latency_seconds_sum{stage="output"} 0.02', lines)
+
+
+class LatencyDisabledTestCase(unittest.TestCase):
+    def test_no_histograms(self):
+        if profile.latency_enabled:
+            self.skipTest('MLAT_LATENCY_PROFILE is set')
+        profile.record_latency('solve', 0.001)
+        self.assertEqual(profile.latency_histograms(), [])
+
+
+def busy_wait(stop):
+    while not stop.is_set():
+        pass
+
+
+class StackSamplerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.assertFalse(profile.sampling_enabled())
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=busy_wait, args=(self.stop,))
+        self.thread.start()
+
+    def tearDown(self):
+        profile.stop_sampling()
+        self.stop.set()
+        self.thread.join()
+        profile._sampled_stacks.clear()
+
+    def test_collapsed_stacks(self):
+        profile.start_sampling(interval=0.001, thread_ident=self.thread.ident)
+        self.assertTrue(profile.sampling_enabled())
+        deadline = time.monotonic() + 5.0
+        while profile._sampler.samples < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        profile.stop_sampling()
+        self.assertFalse(profile.sampling_enabled())
+
+        out = io.StringIO()
+        profile.dump_sampled_stacks(out)
+        lines = out.getvalue().split('\n')
+        self.assertEqual(lines[-1], '')
+        entries = [line.rsplit(' ', 1) for line in lines[:-1]]
+        counts = [int(count) for stack, count in entries]
+        self.assertGreaterEqual(sum(counts), 20)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+        # outermost frame first, labelled module.function
+        stack = entries[0][0].split(';')
+        self.assertEqual(stack[0], 'threading._bootstrap')
+        i = stack.index(__name__ + '.busy_wait')
+        self.assertEqual(stack[i - 1], 'threading.run')
+
+    def test_samples_kept_until_restart(self):
+        profile._sampled_stacks['a;b'] = 3
+        profile.start_sampling(interval=60.0, thread_ident=self.thread.ident, reset=False)
+        profile.stop_sampling()
+        self.assertEqual(profile._sampled_stacks, {'a;b': 3})
+
+        profile.start_sampling(interval=60.0, thread_ident=self.thread.ident)
+        profile.stop_sampling()
+        self.assertEqual(profile._sampled_stacks, {})
+
+    def test_too_many_stacks(self):
+        saved = profile.MAX_SAMPLED_STACKS
+        profile.MAX_SAMPLED_STACKS = 1
+        try:
+            profile._sampled_stacks['other'] = 1
+            profile.start_sampling(interval=0.001, thread_ident=self.thread.ident, reset=False)
+            deadline = time.monotonic() + 5.0
+            while profile._sampler.samples < 5 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            profile.stop_sampling()
+        finally:
+            profile.MAX_SAMPLED_STACKS = saved
+
+        self.assertEqual(profile._sampled_stacks['other'], 1)
+        self.assertEqual(set(profile._sampled_stacks), {'other', '[too many stacks]'})
+        self.assertGreaterEqual(profile._sampled_stacks['[too many stacks]'], 5)
+
+    def test_target_thread_exits(self):
+        profile.start_sampling(interval=0.001, thread_ident=self.thread.ident)
+        sampler = profile._sampler
+        self.stop.set()
+        self.thread.join()
+        sampler.join(5.0)
+        self.assertFalse(sampler.is_alive())
+
+
+class SamplingSignalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved = profile.sampling_configured
+        self.loop = timebase.use_virtual_time()
+
+    def tearDown(self):
+        profile.sampling_configured = self.saved
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def start_and_close(self, configured):
+        profile.sampling_configured = configured
+        c = coordinator.Coordinator(work_dir='/nonexistent')
+        self.loop.run_until_complete(c.start())
+        installed = signal.SIGUSR1 in self.loop._signal_handlers
+        c.close()
+        self.loop.run_until_complete(c.wait_closed())
+        self.assertNotIn(signal.SIGUSR1, self.loop._signal_handlers)
+        return installed
+
+    def test_not_configured(self):
+        self.assertFalse(self.start_and_close(False))
+
+    def test_configured(self):
+        self.assertTrue(self.start_and_close(True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import random
+import unittest
+
+import modes.altitude
+import modes.cpr
+import modes.message
+from mlat import constants, geodesy
+from mlat.server import simulator
+
+
+class AltitudeEncodingTestCase(unittest.TestCase):
+    def test_ac13_round_trip(self):
+        for alt in range(-1000, 50175 + 1, 25):
+            ac13 = modes.altitude.encode_ac13(alt)
+            self.assertEqual(ac13 & 0x0040, 0)     # M bit clear
+            self.assertEqual(ac13 & 0x0010, 0x10)  # Q bit set
+            self.assertEqual(modes.altitude.decode_ac13(ac13), alt)
+
+    def test_ac12_round_trip(self):
+        for alt in range(-1000, 50175 + 1, 25):
+            ac12 = modes.altitude.encode_ac12(alt)
+            self.assertLess(ac12, 0x1000)
+            self.assertEqual(modes.altitude.decode_ac12(ac12), alt)
+
+    def test_rounding(self):
+        self.assertEqual(modes.altitude.decode_ac13(modes.altitude.encode_ac13(35012)), 35000)
+        self.assertEqual(modes.altitude.decode_ac13(modes.altitude.encode_ac13(35013)), 35025)
+        self.assertEqual(modes.altitude.decode_ac12(modes.altitude.encode_ac12(-987.4)), -975)
+
+    def test_out_of_range(self):
+        for alt in (-1013, 50188, 100000):
+            with self.assertRaises(ValueError):
+                modes.altitude.encode_ac13(alt)
+            with self.assertRaises(ValueError):
+                modes.altitude.encode_ac12(alt)
+
+
+class CPREncodingTestCase(unittest.TestCase):
+    def check(self, lat, lon):
+        latE, lonE = modes.cpr.encode(lat, lon, False)
+        latO, lonO = modes.cpr.encode(lat, lon, True)
+        for v in (latE, lonE, latO, lonO):
+            self.assertTrue(0 <= v < 131072)
+
+        rlatE, rlonE, rlatO, rlonO = modes.cpr.decode(latE, lonE, latO, lonO)
+
+        # within half a step of the encoding grid
+        nl = modes.cpr.NL(lat)
+        for rlat, rlon, zones in ((rlatE, rlonE, nl), (rlatO, rlonO, max(1, nl - 1))):
+            self.assertLessEqual(abs(rlat - lat), 360.0 / 59 / 131072)
+            dlon = (rlon - lon + 180) % 360 - 180
+            self.assertLessEqual(abs(dlon), 360.0 / zones / 131072 + 1e-9)
+
+    def test_known_positions(self):
+        for lat, lon in ((51.5, -0.5), (0.0, 0.0), (-33.9, 151.2), (40.6, -73.8),
+                         (-54.8, -68.3), (64.1, -21.9), (1.35, 103.99), (86.0, 179.99)):
+            self.check(lat, lon)
+
+    def test_random_positions(self):
+        rng = random.Random(1234)
+        for i in range(2000):
+            lat = rng.uniform(-85, 85)
+            lon = rng.uniform(-180, 180)
+            # positions right on a latitude zone boundary may legitimately
+            # fail to decode globally; keep clear of them
+            if modes.cpr.NL(lat - 0.01) != modes.cpr.NL(lat + 0.01):
+                continue
+            self.check(lat, lon)
+
+
+class SimulationTestCase(unittest.TestCase):
+    def make_simulation(self):
+        return simulator.Simulation.random(5, 6, radius=100e3, adsb_fraction=0.5, seed=7, utc_base=1.5e9)
+
+    def test_deterministic(self):
+        a = self.make_simulation()
+        b = self.make_simulation()
+        self.assertEqual(a.events(0.0, 5.0), b.events(0.0, 5.0))
+
+    def test_messages_decode_to_truth(self):
+        sim = self.make_simulation()
+        self.assertEqual(len({ac.adsb for ac in sim.aircraft}), 2)
+
+        events = sim.events(0.0, 10.0)
+        sync_count = mlat_count = 0
+        for arrival, i, address, kind, args in events:
+            receiver = sim.receivers[i]
+            # the message left the aircraft slightly before it arrived
+            ac = sim._by_address[address]
+            t = arrival - geodesy.ecef_distance(ac.ecef(arrival), receiver.ecef) / constants.Cair
+
+            if kind == simulator.SYNC:
+                sync_count += 1
+                even_time, odd_time, even_message, odd_message = args
+                self.assertTrue(ac.adsb)
+
+                even = modes.message.decode(even_message)
+                odd = modes.message.decode(odd_message)
+                for decoded, odd_flag in ((even, 0), (odd, 1)):
+                    self.assertEqual(decoded.DF, 17)
+                    self.assertTrue(decoded.crc_ok)
+                    self.assertEqual(decoded.address, address)
+                    self.assertIs(decoded.estype, modes.message.ESType.airborne_position)
+                    self.assertEqual(decoded.F, odd_flag)
+                    self.assertGreaterEqual(decoded.nuc, 6)
+
+                # the even message was sent one position interval earlier
+                t_even = t - sim.position_interval
+                self.assertLess(even_time, odd_time)
+                self.assertAlmostEqual((odd_time - even_time) / receiver.clock.freq, sim.position_interval,
+                                       delta=1e-3)
+
+                rlatE, rlonE, rlatO, rlonO = modes.cpr.decode(even.LAT, even.LON, odd.LAT, odd.LON)
+                for (rlat, rlon, decoded), when in (((rlatE, rlonE, even), t_even), ((rlatO, rlonO, odd), t)):
+                    lat, lon, alt = ac.position(when)
+                    self.assertLess(geodesy.ecef_distance(geodesy.llh2ecef((rlat, rlon, alt)),
+                                                          geodesy.llh2ecef((lat, lon, alt))), 20.0)
+                    self.assertLessEqual(abs(decoded.altitude - alt * constants.MTOF), 12.5 + 1e-6)
+            else:
+                mlat_count += 1
+                timestamp, message = args
+                decoded = modes.message.decode(message)
+                self.assertEqual(decoded.address, address)
+                self.assertIn(decoded.DF, (4, 11))
+                if decoded.DF == 4:
+                    lat, lon, alt = ac.position(t)
+                    self.assertLessEqual(abs(decoded.altitude - alt * constants.MTOF), 12.5 + 1e-6)
+                else:
+                    self.assertTrue(decoded.crc_ok)
+
+        self.assertGreater(sync_count, 0)
+        self.assertGreater(mlat_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from mlat.server import statefile
+
+
+class StateFileWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mlat-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def read(self, name):
+        with open(os.path.join(self.work_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        writer = statefile.StateFileWriter(self.work_dir)
+        writer.write({'a.json': {'x': [1, 2]}, 'b.json': []})
+
+        self.assertEqual(self.read('a.json'), b'{"x":[1,2]}')
+        self.assertEqual(self.read('b.json'), b'[]')
+        self.assertEqual(writer.bodies['a.json'], (b'{"x":[1,2]}', hashlib.sha1(b'{"x":[1,2]}').hexdigest()))
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['a.json', 'b.json'])
+
+    def test_skip_unchanged(self):
+        writer = statefile.StateFileWriter(self.work_dir, skip_unchanged=True)
+        writer.write({'a.json': {'x': 1}})
+        path = os.path.join(self.work_dir, 'a.json')
+        os.utime(path, (0, 0))
+
+        writer.write({'a.json': {'x': 1}})
+        self.assertEqual(os.stat(path).st_mtime, 0)
+
+        writer.write({'a.json': {'x': 2}})
+        self.assertNotEqual(os.stat(path).st_mtime, 0)
+        self.assertEqual(writer.bodies['a.json'][0], b'{"x":2}')
+
+    def test_unserializable(self):
+        writer = statefile.StateFileWriter(self.work_dir)
+        with self.assertLogs('statefile', logging.ERROR):
+            writer.write({'bad.json': {'x': object()}, 'good.json': 1})
+        self.assertNotIn('bad.json', writer.bodies)
+        self.assertEqual(self.read('good.json'), b'1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import time
+import unittest
+
+from mlat.server import timebase, util
+
+
+class VirtualTimeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time(timebase.VirtualTimeEventLoop(utc=1500000000.0))
+
+    def tearDown(self):
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def test_clock(self):
+        self.assertIs(asyncio.get_event_loop(), self.loop)
+        self.assertEqual(timebase.monotonic(), self.loop.time())
+        self.assertAlmostEqual(timebase.time(), 1500000000.0)
+
+        self.loop.advance(12.5)
+        self.assertAlmostEqual(timebase.time(), 1500000012.5)
+
+    def test_sleep_skips_ahead(self):
+        @asyncio.coroutine
+        def sleeper():
+            yield from asyncio.sleep(3600.0)
+
+        start = time.monotonic()
+        virtual_start = timebase.monotonic()
+        self.loop.run_until_complete(sleeper())
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertAlmostEqual(timebase.monotonic() - virtual_start, 3600.0, delta=0.1)
+        self.assertAlmostEqual(timebase.time(), 1500003600.0, delta=0.1)
+
+    def test_call_later(self):
+        fired = []
+        timebase.call_later(2.0, lambda: fired.append(('b', timebase.time())))
+        timebase.call_later(1.0, lambda: fired.append(('a', timebase.time())))
+        handle = timebase.call_later(1.5, lambda: fired.append(('cancelled', timebase.time())))
+        handle.cancel()
+
+        self.loop.run_until_complete(asyncio.sleep(5.0))
+        self.assertEqual([name for name, t in fired], ['a', 'b'])
+        self.assertAlmostEqual(fired[0][1], 1500000001.0, delta=0.01)
+        self.assertAlmostEqual(fired[1][1], 1500000002.0, delta=0.01)
+
+    def test_completed_future(self):
+        # util.completed_future must belong to the virtual loop
+        self.assertTrue(self.loop.run_until_complete(util.completed_future))
+
+    def test_use_real_time(self):
+        timebase.use_real_time()
+        self.assertAlmostEqual(timebase.time(), time.time(), delta=1.0)
+        self.assertAlmostEqual(timebase.monotonic(), time.monotonic(), delta=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
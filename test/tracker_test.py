@@ -0,0 +1,121 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import asyncio
+import unittest
+
+from mlat.server import coordinator, timebase, tracker
+
+
+class RecordingConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def request_traffic(self, receiver, start_set, stop_set):
+        self.requests.append((set(start_set), set(stop_set)))
+
+
+def make_receiver(name):
+    return coordinator.Receiver(name, name, RecordingConnection(), None,
+                                position_llh=(51.5, -0.5, 100.0),
+                                privacy=False,
+                                connection_info='test')
+
+
+class TrafficRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+        self.tracker = tracker.Tracker((1, 1))
+        self.r1 = make_receiver('r1')
+        self.r2 = make_receiver('r2')
+
+    def tearDown(self):
+        self.tracker.close()
+        self.loop.close()
+        timebase.use_real_time()
+        asyncio.set_event_loop(None)
+
+    def flush(self):
+        self.loop.run_until_complete(asyncio.sleep(self.tracker.traffic_request_interval))
+
+    def update(self, *receivers):
+        for r in receivers:
+            self.tracker.update_interest(r)
+
+    def test_requests_follow_interest(self):
+        self.tracker.add(self.r1, {1, 2, 3})
+        self.tracker.add(self.r2, {1, 2})
+        self.update(self.r1, self.r2)
+
+        # nothing is sent until the periodic flush
+        self.assertEqual(self.r1.connection.requests, [])
+        self.flush()
+        # aircraft seen by two receivers are wanted for sync; 3 is seen by r1 only
+        self.assertEqual(self.r1.connection.requests, [({1, 2}, set())])
+        self.assertEqual(self.r2.connection.requests, [({1, 2}, set())])
+
+        self.tracker.remove(self.r2, {2})
+        self.update(self.r1, self.r2)
+        self.flush()
+        self.assertEqual(self.r1.connection.requests[1:], [(set(), {2})])
+        self.assertEqual(self.r2.connection.requests[1:], [(set(), {2})])
+
+        # no change, nothing sent
+        self.update(self.r1, self.r2)
+        self.flush()
+        self.assertEqual(len(self.r1.connection.requests), 2)
+        self.assertEqual(len(self.r2.connection.requests), 2)
+
+    def test_only_dirty_receivers_refreshed(self):
+        self.tracker.add(self.r1, {1})
+        self.tracker.add(self.r2, {1})
+        self.update(self.r1)
+        self.flush()
+        self.assertEqual(self.r1.connection.requests, [({1}, set())])
+        self.assertEqual(self.r2.connection.requests, [])
+
+    def test_dead_receiver_skipped(self):
+        self.tracker.add(self.r1, {1})
+        self.tracker.add(self.r2, {1})
+        self.update(self.r1, self.r2)
+        self.r2.dead = True
+        self.flush()
+        self.assertEqual(self.r2.connection.requests, [])
+
+    def test_readded_aircraft_not_requested_again(self):
+        self.tracker.add(self.r1, {1})
+        self.tracker.add(self.r2, {1})
+        self.update(self.r1, self.r2)
+        self.flush()
+
+        # the aircraft is dropped from the tracker and re-added between
+        # flushes; the receivers are already sending it
+        self.tracker.remove(self.r1, {1})
+        self.tracker.remove(self.r2, {1})
+        self.assertNotIn(1, self.tracker.aircraft)
+        self.tracker.add(self.r1, {1})
+        self.tracker.add(self.r2, {1})
+        self.update(self.r1, self.r2)
+        self.flush()
+        self.assertEqual(self.r1.connection.requests, [({1}, set())])
+        self.assertEqual(self.r2.connection.requests, [({1}, set())])
+
+    def test_close_stops_flushes(self):
+        self.tracker.add(self.r1, {1})
+        self.tracker.add(self.r2, {1})
+        self.update(self.r1, self.r2)
+        self.tracker.close()
+        self.flush()
+        self.assertEqual(self.r1.connection.requests, [])
+        self.assertIsNone(self.tracker._flush_handle)
+
+    def test_coordinator_close_stops_flushes(self):
+        c = coordinator.Coordinator(work_dir='/nonexistent')
+        self.loop.run_until_complete(c.start())
+        handle = c.tracker._flush_handle
+        c.close()
+        self.loop.run_until_complete(c.wait_closed())
+        self.assertTrue(handle._cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+import unittest
+
+from mlat.server import timebase, util
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = timebase.use_virtual_time()
+
+    def tearDown(self):
+        self.loop.close()
+        timebase.use_real_time()
+
+    def take_all(self):
+        n = 0
+        while self.bucket.take():
+            n += 1
+        return n
+
+    def test_burst(self):
+        self.bucket = util.TokenBucket(rate=10.0, burst=5)
+        self.assertEqual(self.take_all(), 5)
+        self.assertFalse(self.bucket.take())
+
+    def test_refill(self):
+        self.bucket = util.TokenBucket(rate=10.0, burst=5)
+        self.take_all()
+
+        # the bucket follows the server clock, so it refills in virtual time
+        self.loop.advance(0.25)
+        self.assertEqual(self.take_all(), 2)
+        self.loop.advance(0.05)
+        self.assertEqual(self.take_all(), 1)
+
+    def test_refill_capped_at_burst(self):
+        self.bucket = util.TokenBucket(rate=10.0, burst=5)
+        self.take_all()
+        self.loop.advance(3600.0)
+        self.assertEqual(self.take_all(), 5)
+
+    def test_sustained_rate(self):
+        self.bucket = util.TokenBucket(rate=10.0, burst=1)
+        allowed = 0
+        for i in range(1000):
+            # 100 events per second offered, for 10 seconds
+            self.loop.advance(0.01)
+            if self.bucket.take():
+                allowed += 1
+        self.assertAlmostEqual(allowed, 100, delta=2)
+
+
+if __name__ == '__main__':
+    unittest.main()